@@ -6,70 +6,346 @@ import platform # Para verificar o sistema operacional
 import getpass # Alternativa para obter o usuário atual
 # import pwd # Removido - Não funciona no Windows
 import re
+import ipaddress # Para validar o IP retornado pelos serviços externos
 import psutil # Para obter estatísticas do sistema
 import threading
+import signal # Tempo limite dos comandos (grupo de processos)
+import selectors # Saída dos comandos lida em stream
+import shlex
 import pwd # Para obter nome de usuário (Linux) - Adicionado para permissões
 import time
+import socket # Para identificar endereços IPv4 das interfaces (psutil)
 import shutil # Para verificar permissões de escrita
+import tempfile # Arquivo temporário do editor (nome imprevisível, criado com O_EXCL)
+import sqlite3 # Backend de armazenamento opcional
+import struct # Registros binários de largura fixa (histórico de estatísticas)
+import zlib # CRC32 dos registros
+import mimetypes # Content-Type dos downloads
+import queue # Blocos do download compactado (thread produtora -> resposta)
+import stat
+import errno
+import gzip
+import bz2
+import zipfile
+import tarfile
+import hashlib # Checksums dos uploads em partes
+import math
+import fnmatch # Busca por nome (glob)
+import mmap # Leituras por faixa no editor
+import codecs
+import csv # Manifestos de sites em lote
+import io
+import heapq # Seleção da página da listagem sem ordenar a pasta inteira
+import base64 # Cursor da paginação
+from array import array # Buffer circular de métricas em memória
+import copy # Para copiar os dados antes de modificá-los nos stores
+import ctypes # inotify via libc (Linux)
+import ctypes.util
+import multiprocessing # Busca com regex num processo filho (tempo limite garantido)
+try:
+    import fcntl # Lock entre processos (Linux/Unix)
+except ImportError:
+    fcntl = None # Windows: apenas o lock entre threads
+from abc import ABC, abstractmethod # Interface dos backends de armazenamento
+from collections import OrderedDict, deque # LRU do cache de listagens; fila de comandos por classe
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError # Membros do zip extraídos em paralelo; executor de comandos
 from datetime import datetime, timedelta, timezone
 from functools import wraps # Para criar decorators
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context, Response, stream_with_context
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context, Response, stream_with_context, send_file, has_request_context
+import click # Comandos 'flask --app app ...' (vem com o Flask)
+from flask_sock import Sock # WebSocket para as estatísticas ao vivo
 
 # --- Configurações ---
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Chave secreta para flash messages
+sock = Sock(app)
 
 SITES_DATA_FILE = 'sites_data.json'
-SYSTEM_LOG_FILE = 'system_stats_log.json' # Arquivo para logs de estatísticas
+SYSTEM_LOG_FILE = 'system_stats_log.json' # Log antigo de estatísticas (importado na primeira execução)
 LOG_INTERVAL_5MIN = 300 # Segundos (5 minutos)
+METRICS_SAMPLE_INTERVAL = 2 # Segundos entre amostras do sampler em memória (1 a 5 recomendado)
+METRICS_BUFFER_MINUTES = 30 # Janela mantida em memória em resolução total
+LIVE_STATS_INTERVAL = 2 # Segundos entre envios das estatísticas ao vivo (WebSocket); mínimo: METRICS_SAMPLE_INTERVAL
+LIVE_STATS_IDLE_TIMEOUT = 60 # Segundos sem mensagem do cliente (ping) até desconectá-lo
+SITE_METRICS_INTERVAL = 15 # Segundos entre amostras de recursos por site (CPU, memória, I/O, sockets)
+SITE_METRICS_OPEN_CGROUPS = 256 # Diretórios de cgroup mantidos abertos pelo coletor (LRU, 1 fd cada)
+SITE_STATS_OPEN_STORES = 64 # Históricos por site mantidos abertos no backend 'json' (LRU, 1 fd por nível)
+CGROUP_ROOT = '/sys/fs/cgroup' # Raiz do cgroup v2 (hierarquia unificada)
+SYSTEMD_CGROUP_SLICE = 'system.slice' # Slice onde o systemd coloca os serviços dos sites
+DISK_INDEX_INTERVAL = 300 # Segundos entre passadas do indexador de uso de disco (stat por diretório)
+DISK_INDEX_FULL_RESCAN = 6 * 3600 # Releitura completa (sem inotify): pega arquivos alterados no lugar
+DISK_INDEX_DEBOUNCE = 2 # Segundos para agrupar alterações antes de atualizar o índice
+FM_LIST_PAGE_SIZE = 500 # Itens por página na listagem do file manager
+FM_LIST_MAX_PAGE_SIZE = 5000
+FM_LIST_CACHE_MAX_DIRS = 128 # Diretórios mantidos no cache de listagens (cada um com um watch inotify)
+FM_LIST_CACHE_MAX_ENTRIES = 400000 # Total de entradas em cache somando todos os diretórios
+FM_LIST_CACHE_TTL = 10 # Segundos de validade de uma listagem sem watch inotify
+FM_SEARCH_MAX_RESULTS = 1000 # Resultados por busca no file manager
+FM_SEARCH_TIME_LIMIT = 20 # Segundos por busca (o que já foi encontrado é enviado)
+FM_SEARCH_MAX_READ = 1024 * 1024 # Bytes lidos de cada arquivo na busca por conteúdo
+FM_SEARCH_MATCHES_PER_FILE = 20 # Linhas enviadas por arquivo na busca por conteúdo
+FM_SEARCH_LINE_LENGTH = 300 # Caracteres por linha nos resultados
+FM_SEARCH_KILL_GRACE = 2 # Segundos além do limite até matar o processo de uma busca com regex
+FM_VIEW_MAX_BYTES = 2 * 1024 * 1024 # Bytes por leitura no visualizador/editor
+FM_VIEW_MAX_LINES = 20000 # Linhas por leitura (line/count e tail)
+FM_EDITOR_MAX_SIZE = 2 * 1024 * 1024 # Tamanho máximo de um arquivo salvo pelo editor
+FM_TAIL_POLL_INTERVAL = 0.5 # Segundos entre verificações no modo seguir (tail -f)
+FM_TAIL_HEARTBEAT = 15 # Segundos sem dados até um sinal de vida (detecta a desconexão)
+FM_TAIL_MAX_DURATION = 30 * 60 # Segundos por conexão no modo seguir (o navegador reconecta)
+FM_SEARCH_NAME_INDEX = True # Guarda os nomes dos arquivos no índice de disco (busca por nome sem scandir)
+FM_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # Tamanho das partes no upload em partes
+FM_UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024 # Maior parte aceita num PUT
+FM_UPLOAD_MAX_SIZE = 20 * 1024 ** 3 # Maior arquivo aceito no upload em partes
+FM_UPLOAD_PARALLEL = 4 # Partes enviadas em paralelo pelo navegador
+FM_UPLOAD_SESSION_TTL = 24 * 3600 # Segundos sem atividade até um upload incompleto ser descartado
+UPLOAD_STATE_DIR = 'upload_sessions' # Estado dos uploads em partes em andamento (retomáveis)
+UPLOAD_CHECKSUM_ALGORITHMS = ('sha256', 'sha1', 'md5')
+# Downloads pelo nginx (X-Accel-Redirect): defina um prefixo e, no server do painel,
+# 'location /_cicopanel_download/ { internal; alias /; }'. None: o Flask envia o arquivo.
+FM_DOWNLOAD_ACCEL_PREFIX = None # Ex: '/_cicopanel_download/'
+FM_ARCHIVE_COMPRESSION_LEVEL = 6 # Nível padrão (0 a 9) do download compactado; 0 = sem compressão
+FM_ARCHIVE_CHUNK_SIZE = 256 * 1024 # Bytes por bloco enviado no download compactado
+FM_ARCHIVE_QUEUE_CHUNKS = 16 # Blocos em memória por download (limita o uso de memória)
+FM_EXTRACT_WORKERS = 4 # Threads gravando os membros de um zip ao mesmo tempo
+FM_EXTRACT_BUFFER_SIZE = 1024 * 1024 # Bytes por leitura/escrita na extração
+FM_COPY_WORKERS = 8 # Threads copiando arquivos de uma árvore ao mesmo tempo
+FM_COPY_CHUNK_SIZE = 64 * 1024 * 1024 # Bytes por chamada de copy_file_range (granularidade do progresso)
+FM_COPY_BUFFER_SIZE = 1024 * 1024 # Bytes por leitura/escrita quando o kernel não copia sozinho
+COMMAND_WORKERS = 8 # Comandos (sudo, systemctl, certbot...) executando em background ao mesmo tempo
+COMMAND_TIMEOUT = 120 # Segundos por comando, salvo as classes em COMMAND_TIMEOUTS
+COMMAND_TIMEOUTS = {'certbot': 600, 'rm': 3600, 'chown': 1800, 'apt-get': 1800} # Por programa executado
+COMMAND_CLASS_LIMITS = {'certbot': 1, 'nginx': 1, 'apt-get': 1, 'useradd': 1, 'userdel': 1, 'chpasswd': 1} # Máximo ao mesmo tempo por programa
+COMMAND_OUTPUT_LIMIT = 256 * 1024 # Bytes de saída guardados por canal (stdout/stderr) de cada comando
+COMMAND_KILL_GRACE = 5 # Segundos entre o SIGTERM e o SIGKILL de um comando que estourou o tempo
+FILE_JOBS_DATA_FILE = 'file_jobs.json' # Registros das tarefas do file manager (backend 'json')
+FILE_JOBS_WORKERS = 4 # Tarefas do file manager (extrair, copiar, mover, excluir) executando ao mesmo tempo
+FILE_JOBS_PER_USER = 2 # Máximo em execução por usuário (as demais esperam na fila)
+FILE_JOBS_PER_SITE = 2 # Máximo em execução por site
+FILE_JOBS_MAX_QUEUED = 20 # Máximo na fila por usuário
+FILE_JOBS_HISTORY = 200 # Registros de tarefas mantidos
+FILE_JOBS_MAX_ERRORS = 100 # Erros guardados por tarefa
+PROVISIONING_DATA_FILE = 'provisioning.json' # Registros dos provisionamentos de sites (backend 'json')
+PROVISIONING_WORKERS = 2 # Sites sendo provisionados ao mesmo tempo (certbot/nginx já são serializados no executor)
+PROVISIONING_HISTORY = 1000 # Registros de provisionamento mantidos (acima de PROVISIONING_BULK_MAX_SITES)
+PROVISIONING_BULK_MAX_SITES = 500 # Sites por manifesto em /api/provisioning/bulk e 'flask import-sites'
+PROVISIONING_BULK_WORKERS = 8 # Sites de um lote processados ao mesmo tempo nas etapas locais (diretório, config, links)
+PROVISIONING_BULK_SSL_WORKERS = 4 # Certificados de um lote pedidos ao mesmo tempo (também limitado por COMMAND_CLASS_LIMITS['certbot'])
+PROVISIONING_MAX_MESSAGES = 50 # Mensagens guardadas por etapa
+PROVISIONING_EVENTS_TIMEOUT = 600 # Segundos máximos de uma conexão em /api/provisioning/<id>/events
+PROVISIONING_HEARTBEAT = 15 # Segundos entre linhas de 'keep-alive' no stream de eventos
+INOTIFY_ENABLED = True # Usa inotify (Linux) para atualizar índices/caches assim que os arquivos mudam
+INOTIFY_MODIFY_INTERVAL = 2 # Segundos entre avisos de escrita (IN_MODIFY) num mesmo diretório
 LOG_RETENTION_5MIN = timedelta(minutes=30)
 LOG_RETENTION_30MIN = timedelta(hours=24)
 LOG_RETENTION_24H = timedelta(days=7)
-log_lock = threading.Lock() # Lock para acesso seguro ao arquivo de log
+LOG_RETENTION = {'log_5min': LOG_RETENTION_5MIN, 'log_30min': LOG_RETENTION_30MIN, 'log_24h': LOG_RETENTION_24H}
+LOG_TIER_INTERVALS = {'log_5min': LOG_INTERVAL_5MIN, 'log_30min': 30 * 60, 'log_24h': 24 * 3600} # Segundos entre pontos de cada nível
+STATS_DATA_DIR = 'stats_data' # Arquivos circulares do histórico de estatísticas (backend 'json')
+ROLLUP_STATE_FILE = os.path.join(STATS_DATA_DIR, 'rollup_state.json') # Baldes de agregação em andamento
+ROLLUP_HISTOGRAM_STEP = 0.5 # Resolução (em pontos percentuais) do histograma usado para o p95
 NGINX_SITES_AVAILABLE = '/etc/nginx/sites-available/'
 NGINX_SITES_ENABLED = '/etc/nginx/sites-enabled/'
 SYSTEMD_SERVICE_DIR = '/etc/systemd/system/'
+SYSTEMD_DBUS_ENABLED = True # Fala com o systemd pelo D-Bus quando o jeepney está instalado (senão 'sudo systemctl')
+SYSTEMD_DBUS_TIMEOUT = 10 # Segundos por chamada ao systemd
+SYSTEMD_DBUS_RETRY = 60 # Segundos até tentar o D-Bus de novo depois de perder o barramento
+SYSTEMD_JOB_TIMEOUT = 90 # Segundos esperando um start/stop/restart terminar
+NGINX_RELOAD_DEBOUNCE = 1.0 # Segundos sem novos pedidos até recarregar o Nginx (agrupa alterações em lote)
+NGINX_RELOAD_MAX_DELAY = 5 # Segundos máximos entre o primeiro pedido e a recarga
+NGINX_RELOAD_WAIT_TIMEOUT = 300 # Segundos que uma requisição espera pelo resultado da recarga
 USERS_DATA_FILE = 'users.json'
+STORAGE_BACKEND = 'json' # 'json' (arquivos *.json) ou 'sqlite' (banco com índices, migra os JSON na primeira execução)
+SQLITE_DB_FILE = 'cicopanel.db'
+PUBLIC_IP_OVERRIDE = None # Defina um IP fixo (ex: '203.0.113.10') para nunca consultar serviços externos
+PUBLIC_IP_SERVICES = ['https://api.ipify.org', 'https://ifconfig.me/ip', 'https://icanhazip.com']
+PUBLIC_IP_TIMEOUT = 3 # Segundos por serviço consultado
+PUBLIC_IP_TTL = 3600 # Segundos até o IP em cache ser considerado velho
+PUBLIC_IP_RETRY_INTERVAL = 60 # Segundos entre tentativas enquanto nenhum serviço responde
 
 # --- Funções Auxiliares ---
 
+# Mensagens das funções auxiliares (Nginx, systemd, certbot...). Dentro de uma requisição viram
+# flash; quando a thread tem um coletor registrado (provisionamento em background) vão para ele.
+message_sink = threading.local()
+
+def notify(message, category='info'):
+    """Envia uma mensagem ao usuário: ao coletor da thread, como flash ou, sem requisição, ao log."""
+    collect = getattr(message_sink, 'collect', None)
+    if collect is not None:
+        collect(message, category)
+    elif has_request_context():
+        flash(message, category)
+    else:
+        print(f"[{category}] {message}")
+
+# --- Persistência Atômica de Arquivos JSON ---
+
+class StoreConflictError(Exception):
+    """A versão esperada não confere: o arquivo foi alterado desde a leitura."""
+
+
+class JsonFileStore:
+    """
+    Persistência de um arquivo JSON compartilhada entre as threads (e processos) do painel.
+
+    - Um lock por arquivo (RLock entre threads + flock num arquivo '.lock' entre processos).
+    - Gravação atômica: arquivo temporário no mesmo diretório, fsync e os.replace.
+    - Serialização compacta (sem indentação).
+    - Contador de versão para concorrência otimista: save(..., expected_version=v)
+      falha com StoreConflictError se outra gravação aconteceu depois da leitura v.
+
+    O lock só é mantido durante a leitura-modificação-gravação em memória; operações
+    lentas (certbot, systemctl) devem acontecer antes, fora de update().
+    """
+
+    _locks = {}
+    _locks_guard = threading.Lock()
+
+    def __init__(self, file_path, default_factory=list):
+        self.file_path = file_path
+        self.default_factory = default_factory
+        self.version = 0
+        self._data = default_factory()
+        self._signature = None
+        abs_path = os.path.abspath(file_path)
+        with JsonFileStore._locks_guard:
+            self.lock = JsonFileStore._locks.setdefault(abs_path, threading.RLock())
+
+    def _current_signature(self):
+        try:
+            st = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _process_lock(self):
+        """Abre e trava o arquivo '.lock' (entre processos). Retorna o descritor ou None."""
+        if fcntl is None:
+            return None
+        lock_fd = os.open(self.file_path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        return lock_fd
+
+    def _process_unlock(self, lock_fd):
+        if lock_fd is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+
+    def _refresh(self):
+        """Relê o arquivo se ele mudou desde a última leitura/gravação deste processo."""
+        signature = self._current_signature()
+        if signature == self._signature:
+            return
+        if signature is None:
+            data = self.default_factory()
+        else:
+            with open(self.file_path, 'r') as f:
+                data = json.load(f) # JSONDecodeError sobe para o chamador
+        self._data = data
+        self._signature = signature
+        self.version += 1
+
+    def _write(self, data):
+        dir_name = os.path.dirname(os.path.abspath(self.file_path))
+        tmp_path = os.path.join(dir_name, f".{os.path.basename(self.file_path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        # Garante que a renomeação também chegue ao disco
+        try:
+            dir_fd = os.open(dir_name, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass # Alguns sistemas de arquivos não permitem fsync em diretórios
+        self._data = data
+        self._signature = self._current_signature()
+        self.version += 1
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def snapshot(self):
+        """Retorna (dados, versão). Os dados são compartilhados: trate-os como somente leitura."""
+        with self.lock:
+            self._refresh()
+            return self._data, self.version
+
+    def save(self, data, expected_version=None):
+        """Grava os dados; com expected_version, falha se houve outra gravação desde a leitura."""
+        with self.lock:
+            lock_fd = self._process_lock()
+            try:
+                if expected_version is not None:
+                    self._refresh()
+                    if self.version != expected_version:
+                        raise StoreConflictError(f"{self.file_path} foi alterado por outra operação (versão {self.version}, esperada {expected_version}).")
+                self._write(data)
+                return self.version
+            finally:
+                self._process_unlock(lock_fd)
+
+    def update(self, mutator):
+        """
+        Leitura-modificação-gravação atômica: chama mutator(cópia_dos_dados) com o lock
+        e grava a cópia. O retorno do mutator é repassado. Exceções cancelam a gravação.
+        """
+        with self.lock:
+            lock_fd = self._process_lock()
+            try:
+                self._refresh()
+                data = copy.deepcopy(self._data)
+                result = mutator(data)
+                self._write(data)
+                return result
+            finally:
+                self._process_unlock(lock_fd)
+
 # --- Funções de Autenticação e Usuários ---
 
+DEFAULT_ADMIN_USER = {"username": "cico", "password": "admin"}
+
+def ensure_admin_user(users):
+    """Garante que 'cico' está na lista (adiciona no início se faltar). Retorna True se alterou."""
+    if not any(u['username'] == 'cico' for u in users):
+        users.insert(0, dict(DEFAULT_ADMIN_USER))
+        return True
+    return False
+
 def load_users():
-    """Carrega os dados dos usuários do arquivo JSON."""
-    if not os.path.exists(USERS_DATA_FILE):
-        # Cria o arquivo com o usuário padrão se não existir
-        default_users = [{"username": "cico", "password": "admin"}]
-        save_users(default_users)
-        return default_users
+    """Carrega os dados dos usuários do backend de armazenamento."""
     try:
-        with open(USERS_DATA_FILE, 'r') as f:
-            users = json.load(f)
-            # Garante que 'cico' existe (caso seja removido manualmente)
-            if not any(u['username'] == 'cico' for u in users):
-                users.append({"username": "cico", "password": "admin"}) # Adiciona se faltar
-                save_users(users)
-            return users
+        users = storage.list_users()
+        # Garante que 'cico' existe (arquivo/banco novo ou removido manualmente)
+        if ensure_admin_user(users):
+            save_users(users)
+        return users
     except json.JSONDecodeError:
         flash("Erro: Arquivo de usuários (users.json) corrompido. Recriando com usuário padrão.", 'error')
-        default_users = [{"username": "cico", "password": "admin"}]
+        default_users = [dict(DEFAULT_ADMIN_USER)]
         save_users(default_users)
         return default_users
     except Exception as e:
          flash(f"Erro inesperado ao carregar usuários: {e}", 'error')
-         return [{"username": "cico", "password": "admin"}] # Fallback seguro
+         return [dict(DEFAULT_ADMIN_USER)] # Fallback seguro
 
 def save_users(users):
-    """Salva os dados dos usuários no arquivo JSON."""
+    """Substitui a lista completa de usuários no backend de armazenamento."""
     try:
-        with open(USERS_DATA_FILE, 'w') as f:
-            # Garante que 'cico' está na lista antes de salvar
-            if not any(u['username'] == 'cico' for u in users):
-                 users.insert(0, {"username": "cico", "password": "admin"}) # Adiciona no início se faltar
-            json.dump(users, f, indent=4)
+        # Garante que 'cico' está na lista antes de salvar
+        ensure_admin_user(users)
+        storage.replace_users(users)
     except Exception as e:
-        flash(f"Erro crítico: Não foi possível salvar os dados dos usuários em {USERS_DATA_FILE}: {e}", 'error')
+        flash(f"Erro crítico: Não foi possível salvar os dados dos usuários: {e}", 'error')
 
 def verify_password(stored_password, provided_password):
     """Verifica a senha (atualmente comparação direta)."""
@@ -99,97 +375,802 @@ def admin_required(f):
 # --- Funções de Log de Estatísticas ---
 
 def load_system_logs():
-    """Carrega os logs de estatísticas do arquivo JSON."""
-    with log_lock: # Garante acesso exclusivo ao arquivo
-        if not os.path.exists(SYSTEM_LOG_FILE):
-            return {'log_5min': [], 'log_30min': [], 'log_24h': []}
-        try:
-            with open(SYSTEM_LOG_FILE, 'r') as f:
-                data = json.load(f)
-                # Garante que as chaves existem
-                if 'log_5min' not in data: data['log_5min'] = []
-                if 'log_30min' not in data: data['log_30min'] = []
-                if 'log_24h' not in data: data['log_24h'] = []
-                return data
-        except json.JSONDecodeError:
-            print(f"Erro: Arquivo de log de estatísticas {SYSTEM_LOG_FILE} corrompido. Criando um novo.")
-            return {'log_5min': [], 'log_30min': [], 'log_24h': []}
-        except Exception as e:
-            print(f"Erro inesperado ao carregar logs de estatísticas: {e}")
-            return {'log_5min': [], 'log_30min': [], 'log_24h': []} # Retorna vazio em caso de erro
+    """Carrega os logs de estatísticas do backend de armazenamento."""
+    try:
+        return storage.load_system_logs()
+    except Exception as e:
+        print(f"Erro inesperado ao carregar logs de estatísticas: {e}")
+        return {'log_5min': [], 'log_30min': [], 'log_24h': []} # Retorna vazio em caso de erro
 
 def save_system_logs(logs):
-    """Salva os logs de estatísticas no arquivo JSON."""
-    with log_lock: # Garante acesso exclusivo ao arquivo
-        try:
-            with open(SYSTEM_LOG_FILE, 'w') as f:
-                json.dump(logs, f, indent=2) # Indentação menor para economizar espaço
-        except Exception as e:
-            print(f"Erro crítico: Não foi possível salvar os logs de estatísticas em {SYSTEM_LOG_FILE}: {e}")
+    """Substitui todos os logs de estatísticas no backend de armazenamento."""
+    try:
+        storage.save_system_logs(logs)
+    except Exception as e:
+        print(f"Erro crítico: Não foi possível salvar os logs de estatísticas: {e}")
 
-def prune_logs(log_list, retention_period):
-    """Remove entradas antigas de uma lista de logs."""
-    if not log_list:
-        return []
-    now = datetime.now(timezone.utc)
-    cutoff_time = now - retention_period
-    # Converte strings ISO de volta para datetime para comparação
-    return [
-        entry for entry in log_list
-        if datetime.fromisoformat(entry['timestamp'].replace('Z', '+00:00')) >= cutoff_time
-    ]
+def parse_log_timestamp(timestamp):
+    """Converte o timestamp ISO 8601 UTC ('...Z') dos logs para datetime."""
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
 
 def log_system_stats():
-    """Coleta e salva as estatísticas do sistema."""
+    """Persiste o ponto do nível de 5 minutos, derivado do buffer de métricas em memória."""
     try:
-        cpu = psutil.cpu_percent(interval=0.1)
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
-        # Usar UTC para timestamps para evitar problemas com fuso horário e DST
-        timestamp = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z') # Formato ISO 8601 UTC
+        timestamps, values = metrics_buffer.window(LOG_INTERVAL_5MIN)
+        if not timestamps:
+            return # Nenhuma amostra ainda
 
+        # Média da janela: o ponto de 5 minutos representa todas as amostras do período
         current_stats = {
-            'timestamp': timestamp,
-            'cpu_usage': cpu,
-            'memory_usage': memory.percent,
-            'disk_usage': disk.percent
+            'timestamp': datetime.fromtimestamp(timestamps[-1], timezone.utc).isoformat().replace('+00:00', 'Z'), # Formato ISO 8601 UTC
         }
-
-        logs = load_system_logs()
-        now = datetime.now(timezone.utc)
+        for field, column in values.items():
+            current_stats[field] = round(sum(column) / len(column), 2)
 
         # --- Log de 5 minutos ---
-        logs['log_5min'].append(current_stats)
-        logs['log_5min'] = prune_logs(logs['log_5min'], LOG_RETENTION_5MIN)
-
-        # --- Log de 30 minutos (Downsampling) ---
-        # Adiciona um ponto a cada 30 minutos (aproximadamente)
-        last_30min_log_time = None
-        if logs['log_30min']:
-            last_30min_log_time = datetime.fromisoformat(logs['log_30min'][-1]['timestamp'].replace('Z', '+00:00'))
-
-        # Adiciona se for o primeiro log ou se passaram 30 minutos desde o último
-        if not last_30min_log_time or (now - last_30min_log_time) >= timedelta(minutes=30):
-            logs['log_30min'].append(current_stats)
-            logs['log_30min'] = prune_logs(logs['log_30min'], LOG_RETENTION_30MIN)
-
-        # --- Log de 24 horas (Downsampling) ---
-        # Adiciona um ponto a cada 24 horas (aproximadamente)
-        last_24h_log_time = None
-        if logs['log_24h']:
-            last_24h_log_time = datetime.fromisoformat(logs['log_24h'][-1]['timestamp'].replace('Z', '+00:00'))
-
-        # Adiciona se for o primeiro log ou se passaram 24 horas desde o último
-        if not last_24h_log_time or (now - last_24h_log_time) >= timedelta(hours=24):
-            logs['log_24h'].append(current_stats)
-            logs['log_24h'] = prune_logs(logs['log_24h'], LOG_RETENTION_24H)
-
-        save_system_logs(logs)
+        storage.append_system_stat(current_stats, ['log_5min'])
+
+        # --- Logs de 30 minutos e 24 horas (Rollups) ---
+        # Os baldes são alimentados pelo sampler a cada amostra; aqui apenas o estado
+        # em andamento é salvo em disco (no mesmo ritmo do nível de 5 minutos).
+        rollup_engine.save_state()
         # print(f"[{datetime.now()}] Estatísticas logadas com sucesso.") # Debug
 
     except Exception as e:
         print(f"Erro ao coletar/logar estatísticas do sistema: {e}")
 
+# --- Séries Temporais de Estatísticas (Arquivos Circulares Binários) ---
+# Cada nível (log_5min, log_30min, log_24h) tem um arquivo de tamanho fixo com registros
+# binários de largura fixa. Gravar uma amostra custa uma escrita de registro + cabeçalho
+# (O(1)), a retenção é o próprio anel (o registro mais antigo é sobrescrito) e leitores
+# usam os.pread sem travar o escritor: cada registro tem número de sequência e CRC.
+
+class StatsRingFile:
+    """Arquivo circular de registros (seq, timestamp, valores float32..., crc32)."""
+
+    MAGIC = b'CICOTS1\0'
+    HEADER = struct.Struct('<8sIIQ') # magic, tamanho do registro, capacidade, total já gravado
+
+    def __init__(self, path, fields, capacity):
+        self.path = path
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.record = struct.Struct('<Qd' + 'f' * len(self.fields) + 'I')
+        self._write_lock = threading.RLock() # Apenas entre escritores; leitores não travam
+        self._fd = None
+        self.head = 0 # Quantidade total de registros já gravados (próxima sequência)
+        self._open()
+
+    def _open(self):
+        preserved = []
+        if os.path.exists(self.path):
+            fd = os.open(self.path, os.O_RDWR)
+            header = os.pread(fd, self.HEADER.size, 0)
+            if len(header) == self.HEADER.size:
+                magic, record_size, capacity, head = self.HEADER.unpack(header)
+                if magic == self.MAGIC and record_size == self.record.size:
+                    if capacity == self.capacity:
+                        self._fd, self.head = fd, head
+                        return
+                    # Capacidade mudou (retenção/intervalo alterados): preserva os registros
+                    preserved = self._read_from(fd, capacity, head)
+            os.close(fd)
+            if not preserved:
+                print(f"Aviso: Arquivo de estatísticas '{self.path}' em formato diferente. Recriando.")
+        self._create(preserved)
+
+    def _create(self, records=()):
+        """Cria o arquivo vazio (via temporário + os.replace) e regrava 'records' nele."""
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(fd, self.HEADER.size + self.record.size * self.capacity)
+        os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.record.size, self.capacity, 0), 0)
+        os.replace(tmp_path, self.path)
+        self._fd = fd
+        self.head = 0
+        for timestamp, values in records[-self.capacity:]:
+            self.append(timestamp, values)
+
+    def append(self, timestamp, values):
+        """Grava um registro sobre o slot mais antigo e avança o cabeçalho."""
+        with self._write_lock:
+            seq = self.head
+            payload = self.record.pack(seq, timestamp, *values, 0)[:-4]
+            data = payload + struct.pack('<I', zlib.crc32(payload))
+            os.pwrite(self._fd, data, self.HEADER.size + (seq % self.capacity) * self.record.size)
+            self.head = seq + 1
+            os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, self.record.size, self.capacity, self.head), 0)
+
+    def _valid(self, chunk):
+        return len(chunk) == self.record.size and zlib.crc32(chunk[:-4]) == struct.unpack_from('<I', chunk, self.record.size - 4)[0]
+
+    def _read_from(self, fd, capacity, head, since=None):
+        raw = os.pread(fd, self.record.size * capacity, self.HEADER.size)
+        oldest_seq = max(0, head - capacity)
+        records = []
+        for offset in range(0, len(raw) - self.record.size + 1, self.record.size):
+            chunk = raw[offset:offset + self.record.size]
+            if not self._valid(chunk):
+                continue # Slot vazio ou sendo escrito neste instante
+            seq, timestamp, *values, _ = self.record.unpack(chunk)
+            if seq < oldest_seq or (since is not None and timestamp < since):
+                continue
+            records.append((seq, timestamp, tuple(values)))
+        records.sort()
+        return [(timestamp, values) for _, timestamp, values in records]
+
+    def read_records(self, since=None):
+        """Retorna [(timestamp, (valores...))] em ordem cronológica, sem travar o escritor."""
+        return self._read_from(self._fd, self.capacity, self.head, since)
+
+    def clear(self):
+        with self._write_lock:
+            old_fd = self._fd
+            self._create()
+            os.close(old_fd)
+
+    def close(self):
+        with self._write_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+STATS_FIELDS = ('cpu_usage', 'memory_usage', 'disk_usage')
+SITE_STATS_FIELDS = ('cpu_usage', 'memory_mb', 'io_read_bps', 'io_write_bps', 'sockets') # Recursos por serviço de site
+SITE_STATS_TIERS = tuple(LOG_RETENTION) # Por site, todos os níveis são agregados das amostras do coletor
+ROLLUP_TIERS = ('log_30min', 'log_24h')
+ROLLUP_SUFFIXES = ('_min', '_max', '_p95') # A média fica no próprio nome da métrica (ex: 'cpu_usage')
+
+def rollup_fields(metrics):
+    """Campos de uma entrada agregada: média, mín, máx e p95 de cada métrica + 'samples'."""
+    return tuple(
+        name for metric in metrics for name in (metric,) + tuple(metric + suffix for suffix in ROLLUP_SUFFIXES)
+    ) + ('samples',)
+
+ROLLUP_FIELDS = rollup_fields(STATS_FIELDS)
+
+def tier_fields(tier, metrics=STATS_FIELDS, rollup_tiers=ROLLUP_TIERS):
+    """Campos gravados em cada nível: amostras brutas ou agregados."""
+    return rollup_fields(metrics) if tier in rollup_tiers else tuple(metrics)
+
+def entry_field_value(entry, field):
+    """Valor de um campo; entradas antigas sem agregados usam o valor bruto da métrica."""
+    if field in entry:
+        return float(entry[field] or 0)
+    if field == 'samples':
+        return 1.0
+    for suffix in ROLLUP_SUFFIXES:
+        if field.endswith(suffix):
+            return float(entry.get(field[:-len(suffix)]) or 0)
+    return 0.0
+
+class SystemStatsStore:
+    """
+    Histórico de estatísticas em níveis de retenção, um StatsRingFile por nível.
+
+    'metrics' e 'rollup_tiers' permitem reutilizar o mesmo formato para outras séries
+    (ex: recursos por site, em que todos os níveis são agregados).
+    """
+
+    def __init__(self, data_dir, legacy_file=None, metrics=STATS_FIELDS, rollup_tiers=ROLLUP_TIERS):
+        os.makedirs(data_dir, exist_ok=True)
+        paths = {tier: os.path.join(data_dir, f'{tier}.bin') for tier in LOG_RETENTION}
+        is_new = not any(os.path.exists(path) for path in paths.values())
+        self.rings = {}
+        for tier, retention in LOG_RETENTION.items():
+            # Capacidade = amostras esperadas no período de retenção + folga para atrasos
+            capacity = math.ceil(retention.total_seconds() / LOG_TIER_INTERVALS[tier]) + 2
+            self.rings[tier] = StatsRingFile(paths[tier], tier_fields(tier, metrics, rollup_tiers), capacity)
+        if is_new and legacy_file:
+            self._import_legacy_json(legacy_file)
+
+    def _import_legacy_json(self, legacy_file):
+        """Importa o antigo system_stats_log.json na primeira execução."""
+        if not os.path.exists(legacy_file):
+            return
+        try:
+            with open(legacy_file, 'r') as f:
+                logs = json.load(f)
+            self.replace(logs)
+            print(f"Histórico de estatísticas importado de '{legacy_file}'.")
+        except Exception as e:
+            print(f"Aviso: Não foi possível importar '{legacy_file}': {e}")
+
+    def _to_entry(self, tier, timestamp, values):
+        entry = {'timestamp': datetime.fromtimestamp(timestamp, timezone.utc).isoformat().replace('+00:00', 'Z')}
+        for field, value in zip(self.rings[tier].fields, values):
+            entry[field] = int(value) if field == 'samples' else round(value, 2) # float32 -> evita 12.300000190734863 no JSON
+        return entry
+
+    def append(self, entry, tiers):
+        timestamp = parse_log_timestamp(entry['timestamp']).timestamp()
+        for tier in tiers:
+            ring = self.rings[tier]
+            ring.append(timestamp, tuple(entry_field_value(entry, field) for field in ring.fields))
+
+    def load(self):
+        now = time.time()
+        return {
+            tier: [self._to_entry(tier, ts, values) for ts, values in ring.read_records(since=now - LOG_RETENTION[tier].total_seconds())]
+            for tier, ring in self.rings.items()
+        }
+
+    def replace(self, logs):
+        for tier, ring in self.rings.items():
+            ring.clear()
+            entries = sorted(logs.get(tier, []), key=lambda e: e['timestamp'])
+            for entry in entries:
+                self.append(entry, [tier])
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+
+
+# --- Rollups do Histórico (Mín/Média/Máx/p95 por Balde) ---
+
+def histogram_bin(metric, value):
+    """Bin do histograma: linear para percentuais ('*_usage'), logarítmico para o resto (MB, bytes/s...)."""
+    if metric.endswith('_usage'):
+        index = int(value / ROLLUP_HISTOGRAM_STEP)
+    else:
+        index = int(math.log2(1 + max(0.0, value)) * 4) # 4 bins por dobro (~19% de resolução)
+    return min(RollupBucket.BINS - 1, max(0, index))
+
+def histogram_bin_upper(metric, index):
+    """Limite superior de um bin (inverso de histogram_bin)."""
+    if metric.endswith('_usage'):
+        return (index + 1) * ROLLUP_HISTOGRAM_STEP
+    return 2 ** ((index + 1) / 4) - 1
+
+
+class RollupBucket:
+    """Acumulador de um balde: contagem, soma, mín, máx e histograma (para o p95) por métrica."""
+
+    BINS = int(100 / ROLLUP_HISTOGRAM_STEP) + 1
+
+    def __init__(self, start, state=None, metrics=STATS_FIELDS):
+        self.start = start
+        self.metrics = tuple(metrics)
+        state = state or {}
+        self.count = state.get('count', 0)
+        self.sums = state.get('sums', [0.0] * len(self.metrics))
+        self.mins = state.get('mins', [None] * len(self.metrics))
+        self.maxs = state.get('maxs', [None] * len(self.metrics))
+        self.histograms = state.get('histograms', [[0] * self.BINS for _ in self.metrics])
+
+    def add(self, values):
+        self.count += 1
+        for i, value in enumerate(values):
+            self.sums[i] += value
+            self.mins[i] = value if self.mins[i] is None else min(self.mins[i], value)
+            self.maxs[i] = value if self.maxs[i] is None else max(self.maxs[i], value)
+            self.histograms[i][histogram_bin(self.metrics[i], value)] += 1
+
+    def _percentile(self, i, fraction):
+        target = math.ceil(self.count * fraction)
+        cumulative = 0
+        for bin_index, bin_count in enumerate(self.histograms[i]):
+            cumulative += bin_count
+            if cumulative >= target:
+                # Limite superior do bin, sem passar do máximo observado
+                return min(histogram_bin_upper(self.metrics[i], bin_index), self.maxs[i])
+        return self.maxs[i]
+
+    def to_entry(self):
+        entry = {'timestamp': datetime.fromtimestamp(self.start, timezone.utc).isoformat().replace('+00:00', 'Z')}
+        for i, metric in enumerate(self.metrics):
+            entry[metric] = round(self.sums[i] / self.count, 2)
+            entry[metric + '_min'] = round(self.mins[i], 2)
+            entry[metric + '_max'] = round(self.maxs[i], 2)
+            entry[metric + '_p95'] = round(self._percentile(i, 0.95), 2)
+        entry['samples'] = self.count
+        return entry
+
+    def to_state(self):
+        return {'start': self.start, 'count': self.count, 'sums': self.sums, 'mins': self.mins,
+                'maxs': self.maxs, 'histograms': self.histograms}
+
+
+class RollupEngine:
+    """
+    Agrega as amostras brutas do coletor em baldes alinhados por nível (30 min, 24 h).
+
+    add_sample() devolve os baldes que fecharam, prontos para gravar no nível. Os baldes
+    em andamento têm tamanho fixo (histograma) e são salvos num pequeno arquivo de estado
+    (a cada amostra, ou quando save_state() é chamado), para que um restart não perca o
+    dia corrente.
+    """
+
+    def __init__(self, state_file, metrics=STATS_FIELDS, tiers=ROLLUP_TIERS):
+        self.state_file = state_file
+        self.metrics = tuple(metrics)
+        self.tiers = tuple(tiers)
+        self._lock = threading.Lock()
+        self.buckets = {}
+        self._load_state()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            for tier, bucket_state in state.items():
+                if tier in self.tiers:
+                    self.buckets[tier] = RollupBucket(bucket_state['start'], bucket_state, self.metrics)
+        except Exception as e:
+            print(f"Aviso: Estado dos rollups ({self.state_file}) inválido, recomeçando: {e}")
+            self.buckets = {}
+
+    def _save_state_locked(self):
+        try:
+            self._write_state()
+        except OSError as e:
+            print(f"Aviso: Não foi possível salvar o estado dos rollups: {e}")
+
+    def _write_state(self):
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({tier: bucket.to_state() for tier, bucket in self.buckets.items()}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.state_file)
+
+    def add_sample(self, entry, persist=True):
+        """
+        Adiciona uma amostra bruta. Retorna [(nível, entrada_agregada)] dos baldes fechados.
+        Com persist=False o estado fica só em memória até a próxima chamada a save_state().
+        """
+        timestamp = parse_log_timestamp(entry['timestamp']).timestamp()
+        values = [float(entry.get(metric) or 0) for metric in self.metrics]
+        closed = []
+        with self._lock:
+            for tier in self.tiers:
+                interval = LOG_TIER_INTERVALS[tier]
+                bucket_start = timestamp - (timestamp % interval)
+                bucket = self.buckets.get(tier)
+                if bucket is not None and bucket.start != bucket_start:
+                    if bucket.count:
+                        closed.append((tier, bucket.to_entry()))
+                    bucket = None
+                if bucket is None:
+                    bucket = self.buckets[tier] = RollupBucket(bucket_start, metrics=self.metrics)
+                bucket.add(values)
+            if persist or closed:
+                self._save_state_locked()
+        return closed
+
+    def save_state(self):
+        with self._lock:
+            self._save_state_locked()
+
+    def partial_entries(self):
+        """Agregados dos baldes ainda abertos, marcados com 'partial': True."""
+        with self._lock:
+            entries = []
+            for tier, bucket in self.buckets.items():
+                if bucket.count:
+                    entry = bucket.to_entry()
+                    entry['partial'] = True
+                    entries.append((tier, entry))
+            return entries
+
+rollup_engine = RollupEngine(ROLLUP_STATE_FILE)
+
+# --- Métricas em Alta Resolução (Buffer Circular em Memória) ---
+# Um sampler em background coleta CPU/memória/disco a cada METRICS_SAMPLE_INTERVAL
+# segundos e grava num buffer circular de arrays (array('f') por métrica). As rotas
+# leem a última amostra sem bloquear, e o nível de 5 minutos em disco é derivado do
+# buffer (média da janela), então o I/O em disco não cresce com a resolução.
+
+class MetricsRingBuffer:
+    """Buffer circular de tamanho fixo: um array('d') de timestamps e um array('f') por métrica."""
+
+    def __init__(self, fields, capacity):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.values = {field: array('f', [0.0]) * capacity for field in self.fields}
+        self.head = 0 # Total de amostras já gravadas
+        self.latest = None # Última amostra completa (dict); trocada por atribuição, leitura sem lock
+        self._lock = threading.Lock()
+
+    def append(self, sample):
+        with self._lock:
+            slot = self.head % self.capacity
+            self.timestamps[slot] = sample['epoch']
+            for field in self.fields:
+                self.values[field][slot] = sample[field]
+            self.head += 1
+        self.latest = sample
+
+    def window(self, seconds):
+        """Retorna (timestamps, {métrica: valores}) das amostras dos últimos 'seconds', em ordem."""
+        with self._lock:
+            count = min(self.head, self.capacity)
+            start = self.head - count
+            slots = [i % self.capacity for i in range(start, self.head)]
+            timestamps = [self.timestamps[i] for i in slots]
+            values = {field: [self.values[field][i] for i in slots] for field in self.fields}
+        cutoff = time.time() - seconds
+        first = next((i for i, ts in enumerate(timestamps) if ts >= cutoff), len(timestamps))
+        return timestamps[first:], {field: column[first:] for field, column in values.items()}
+
+
+metrics_buffer = MetricsRingBuffer(
+    STATS_FIELDS, max(1, int(METRICS_BUFFER_MINUTES * 60 / METRICS_SAMPLE_INTERVAL))
+)
+metrics_sampler_thread = None
+metrics_sampler_lock = threading.Lock()
+
+def collect_system_sample():
+    """Lê CPU, memória e disco sem bloquear (cpu_percent mede desde a chamada anterior)."""
+    cpu = psutil.cpu_percent(interval=None)
+    memory = psutil.virtual_memory()
+    disk = psutil.disk_usage('/') # Uso do disco raiz '/'
+    now = datetime.now(timezone.utc)
+    return {
+        'epoch': now.timestamp(),
+        # Usar UTC para timestamps para evitar problemas com fuso horário e DST
+        'timestamp': now.isoformat().replace('+00:00', 'Z'), # Formato ISO 8601 UTC
+        'cpu_usage': cpu,
+        'memory_usage': memory.percent,
+        'memory_total': round(memory.total / (1024**3), 2), # GB
+        'memory_used': round(memory.used / (1024**3), 2),   # GB
+        'disk_usage': disk.percent,
+        'disk_total': round(disk.total / (1024**3), 2),     # GB
+        'disk_used': round(disk.used / (1024**3), 2)        # GB
+    }
+
+# --- Transmissão ao Vivo das Estatísticas (WebSocket) ---
+# O sampler publica cada amostra aqui; uma única mensagem (completa e delta) é
+# serializada por intervalo e compartilhada por todos os clientes conectados.
+
+class StatsBroadcaster:
+    """
+    Distribui a amostra mais recente para os assinantes em LIVE_STATS_INTERVAL.
+
+    A cada publicação guarda a mensagem completa e o delta em relação à anterior
+    (somente os campos alterados), ambos já em JSON. Um cliente que recebeu a
+    publicação anterior recebe o delta; quem perdeu alguma recebe a completa.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.seq = 0
+        self.full_message = None
+        self.delta_message = None
+        self.subscribers = 0
+        self._last_values = {}
+        self._last_publish = None
+        self._condition = threading.Condition()
+
+    def publish(self, sample):
+        now = time.monotonic()
+        if self._last_publish is not None and now - self._last_publish < self.interval - 0.01:
+            return # Respeita a taxa configurada, mesmo com o sampler mais rápido
+        self._last_publish = now
+        values = {key: value for key, value in sample.items() if key != 'epoch'}
+        with self._condition:
+            if self.subscribers == 0:
+                # Ninguém ouvindo: não serializa; o próximo cliente começa com a mensagem completa
+                self._last_values = values
+                self.seq += 1
+                self.full_message = self.delta_message = None
+                return
+            changed = {key: value for key, value in values.items() if self._last_values.get(key) != value}
+            self._last_values = values
+            self.seq += 1
+            self.full_message = json.dumps({'type': 'full', 'seq': self.seq, 'stats': values})
+            self.delta_message = json.dumps({'type': 'delta', 'seq': self.seq, 'stats': changed})
+            self._condition.notify_all()
+
+    def subscribe(self):
+        with self._condition:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self._condition:
+            self.subscribers -= 1
+
+    def wait(self, last_seq, timeout):
+        """Aguarda uma publicação mais nova que last_seq. Retorna (seq, mensagem) ou (last_seq, None)."""
+        with self._condition:
+            if self.seq == last_seq or self.full_message is None:
+                self._condition.wait(timeout)
+            if self.seq == last_seq or self.full_message is None:
+                return last_seq, None
+            if last_seq and self.seq == last_seq + 1:
+                return self.seq, self.delta_message
+            return self.seq, self.full_message
+
+
+stats_broadcaster = StatsBroadcaster(LIVE_STATS_INTERVAL)
+
+def run_metrics_sampler():
+    """Coleta amostras no intervalo configurado e persiste o nível de 5 minutos."""
+    print(f"Iniciando sampler de métricas (intervalo de {METRICS_SAMPLE_INTERVAL}s)...")
+    psutil.cpu_percent(interval=None) # Primeira chamada só inicializa a medição
+    next_tick = time.monotonic()
+    last_persist = None
+    while True:
+        next_tick += METRICS_SAMPLE_INTERVAL
+        time.sleep(max(0, next_tick - time.monotonic()))
+        try:
+            sample = collect_system_sample()
+            metrics_buffer.append(sample)
+            stats_broadcaster.publish(sample)
+            # Os rollups recebem todas as amostras (em memória); o estado só vai ao disco a cada 5 min
+            for tier, rollup_entry in rollup_engine.add_sample(sample, persist=False):
+                storage.append_system_stat(rollup_entry, [tier])
+        except Exception as e:
+            print(f"Erro ao coletar amostra de métricas: {e}")
+            continue
+        if last_persist is None or time.monotonic() - last_persist >= LOG_INTERVAL_5MIN:
+            last_persist = time.monotonic()
+            log_system_stats()
+        if next_tick < time.monotonic() - METRICS_SAMPLE_INTERVAL:
+            next_tick = time.monotonic() # Atrasou demais (suspensão, etc.): não tenta compensar
+
+def start_metrics_sampler():
+    """Inicia a thread do sampler (uma única vez), junto com o coletor de recursos por site."""
+    global metrics_sampler_thread
+    with metrics_sampler_lock:
+        if metrics_sampler_thread is not None and metrics_sampler_thread.is_alive():
+            return
+        metrics_sampler_thread = threading.Thread(target=run_metrics_sampler, daemon=True)
+        metrics_sampler_thread.start()
+    start_site_metrics_collector()
+
+def get_latest_sample():
+    """Última amostra do buffer; garante o sampler mesmo quando o app roda via WSGI."""
+    start_metrics_sampler()
+    sample = metrics_buffer.latest
+    if sample is None:
+        sample = collect_system_sample() # Ainda sem amostras: leitura direta (não bloqueante)
+    return sample
+
+
+# --- Recursos por Site (Serviços Systemd) ---
+# Um coletor em background amostra, a cada SITE_METRICS_INTERVAL segundos, CPU, memória
+# (RSS), I/O e sockets abertos do 'service_name' de cada site. Com cgroup v2 os contadores
+# vêm dos arquivos do cgroup do serviço (diretórios mantidos abertos numa LRU e lidos via
+# dir_fd, sem resolver caminhos nem varrer processos); sem o cgroup, a árvore de processos
+# do MainPID (psutil), com os MainPIDs obtidos numa única consulta ao systemd.
+
+SITE_SERVICE_RE = re.compile(r'^[a-zA-Z0-9.@_-]+\.service$')
+
+class SiteResourceCollector:
+    """Lê os contadores acumulados de cada serviço e converte em taxas entre amostras."""
+
+    def __init__(self, cgroup_root):
+        self.cgroup_root = cgroup_root
+        self.unified = os.path.exists(os.path.join(cgroup_root, 'cgroup.controllers')) # cgroup v2
+        self.latest = {} # service_name -> última amostra (trocado por atribuição)
+        self._dir_fds = OrderedDict() # service_name -> fd do diretório do cgroup (LRU, até SITE_METRICS_OPEN_CGROUPS)
+        self._previous = {} # service_name -> (monotonic, cpu_usec, bytes lidos, bytes gravados)
+        self._engines = {} # service_name -> RollupEngine (níveis do histórico)
+        self._engines_lock = threading.Lock() # As rotas também consultam os baldes em andamento
+
+    # --- cgroup v2 ---
+
+    def _open_cgroup(self, service_name):
+        fd = self._dir_fds.get(service_name)
+        if fd is None:
+            try:
+                fd = os.open(os.path.join(self.cgroup_root, SYSTEMD_CGROUP_SLICE, service_name), os.O_RDONLY | os.O_DIRECTORY)
+            except OSError:
+                return None # Serviço parado (sem cgroup) ou inexistente
+            self._dir_fds[service_name] = fd
+            while len(self._dir_fds) > SITE_METRICS_OPEN_CGROUPS:
+                os.close(self._dir_fds.popitem(last=False)[1])
+        else:
+            self._dir_fds.move_to_end(service_name)
+        return fd
+
+    def _close_cgroup(self, service_name):
+        fd = self._dir_fds.pop(service_name, None)
+        if fd is not None:
+            os.close(fd)
+
+    @staticmethod
+    def _read_at(dir_fd, name):
+        fd = os.open(name, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            chunks = []
+            while True: # cgroup.procs de um serviço com muitos processos passa de um bloco
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    return b''.join(chunks).decode()
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+
+    def _read_cgroup(self, service_name):
+        """(cpu_usec, rss_bytes, bytes_lidos, bytes_gravados, pids) do cgroup do serviço, ou None."""
+        dir_fd = self._open_cgroup(service_name)
+        if dir_fd is None:
+            return None
+        try:
+            cpu_stat = self._read_at(dir_fd, 'cpu.stat')
+            memory_stat = self._read_at(dir_fd, 'memory.stat')
+            procs = self._read_at(dir_fd, 'cgroup.procs')
+            try:
+                io_stat = self._read_at(dir_fd, 'io.stat')
+            except FileNotFoundError:
+                io_stat = '' # Controlador 'io' não habilitado
+        except OSError:
+            # Serviço parado ou reiniciado: o cgroup antigo sumiu; reabre na próxima amostra
+            self._close_cgroup(service_name)
+            return None
+
+        cpu_usec = next((int(line.split()[1]) for line in cpu_stat.splitlines() if line.startswith('usage_usec ')), 0)
+        memory = dict(line.split(' ', 1) for line in memory_stat.splitlines() if ' ' in line)
+        rss = int(memory.get('anon', 0)) # Memória anônima: o equivalente ao RSS sem page cache
+        read_bytes = write_bytes = 0
+        for line in io_stat.splitlines():
+            for field in line.split()[1:]:
+                key, _, value = field.partition('=')
+                if key == 'rbytes':
+                    read_bytes += int(value)
+                elif key == 'wbytes':
+                    write_bytes += int(value)
+        pids = [int(pid) for pid in procs.split()]
+        return cpu_usec, rss, read_bytes, write_bytes, pids
+
+    # --- Sem cgroup: árvore de processos do MainPID ---
+
+    @staticmethod
+    def _main_pids(service_names):
+        """MainPID de vários serviços numa única consulta ao systemd (D-Bus ou systemctl show)."""
+        if not service_names:
+            return {}
+        try:
+            return systemd.main_pids(service_names)
+        except SystemdError:
+            return {}
+
+    @staticmethod
+    def _read_process_tree(pid):
+        try:
+            root = psutil.Process(pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None
+        cpu_seconds = rss = read_bytes = write_bytes = 0
+        pids = []
+        for proc in processes:
+            try:
+                with proc.oneshot():
+                    cpu_times = proc.cpu_times()
+                    cpu_seconds += cpu_times.user + cpu_times.system
+                    rss += proc.memory_info().rss
+                    try:
+                        io = proc.io_counters()
+                        read_bytes += io.read_bytes
+                        write_bytes += io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        pass # Sem permissão (ou plataforma sem io_counters)
+                pids.append(proc.pid)
+            except psutil.Error:
+                continue # Processo terminou durante a leitura
+        return int(cpu_seconds * 1e6), rss, read_bytes, write_bytes, pids
+
+    @staticmethod
+    def _sockets_by_pid():
+        """Contagem de sockets inet por PID (uma varredura para todos os serviços)."""
+        try:
+            connections = psutil.net_connections(kind='inet')
+        except (psutil.AccessDenied, OSError):
+            return {}
+        counts = {}
+        for connection in connections:
+            if connection.pid:
+                counts[connection.pid] = counts.get(connection.pid, 0) + 1
+        return counts
+
+    def sample(self, service_names):
+        """Amostra todos os serviços. Retorna {service_name: entrada} (vazio na primeira leitura)."""
+        now = time.monotonic()
+        counters = {}
+        without_cgroup = []
+        for service_name in service_names:
+            values = self._read_cgroup(service_name) if self.unified else None
+            if values is None:
+                without_cgroup.append(service_name)
+            else:
+                counters[service_name] = values
+        for service_name, pid in self._main_pids(without_cgroup).items():
+            values = self._read_process_tree(pid)
+            if values is not None:
+                counters[service_name] = values
+
+        sockets = self._sockets_by_pid()
+        cpu_capacity_usec = (psutil.cpu_count() or 1) * 1e6
+        timestamp = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+        samples = {}
+        for service_name, (cpu_usec, rss, read_bytes, write_bytes, pids) in counters.items():
+            previous = self._previous.get(service_name)
+            self._previous[service_name] = (now, cpu_usec, read_bytes, write_bytes)
+            if previous is None or now <= previous[0]:
+                continue # Primeira leitura: apenas a base para as taxas
+            elapsed = now - previous[0]
+            samples[service_name] = {
+                'timestamp': timestamp,
+                # Percentual da capacidade total do host (mesma escala do gráfico de CPU do sistema)
+                'cpu_usage': round(min(100.0, max(0, cpu_usec - previous[1]) / (elapsed * cpu_capacity_usec) * 100), 2),
+                'memory_mb': round(rss / (1024**2), 2),
+                'io_read_bps': round(max(0, read_bytes - previous[2]) / elapsed, 1),
+                'io_write_bps': round(max(0, write_bytes - previous[3]) / elapsed, 1),
+                'sockets': sum(sockets.get(pid, 0) for pid in pids),
+            }
+
+        # Serviços parados ou removidos: descarta a base e o diretório aberto
+        for service_name in set(self._previous) - set(counters):
+            del self._previous[service_name]
+        for service_name in set(self._dir_fds) - set(service_names):
+            self._close_cgroup(service_name)
+        self.latest = samples
+        return samples
+
+    def engine(self, service_name):
+        """RollupEngine do serviço (baldes de 5 min, 30 min e 24 h com estado em disco)."""
+        with self._engines_lock:
+            engine = self._engines.get(service_name)
+            if engine is None:
+                state_file = os.path.join(STATS_DATA_DIR, 'site_rollups', service_name + '.json')
+                engine = self._engines[service_name] = RollupEngine(state_file, SITE_STATS_FIELDS, SITE_STATS_TIERS)
+            return engine
+
+    def forget(self, service_name):
+        """Descarta o estado de um serviço removido."""
+        with self._engines_lock:
+            self._engines.pop(service_name, None)
+        self._previous.pop(service_name, None)
+        self.latest = {name: sample for name, sample in self.latest.items() if name != service_name}
+        try:
+            os.remove(os.path.join(STATS_DATA_DIR, 'site_rollups', service_name + '.json'))
+        except FileNotFoundError:
+            pass
+
+
+site_collector = SiteResourceCollector(CGROUP_ROOT)
+site_collector_thread = None
+
+def collect_site_metrics():
+    """Uma rodada do coletor: amostra todos os serviços e grava os baldes que fecharam."""
+    service_names = [site['service_name'] for site in storage.list_sites()
+                     if SITE_SERVICE_RE.match(site.get('service_name') or '')]
+    closed_by_tier = {}
+    for service_name, entry in site_collector.sample(service_names).items():
+        for tier, rollup_entry in site_collector.engine(service_name).add_sample(entry, persist=False):
+            closed_by_tier.setdefault(tier, {})[service_name] = rollup_entry
+    # Os baldes são alinhados ao relógio, então fecham juntos: uma gravação por nível
+    for tier, entries in closed_by_tier.items():
+        storage.append_site_stats(entries, tier)
+
+def run_site_metrics_collector():
+    print(f"Iniciando coletor de recursos por site (intervalo de {SITE_METRICS_INTERVAL}s)...")
+    while True:
+        started = time.monotonic()
+        try:
+            collect_site_metrics()
+        except Exception as e:
+            print(f"Erro ao coletar recursos por site: {e}")
+        time.sleep(max(1, SITE_METRICS_INTERVAL - (time.monotonic() - started)))
+
+def start_site_metrics_collector():
+    """Inicia a thread do coletor por site (uma única vez; apenas Linux)."""
+    global site_collector_thread
+    if platform.system() != 'Linux':
+        return
+    with metrics_sampler_lock:
+        if site_collector_thread is not None and site_collector_thread.is_alive():
+            return
+        site_collector_thread = threading.Thread(target=run_site_metrics_collector, daemon=True)
+        site_collector_thread.start()
+
+
 def set_directory_permissions(directory_path, username):
     """Define o dono do diretório para o usuário especificado (Linux apenas)."""
     if platform.system() != 'Linux':
@@ -197,14 +1178,14 @@ def set_directory_permissions(directory_path, username):
         return True # Considera sucesso em não-Linux
 
     if not os.path.exists(directory_path):
-        flash(f"Erro interno: Diretório '{directory_path}' não encontrado para definir permissões.", "error")
+        notify(f"Erro interno: Diretório '{directory_path}' não encontrado para definir permissões.", "error")
         return False
 
     # Verifica se o usuário do sistema existe
     try:
         pwd.getpwnam(username)
     except KeyError:
-        flash(f"Aviso: Usuário do sistema '{username}' não encontrado. Não foi possível definir permissões na pasta '{directory_path}'.", 'warning')
+        notify(f"Aviso: Usuário do sistema '{username}' não encontrado. Não foi possível definir permissões na pasta '{directory_path}'.", 'warning')
         return False # Falha pois o usuário não existe no OS
 
     print(f"Definindo permissões para {username} em {directory_path}")
@@ -213,10 +1194,10 @@ def set_directory_permissions(directory_path, username):
     if result and result.returncode == 0:
         # Opcional: Definir permissões mais específicas (ex: 755 para diretórios, 644 para arquivos)
         # run_command(['sudo', 'chmod', 'u+rwX,go+rX,go-w', directory_path], check=False) # Exemplo: drwxr-xr-x
-        flash(f"Permissões definidas para o usuário '{username}' no diretório '{directory_path}'.", 'info')
+        notify(f"Permissões definidas para o usuário '{username}' no diretório '{directory_path}'.", 'info')
         return True
     else:
-        flash(f"Falha ao definir permissões para '{username}' em '{directory_path}'. Detalhes: {result.stderr if result else 'N/A'}", 'error')
+        notify(f"Falha ao definir permissões para '{username}' em '{directory_path}'. Detalhes: {result.stderr if result else 'N/A'}", 'error')
         return False
 
 def create_home_symlink(target_path, username, site_domain):
@@ -226,7 +1207,7 @@ def create_home_symlink(target_path, username, site_domain):
         return True
 
     if not os.path.exists(target_path):
-        flash(f"Erro interno: Diretório de destino '{target_path}' não encontrado para criar link simbólico.", "error")
+        notify(f"Erro interno: Diretório de destino '{target_path}' não encontrado para criar link simbólico.", "error")
         return False
 
     # Gera um nome seguro para o link a partir do domínio
@@ -239,7 +1220,7 @@ def create_home_symlink(target_path, username, site_domain):
         user_uid = user_info.pw_uid
         user_gid = user_info.pw_gid
     except KeyError:
-        flash(f"Aviso: Usuário do sistema '{username}' não encontrado. Não foi possível criar link simbólico na home.", 'warning')
+        notify(f"Aviso: Usuário do sistema '{username}' não encontrado. Não foi possível criar link simbólico na home.", 'warning')
         return False # Usuário não existe no OS
 
     symlink_path = os.path.join(home_dir, site_link_name)
@@ -251,7 +1232,7 @@ def create_home_symlink(target_path, username, site_domain):
              print(f"Link simbólico '{symlink_path}' já existe e aponta corretamente.")
              return True
         else:
-            flash(f"Aviso: Já existe um arquivo ou link inválido em '{symlink_path}'. Link simbólico não foi criado.", 'warning')
+            notify(f"Aviso: Já existe um arquivo ou link inválido em '{symlink_path}'. Link simbólico não foi criado.", 'warning')
             return False # Impede a sobrescrita
 
     # Verifica se o diretório home existe e tem permissão de escrita para o usuário
@@ -266,14 +1247,14 @@ def create_home_symlink(target_path, username, site_domain):
              if result_ln and result_ln.returncode == 0:
                 result_chown = run_command(['sudo', 'chown', '-h', f'{username}:{username}', symlink_path], check=False) # -h para não seguir o link
                 if result_chown and result_chown.returncode == 0:
-                     flash(f"Link simbólico criado em '{symlink_path}' (como root e dono ajustado).", 'info')
+                     notify(f"Link simbólico criado em '{symlink_path}' (como root e dono ajustado).", 'info')
                      return True
                 else:
-                    flash(f"Falha ao ajustar dono do link simbólico '{symlink_path}' após criação.", 'error')
+                    notify(f"Falha ao ajustar dono do link simbólico '{symlink_path}' após criação.", 'error')
                     run_command(['sudo', 'rm', symlink_path], check=False) # Tenta limpar
                     return False
              else:
-                flash(f"Falha ao criar link simbólico '{symlink_path}' (mesmo como root).", 'error')
+                notify(f"Falha ao criar link simbólico '{symlink_path}' (mesmo como root).", 'error')
                 return False
 
 
@@ -283,68 +1264,968 @@ def create_home_symlink(target_path, username, site_domain):
     result = run_command(['sudo', '-u', username, 'ln', '-s', target_path, symlink_path], check=False)
 
     if result and result.returncode == 0:
-        flash(f"Link simbólico criado com sucesso em '{symlink_path}'.", 'success')
+        notify(f"Link simbólico criado com sucesso em '{symlink_path}'.", 'success')
         return True
     else:
-        flash(f"Falha ao criar link simbólico em '{symlink_path}'. Detalhes: {result.stderr if result else 'N/A'}", 'error')
+        notify(f"Falha ao criar link simbólico em '{symlink_path}'. Detalhes: {result.stderr if result else 'N/A'}", 'error')
         # Tenta verificar se o diretório home tem permissão de escrita para o usuário
         if not os.access(home_dir, os.W_OK):
-             flash(f"Verifique as permissões de escrita no diretório home: {home_dir}", "warning")
+             notify(f"Verifique as permissões de escrita no diretório home: {home_dir}", "warning")
         return False
 
 
-def run_logging_scheduler():
-    """Executa o log de estatísticas periodicamente em uma thread."""
-    print("Iniciando scheduler de log de estatísticas...")
-    while True:
-        log_system_stats()
-        # Espera o intervalo definido (com pequena correção para drift, embora simples)
-        time.sleep(LOG_INTERVAL_5MIN)
+# --- Funções Auxiliares Nginx/Systemd ---
 
+# --- Executor de Comandos ---
+# Todos os comandos privilegiados (sudo, systemctl, certbot, nginx...) passam por aqui. Cada
+# comando tem um tempo limite (por classe, ver COMMAND_TIMEOUTS): ao estourar, o grupo de
+# processos recebe SIGTERM e, após COMMAND_KILL_GRACE segundos, SIGKILL. A saída é lida em
+# stream (selectors) e guardada até COMMAND_OUTPUT_LIMIT bytes por canal (início + fim).
+# A classe é o programa executado (ignorando 'sudo' e as opções dele): COMMAND_CLASS_LIMITS
+# limita quantos rodam ao mesmo tempo (ex: um certbot por vez). submit_command() executa
+# num pool de COMMAND_WORKERS threads e devolve um Future (aguardar ou disparar e esquecer);
+# run_command() executa na thread atual, respeitando os mesmos limites.
+
+class CommandResult:
+    """Resultado de um comando. Compatível com subprocess.CompletedProcess (args, returncode, stdout, stderr)."""
+
+    def __init__(self, args, command_class, returncode=None, stdout='', stderr='', duration=0.0,
+                 timed_out=False, truncated=False, error=None):
+        self.args = args
+        self.command_class = command_class
+        self.returncode = returncode # None se o comando nem chegou a executar (ver 'error')
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration # Tempo de parede, em segundos (inclui a espera por vaga na classe)
+        self.timed_out = timed_out
+        self.truncated = truncated # Saída maior que COMMAND_OUTPUT_LIMIT (o meio foi descartado)
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def to_dict(self):
+        return {
+            "args": self.args if isinstance(self.args, str) else list(self.args),
+            "class": self.command_class, "returncode": self.returncode, "ok": self.ok,
+            "stdout": self.stdout, "stderr": self.stderr, "duration": round(self.duration, 3),
+            "timed_out": self.timed_out, "truncated": self.truncated, "error": self.error,
+        }
 
-# --- Funções Auxiliares Nginx/Systemd ---
 
-def run_command(command, check=True, shell=False):
-    """Executa um comando no shell e retorna o resultado."""
-    print(f"Executando comando: {' '.join(command)}")
+class CappedOutput:
+    """Guarda o início e o fim de um canal de saída, descartando o meio além do limite."""
+
+    def __init__(self, limit):
+        self.head_limit = limit * 3 // 4
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+
+    def write(self, data):
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data
+            excess = len(self.tail) - self.tail_limit
+            if excess > 0:
+                del self.tail[:excess]
+                self.dropped += excess
+
+    def text(self):
+        text = self.head.decode('utf-8', 'replace')
+        if self.dropped:
+            text += f"\n[... {self.dropped} bytes omitidos ...]\n"
+        return text + self.tail.decode('utf-8', 'replace')
+
+
+def command_class(command):
+    """Programa executado por um comando ('sudo -u x ln ...' -> 'ln'), usado nos limites e tempos."""
     try:
-        result = subprocess.run(command, capture_output=True, text=True, check=check, shell=shell)
-        print("Saída:", result.stdout)
-        if result.stderr:
-            print("Erro:", result.stderr)
-        return result
-    except subprocess.CalledProcessError as e:
-        print(f"Erro ao executar comando: {e}")
-        print("Saída de erro:", e.stderr)
-        flash(f"Erro ao executar comando: {' '.join(command)}. Detalhes: {e.stderr}", 'error')
+        args = shlex.split(command) if isinstance(command, str) else list(command)
+    except ValueError:
+        return 'shell'
+    if isinstance(command, str) and any(char in command for char in '|;&'):
+        return 'shell' # Pipeline: não há um único programa
+    index = 0
+    while index < len(args) and os.path.basename(args[index]) == 'sudo':
+        index += 1
+        while index < len(args) and args[index].startswith('-'):
+            index += 2 if args[index] in ('-u', '-g', '-C', '-D', '-h', '-p', '-U') else 1
+    return os.path.basename(args[index]) if index < len(args) else 'shell'
+
+def terminate_process_group(process):
+    """SIGTERM no grupo do processo; SIGKILL se não terminar em COMMAND_KILL_GRACE segundos."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            process.kill() if sig == signal.SIGKILL else process.terminate()
+        try:
+            process.wait(timeout=COMMAND_KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+def execute_command(command, timeout, shell=False, input=None, cwd=None, env=None, on_output=None):
+    """
+    Executa 'command' na thread atual e retorna (returncode, stdout, stderr, timed_out, truncated).
+    on_output(canal, texto), se informado, recebe a saída à medida que é produzida.
+    """
+    process = subprocess.Popen(command, shell=shell, cwd=cwd, env=env, start_new_session=True,
+                               stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    outputs = {process.stdout: CappedOutput(COMMAND_OUTPUT_LIMIT), process.stderr: CappedOutput(COMMAND_OUTPUT_LIMIT)}
+    names = {process.stdout: 'stdout', process.stderr: 'stderr'}
+    decoders = {stream: codecs.getincrementaldecoder('utf-8')('replace') for stream in outputs}
+    if input is not None:
+        try:
+            process.stdin.write(input.encode('utf-8') if isinstance(input, str) else input)
+        except BrokenPipeError:
+            pass # O comando saiu sem ler a entrada
+        process.stdin.close()
+    deadline = time.monotonic() + timeout if timeout else None
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        for stream in outputs:
+            selector.register(stream, selectors.EVENT_READ)
+        while selector.get_map():
+            remaining = deadline - time.monotonic() if deadline else None
+            if remaining is not None and remaining <= 0:
+                timed_out = True
+                break
+            for key, _ in selector.select(remaining):
+                data = os.read(key.fd, 65536)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                outputs[key.fileobj].write(data)
+                if on_output:
+                    on_output(names[key.fileobj], decoders[key.fileobj].decode(data))
+    if timed_out:
+        terminate_process_group(process)
+    else:
+        try:
+            process.wait(timeout=max(0.1, deadline - time.monotonic()) if deadline else None)
+        except subprocess.TimeoutExpired:
+            # Fechou a saída mas continua rodando (ex: daemonizou sem redirecionar)
+            timed_out = True
+            terminate_process_group(process)
+    for stream in outputs:
+        stream.close()
+    stdout, stderr = outputs[process.stdout], outputs[process.stderr]
+    return (process.returncode, stdout.text(), stderr.text(), timed_out,
+            bool(stdout.dropped or stderr.dropped))
+
+
+class CommandExecutor:
+    """Pool de execução de comandos com limite de concorrência por classe de comando."""
+
+    def __init__(self, workers, class_limits):
+        self.workers = workers
+        self.class_limits = class_limits
+        self._cond = threading.Condition()
+        self._running = {} # classe -> comandos em execução
+        self._waiting = {} # classe -> deque de execuções assíncronas aguardando vaga
+        self._pool = None
+
+    def _limit(self, cls):
+        return self.class_limits.get(cls)
+
+    def _try_acquire_locked(self, cls):
+        limit = self._limit(cls)
+        if limit is not None and self._running.get(cls, 0) >= limit:
+            return False
+        self._running[cls] = self._running.get(cls, 0) + 1
+        return True
+
+    def _release(self, cls):
+        """Libera a vaga da classe: passa para a próxima execução assíncrona ou acorda quem espera."""
+        with self._cond:
+            waiting = self._waiting.get(cls)
+            if waiting:
+                self._pool.submit(waiting.popleft()) # A vaga continua ocupada pela próxima
+                return
+            self._running[cls] -= 1
+            self._cond.notify_all()
+
+    def _execute(self, command, cls, timeout, queued_at, **options):
+        if timeout is None:
+            timeout = COMMAND_TIMEOUTS.get(cls, COMMAND_TIMEOUT)
+        label = command if isinstance(command, str) else ' '.join(command)
+        try:
+            returncode, stdout, stderr, timed_out, truncated = execute_command(command, timeout, **options)
+            error = f"Tempo limite de {timeout}s excedido." if timed_out else None
+        except OSError as e:
+            returncode, stdout, stderr, timed_out, truncated, error = None, '', '', False, False, str(e)
+        duration = time.monotonic() - queued_at
+        if timed_out:
+            print(f"Comando interrompido após {timeout}s (tempo limite): {label}")
+        return CommandResult(command, cls, returncode, stdout, stderr, duration, timed_out, truncated, error)
+
+    def run(self, command, timeout=None, **options):
+        """Executa na thread atual (aguardando vaga na classe) e retorna o CommandResult."""
+        cls = command_class(command)
+        queued_at = time.monotonic()
+        with self._cond:
+            while not self._try_acquire_locked(cls):
+                self._cond.wait()
+        try:
+            return self._execute(command, cls, timeout, queued_at, **options)
+        finally:
+            self._release(cls)
+
+    def submit(self, command, timeout=None, callback=None, **options):
+        """
+        Agenda o comando no pool e retorna um Future com o CommandResult. callback(resultado),
+        se informado, é chamado na thread do pool ao terminar (para disparar e esquecer).
+        """
+        cls = command_class(command)
+        queued_at = time.monotonic()
+        future = Future()
+
+        def task():
+            result = None
+            try:
+                if future.set_running_or_notify_cancel():
+                    result = self._execute(command, cls, timeout, queued_at, **options)
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                print(f"Erro ao executar comando agendado '{command}': {e}")
+            finally:
+                self._release(cls)
+            if result is not None and callback:
+                # Depois de liberar a vaga: o callback pode executar outro comando da mesma classe
+                try:
+                    callback(result)
+                except Exception as e:
+                    print(f"Erro no callback do comando '{command}': {e}")
+
+        with self._cond:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='command')
+            if self._try_acquire_locked(cls):
+                self._pool.submit(task)
+            else:
+                self._waiting.setdefault(cls, deque()).append(task)
+        return future
+
+    def status(self):
+        """Comandos em execução e aguardando, por classe."""
+        with self._cond:
+            return {cls: {"running": count, "waiting": len(self._waiting.get(cls, ()))}
+                    for cls, count in self._running.items() if count or self._waiting.get(cls)}
+
+
+command_executor = CommandExecutor(COMMAND_WORKERS, COMMAND_CLASS_LIMITS)
+
+def submit_command(command, timeout=None, callback=None, **options):
+    """Executa um comando em background; retorna o Future com o CommandResult."""
+    print(f"Agendando comando: {command if isinstance(command, str) else ' '.join(command)}")
+    return command_executor.submit(command, timeout, callback, **options)
+
+def log_command_result(result):
+    """callback para submit_command: registra o resultado de um comando disparado sem espera."""
+    label = result.args if isinstance(result.args, str) else ' '.join(result.args)
+    if result.ok:
+        print(f"Comando em background concluído em {result.duration:.1f}s: {label}")
+    else:
+        print(f"Comando em background falhou ({result.error or f'código {result.returncode}'}): {label}. {result.stderr.strip()}")
+
+def run_command(command, check=True, shell=False, timeout=None, input=None):
+    """
+    Executa um comando (pelo command_executor, com tempo limite) e retorna o CommandResult.
+    Retorna None se o comando não pôde ser executado, estourou o tempo limite ou, com
+    check=True, terminou com erro. 'input' é enviado na entrada padrão.
+    """
+    label = command if isinstance(command, str) else ' '.join(command)
+    print(f"Executando comando: {label}")
+    result = command_executor.run(command, timeout=timeout, shell=shell, input=input)
+    print("Saída:", result.stdout)
+    if result.stderr:
+        print("Erro:", result.stderr)
+    if result.error:
+        print(f"Erro ao executar comando: {result.error}")
+        notify(f"Erro ao executar comando: {label}. Detalhes: {result.error}", 'error')
         return None
-    except Exception as e:
-        print(f"Erro inesperado ao executar comando: {e}")
-        flash(f"Erro inesperado: {e}", 'error')
+    if check and result.returncode != 0:
+        print(f"Erro ao executar comando: código de saída {result.returncode}")
+        notify(f"Erro ao executar comando: {label}. Detalhes: {result.stderr}", 'error')
         return None
+    return result
+
+# --- Registro de Sites em Memória ---
+
+class SiteRegistry:
+    """
+    Cache em memória do arquivo de sites com índices por domínio, dono e serviço.
+
+    Os dados vêm de um JsonFileStore, que só relê o arquivo quando ele muda; os
+    índices são reconstruídos apenas quando a versão do store avança. Gravações
+    passam pelo store (lock + gravação atômica). Leituras retornam cópias.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.load_error = None # Último erro de leitura (arquivo corrompido, etc.)
+        self._lock = threading.RLock()
+        self._indexed_version = None
+        self._sites = []
+        self._by_domain = {}
+        self._by_owner = {}
+        self._by_service = {}
+
+    def _rebuild_indexes(self, sites):
+        self._sites = sites
+        self._by_domain = {}
+        self._by_owner = {}
+        self._by_service = {}
+        for site in sites:
+            self._by_domain[site.get('domain')] = site
+            self._by_owner.setdefault(site.get('created_by_user'), []).append(site)
+            if site.get('service_name'):
+                self._by_service[site['service_name']] = site
+
+    def _refresh(self):
+        """Reconstrói os índices se o store mudou desde a última indexação."""
+        try:
+            sites, version = self.store.snapshot()
+            if not isinstance(sites, list):
+                raise ValueError("o conteúdo não é uma lista de sites")
+        except (json.JSONDecodeError, ValueError) as e:
+            # Mantém os últimos dados válidos em memória para não apagar sites ao salvar
+            self.load_error = f"Arquivo de dados dos sites ({self.store.file_path}) inválido: {e}"
+            print(f"Erro: {self.load_error}")
+            return
+        self.load_error = None
+        if version != self._indexed_version:
+            self._rebuild_indexes([dict(s) for s in sites])
+            self._indexed_version = version
+
+    def all(self):
+        with self._lock:
+            self._refresh()
+            return [dict(s) for s in self._sites]
+
+    def get(self, domain):
+        with self._lock:
+            self._refresh()
+            site = self._by_domain.get(domain)
+            return dict(site) if site else None
+
+    def by_owner(self, username):
+        with self._lock:
+            self._refresh()
+            return [dict(s) for s in self._by_owner.get(username, [])]
+
+    def by_service(self, service_name):
+        with self._lock:
+            self._refresh()
+            site = self._by_service.get(service_name)
+            return dict(site) if site else None
+
+    def save(self, sites):
+        self.store.save(sites)
+
+    def add(self, site):
+        """Adiciona um site novo; falha com StoreConflictError se o domínio já existir."""
+        def append_site(sites):
+            if any(s.get('domain') == site.get('domain') for s in sites):
+                raise StoreConflictError(f"O domínio '{site.get('domain')}' foi registrado por outra operação.")
+            sites.append(dict(site))
+        self.store.update(append_site)
+
+    def add_many(self, new_sites):
+        """Adiciona vários sites numa única gravação. Retorna os domínios ignorados por já existirem."""
+        def append_sites(sites):
+            existing = {s.get('domain') for s in sites}
+            skipped = []
+            for site in new_sites:
+                if site.get('domain') in existing:
+                    skipped.append(site.get('domain'))
+                    continue
+                existing.add(site.get('domain'))
+                sites.append(dict(site))
+            return skipped
+        return self.store.update(append_sites)
+
+    def update_site(self, domain, changes):
+        """Aplica 'changes' ao registro atual do domínio. Retorna False se ele não existe mais."""
+        def apply_changes(sites):
+            for s in sites:
+                if s.get('domain') == domain:
+                    s.update(changes)
+                    return True
+            return False
+        return self.store.update(apply_changes)
+
+    def remove(self, domain):
+        """Remove o site pelo domínio e grava. Retorna True se ele existia."""
+        def remove_site(sites):
+            before = len(sites)
+            sites[:] = [s for s in sites if s.get('domain') != domain]
+            return len(sites) != before
+        return self.store.update(remove_site)
+
+# --- Backends de Armazenamento (Sites, Usuários, Estatísticas) ---
+
+class StorageBackend(ABC):
+    """
+    Interface comum de persistência, selecionada por STORAGE_BACKEND ('json' ou 'sqlite').
+    Um backend que não implemente todas as operações falha já ao ser instanciado (TypeError).
+
+    As rotas usam as operações granulares (get_site, add_site, update_site...) para que o
+    custo por requisição não cresça com o número de sites; list/replace existem para as
+    telas que precisam de tudo e para load_*/save_*.
+    """
+
+    load_error = None
+
+    # Sites
+    @abstractmethod
+    def list_sites(self): ...
+    @abstractmethod
+    def get_site(self, domain): ...
+    @abstractmethod
+    def sites_by_owner(self, username): ...
+    @abstractmethod
+    def site_by_service(self, service_name): ...
+    @abstractmethod
+    def add_site(self, site): ...
+    @abstractmethod
+    def add_sites(self, sites): ... # Uma gravação; retorna os domínios que já existiam
+    @abstractmethod
+    def update_site(self, domain, changes): ...
+    @abstractmethod
+    def remove_site(self, domain): ...
+    @abstractmethod
+    def replace_sites(self, sites): ...
+
+    # Usuários
+    @abstractmethod
+    def list_users(self): ...
+    @abstractmethod
+    def get_user(self, username): ...
+    @abstractmethod
+    def add_user(self, user): ...
+    @abstractmethod
+    def remove_user(self, username): ...
+    @abstractmethod
+    def replace_users(self, users): ...
+
+    # Estatísticas do sistema
+    @abstractmethod
+    def load_system_logs(self): ...
+    @abstractmethod
+    def save_system_logs(self, logs): ...
+    @abstractmethod
+    def append_system_stat(self, entry, tiers): ...
+
+    # Recursos por site (histórico por service_name)
+    @abstractmethod
+    def load_site_stats(self, service_name): ...
+    @abstractmethod
+    def append_site_stats(self, entries, tier): ... # entries: {service_name: entrada}
+    @abstractmethod
+    def remove_site_stats(self, service_name): ...
+
+    # Tarefas em background do file manager (mantém as FILE_JOBS_HISTORY mais recentes)
+    @abstractmethod
+    def list_jobs(self): ...
+    @abstractmethod
+    def save_job(self, job): ... # Insere ou substitui pelo 'id'
+
+    # Provisionamentos de sites (mantém os PROVISIONING_HISTORY mais recentes)
+    @abstractmethod
+    def list_provisions(self): ...
+    @abstractmethod
+    def save_provision(self, record): ... # Insere ou substitui pelo 'id'
+    @abstractmethod
+    def save_provisions(self, records): ... # Vários numa única gravação
+
+
+class JsonStorageBackend(StorageBackend):
+    """Backend padrão: sites_data.json, users.json, file_jobs.json, provisioning.json e histórico em arquivos circulares (stats_data/)."""
+
+    def __init__(self, sites_file, users_file, stats_dir, legacy_stats_file=None, jobs_file=FILE_JOBS_DATA_FILE,
+                 provisions_file=PROVISIONING_DATA_FILE):
+        self.sites = SiteRegistry(JsonFileStore(sites_file))
+        self.users_store = JsonFileStore(users_file)
+        self.jobs_store = JsonFileStore(jobs_file)
+        self.provisions_store = JsonFileStore(provisions_file)
+        self.stats = SystemStatsStore(stats_dir, legacy_file=legacy_stats_file)
+        self.site_stats_dir = os.path.join(stats_dir, 'sites')
+        self.site_stats = OrderedDict() # service_name -> SystemStatsStore (aberto sob demanda, LRU)
+        self._site_stats_lock = threading.Lock() # Também envolve as leituras/gravações: um store pode ser fechado pela LRU
+
+    @property
+    def load_error(self):
+        return self.sites.load_error
+
+    def list_sites(self):
+        return self.sites.all()
+
+    def get_site(self, domain):
+        return self.sites.get(domain)
+
+    def sites_by_owner(self, username):
+        return self.sites.by_owner(username)
+
+    def site_by_service(self, service_name):
+        return self.sites.by_service(service_name)
+
+    def add_site(self, site):
+        self.sites.add(site)
+
+    def add_sites(self, sites):
+        return self.sites.add_many(sites)
+
+    def update_site(self, domain, changes):
+        return self.sites.update_site(domain, changes)
+
+    def remove_site(self, domain):
+        return self.sites.remove(domain)
+
+    def replace_sites(self, sites):
+        self.sites.save(sites)
+
+    def list_users(self):
+        users, _ = self.users_store.snapshot()
+        return [dict(u) for u in users]
+
+    def get_user(self, username):
+        users, _ = self.users_store.snapshot()
+        user = next((u for u in users if u['username'] == username), None)
+        return dict(user) if user else None
+
+    def add_user(self, user):
+        def append_user(users):
+            # Revalida dentro do lock: outra requisição pode ter criado o mesmo usuário
+            if any(u['username'] == user['username'] for u in users):
+                raise StoreConflictError(f"O nome de usuário '{user['username']}' foi registrado por outra operação.")
+            users.append(dict(user))
+            ensure_admin_user(users)
+        self.users_store.update(append_user)
+
+    def remove_user(self, username):
+        def remove(users):
+            before = len(users)
+            users[:] = [u for u in users if u['username'] != username]
+            ensure_admin_user(users)
+            return len(users) != before
+        return self.users_store.update(remove)
+
+    def replace_users(self, users):
+        self.users_store.save(users)
+
+    def load_system_logs(self):
+        return self.stats.load()
+
+    def save_system_logs(self, logs):
+        self.stats.replace(logs)
+
+    def append_system_stat(self, entry, tiers):
+        self.stats.append(entry, tiers)
+
+    def _site_store_locked(self, service_name):
+        """
+        Store do serviço (chamar com _site_stats_lock). No máximo SITE_STATS_OPEN_STORES ficam
+        abertos: cada um segura um fd por nível, e com centenas de sites isso chegaria ao
+        limite de arquivos abertos do processo. O menos usado é fechado e reaberto quando preciso.
+        """
+        store = self.site_stats.get(service_name)
+        if store is None:
+            store = self.site_stats[service_name] = SystemStatsStore(
+                os.path.join(self.site_stats_dir, service_name),
+                metrics=SITE_STATS_FIELDS, rollup_tiers=SITE_STATS_TIERS)
+            while len(self.site_stats) > SITE_STATS_OPEN_STORES:
+                _, evicted = self.site_stats.popitem(last=False)
+                evicted.close()
+        else:
+            self.site_stats.move_to_end(service_name)
+        return store
+
+    def load_site_stats(self, service_name):
+        if not os.path.isdir(os.path.join(self.site_stats_dir, service_name)):
+            return {tier: [] for tier in LOG_RETENTION}
+        with self._site_stats_lock:
+            return self._site_store_locked(service_name).load()
+
+    def append_site_stats(self, entries, tier):
+        with self._site_stats_lock:
+            for service_name, entry in entries.items():
+                self._site_store_locked(service_name).append(entry, [tier])
+
+    def remove_site_stats(self, service_name):
+        with self._site_stats_lock:
+            store = self.site_stats.pop(service_name, None)
+            if store is not None:
+                store.close()
+            shutil.rmtree(os.path.join(self.site_stats_dir, service_name), ignore_errors=True)
+
+    def list_jobs(self):
+        jobs, _ = self.jobs_store.snapshot()
+        return [dict(job) for job in jobs]
+
+    def save_job(self, job):
+        def upsert(jobs):
+            jobs[:] = [j for j in jobs if j.get('id') != job['id']]
+            jobs.append(dict(job))
+            del jobs[:-FILE_JOBS_HISTORY]
+        self.jobs_store.update(upsert)
+
+    def list_provisions(self):
+        records, _ = self.provisions_store.snapshot()
+        return [copy.deepcopy(record) for record in records]
+
+    def save_provision(self, record):
+        self.save_provisions([record])
+
+    def save_provisions(self, new_records):
+        ids = {record['id'] for record in new_records}
+        def upsert(records):
+            records[:] = [r for r in records if r.get('id') not in ids]
+            records.extend(copy.deepcopy(record) for record in new_records)
+            del records[:-PROVISIONING_HISTORY]
+        self.provisions_store.update(upsert)
+
+
+class SqliteStorageBackend(StorageBackend):
+    """
+    Backend SQLite (modo WAL) com índices por domínio, dono, serviço e timestamp.
+
+    Cada registro guarda o dicionário completo em JSON ('data') e as colunas indexadas
+    ao lado, então campos novos nos sites não exigem migração de esquema. Na primeira
+    execução os arquivos JSON existentes são importados (e mantidos como backup).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS sites (
+            domain TEXT PRIMARY KEY,
+            owner TEXT,
+            service_name TEXT,
+            position INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sites_owner ON sites(owner);
+        CREATE INDEX IF NOT EXISTS idx_sites_service ON sites(service_name);
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS system_stats (
+            tier TEXT NOT NULL,
+            ts REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_system_stats_tier_ts ON system_stats(tier, ts);
+        CREATE TABLE IF NOT EXISTS site_stats (
+            service_name TEXT NOT NULL,
+            tier TEXT NOT NULL,
+            ts REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_site_stats_service ON site_stats(service_name, tier, ts);
+        CREATE INDEX IF NOT EXISTS idx_site_stats_tier_ts ON site_stats(tier, ts);
+        CREATE TABLE IF NOT EXISTS file_jobs (
+            id TEXT PRIMARY KEY,
+            created REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_file_jobs_created ON file_jobs(created);
+        CREATE TABLE IF NOT EXISTS provisions (
+            id TEXT PRIMARY KEY,
+            domain TEXT NOT NULL,
+            created REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_provisions_created ON provisions(created);
+    """
+
+    def __init__(self, db_file, sites_file=None, users_file=None, stats_file=None):
+        self.db_file = db_file
+        self._local = threading.local() # Uma conexão por thread
+        self._conn().executescript(self.SCHEMA)
+        self._migrate_from_json(sites_file, users_file, stats_file)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None) # Transações explícitas
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _run_write(self, work):
+        """Executa work(conn) numa transação de escrita (BEGIN IMMEDIATE)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _migrate_from_json(self, sites_file, users_file, stats_file):
+        """Importa os arquivos JSON uma única vez (marcado na tabela meta)."""
+        if self._conn().execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+
+        def read_json(path, default):
+            if not path or not os.path.exists(path):
+                return default
+            try:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            except json.JSONDecodeError as e:
+                print(f"Aviso: '{path}' inválido, ignorado na migração para SQLite: {e}")
+                return default
+
+        sites = read_json(sites_file, [])
+        users = read_json(users_file, [])
+        stats = read_json(stats_file, {})
+
+        def migrate(conn):
+            self._insert_sites(conn, sites)
+            self._insert_users(conn, users)
+            for tier in LOG_RETENTION:
+                for entry in stats.get(tier, []):
+                    self._insert_stat(conn, tier, entry)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)",
+                         (datetime.now(timezone.utc).isoformat(),))
+
+        self._run_write(migrate)
+        print(f"Migração para SQLite concluída: {len(sites)} site(s), {len(users)} usuário(s).")
+
+    def _rows_to_dicts(self, rows):
+        return [json.loads(row[0]) for row in rows]
+
+    # --- Sites ---
+
+    def _insert_sites(self, conn, sites):
+        conn.executemany(
+            "INSERT OR REPLACE INTO sites (domain, owner, service_name, position, data) VALUES (?, ?, ?, ?, ?)",
+            [(s.get('domain'), s.get('created_by_user'), s.get('service_name'), i,
+              json.dumps(s, separators=(',', ':'))) for i, s in enumerate(sites)]
+        )
+
+    def list_sites(self):
+        return self._rows_to_dicts(self._conn().execute("SELECT data FROM sites ORDER BY position"))
+
+    def get_site(self, domain):
+        row = self._conn().execute("SELECT data FROM sites WHERE domain = ?", (domain,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def sites_by_owner(self, username):
+        return self._rows_to_dicts(self._conn().execute(
+            "SELECT data FROM sites WHERE owner = ? ORDER BY position", (username,)))
+
+    def site_by_service(self, service_name):
+        row = self._conn().execute("SELECT data FROM sites WHERE service_name = ?", (service_name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_site(self, site):
+        def insert(conn):
+            next_position = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM sites").fetchone()[0]
+            try:
+                conn.execute(
+                    "INSERT INTO sites (domain, owner, service_name, position, data) VALUES (?, ?, ?, ?, ?)",
+                    (site.get('domain'), site.get('created_by_user'), site.get('service_name'), next_position,
+                     json.dumps(site, separators=(',', ':'))))
+            except sqlite3.IntegrityError:
+                raise StoreConflictError(f"O domínio '{site.get('domain')}' foi registrado por outra operação.")
+        self._run_write(insert)
+
+    def add_sites(self, sites):
+        def insert(conn):
+            next_position = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM sites").fetchone()[0]
+            skipped = []
+            for site in sites:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO sites (domain, owner, service_name, position, data) VALUES (?, ?, ?, ?, ?)",
+                    (site.get('domain'), site.get('created_by_user'), site.get('service_name'), next_position,
+                     json.dumps(site, separators=(',', ':'))))
+                if cursor.rowcount:
+                    next_position += 1
+                else:
+                    skipped.append(site.get('domain'))
+            return skipped
+        return self._run_write(insert)
+
+    def update_site(self, domain, changes):
+        def apply_changes(conn):
+            row = conn.execute("SELECT data FROM sites WHERE domain = ?", (domain,)).fetchone()
+            if not row:
+                return False
+            site = json.loads(row[0])
+            site.update(changes)
+            conn.execute("UPDATE sites SET owner = ?, service_name = ?, data = ? WHERE domain = ?",
+                         (site.get('created_by_user'), site.get('service_name'),
+                          json.dumps(site, separators=(',', ':')), domain))
+            return True
+        return self._run_write(apply_changes)
+
+    def remove_site(self, domain):
+        return self._run_write(lambda conn: conn.execute("DELETE FROM sites WHERE domain = ?", (domain,)).rowcount > 0)
+
+    def replace_sites(self, sites):
+        def replace(conn):
+            conn.execute("DELETE FROM sites")
+            self._insert_sites(conn, sites)
+        self._run_write(replace)
+
+    # --- Usuários ---
+
+    def _insert_users(self, conn, users):
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (username, position, data) VALUES (?, ?, ?)",
+            [(u['username'], i, json.dumps(u, separators=(',', ':'))) for i, u in enumerate(users)]
+        )
+
+    def list_users(self):
+        return self._rows_to_dicts(self._conn().execute("SELECT data FROM users ORDER BY position"))
+
+    def get_user(self, username):
+        row = self._conn().execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_user(self, user):
+        def insert(conn):
+            next_position = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM users").fetchone()[0]
+            try:
+                conn.execute("INSERT INTO users (username, position, data) VALUES (?, ?, ?)",
+                             (user['username'], next_position, json.dumps(user, separators=(',', ':'))))
+            except sqlite3.IntegrityError:
+                raise StoreConflictError(f"O nome de usuário '{user['username']}' foi registrado por outra operação.")
+        self._run_write(insert)
+
+    def remove_user(self, username):
+        if username == 'cico':
+            return False # O administrador nunca é removido
+        return self._run_write(lambda conn: conn.execute("DELETE FROM users WHERE username = ?", (username,)).rowcount > 0)
+
+    def replace_users(self, users):
+        def replace(conn):
+            conn.execute("DELETE FROM users")
+            self._insert_users(conn, users)
+        self._run_write(replace)
+
+    # --- Estatísticas ---
+
+    def _insert_stat(self, conn, tier, entry):
+        conn.execute("INSERT INTO system_stats (tier, ts, data) VALUES (?, ?, ?)",
+                     (tier, parse_log_timestamp(entry['timestamp']).timestamp(),
+                      json.dumps(entry, separators=(',', ':'))))
+
+    def load_system_logs(self):
+        conn = self._conn()
+        return {
+            tier: self._rows_to_dicts(conn.execute(
+                "SELECT data FROM system_stats WHERE tier = ? ORDER BY ts", (tier,)))
+            for tier in LOG_RETENTION
+        }
+
+    def save_system_logs(self, logs):
+        def replace(conn):
+            conn.execute("DELETE FROM system_stats")
+            for tier in LOG_RETENTION:
+                for entry in logs.get(tier, []):
+                    self._insert_stat(conn, tier, entry)
+        self._run_write(replace)
+
+    def append_system_stat(self, entry, tiers):
+        now = datetime.now(timezone.utc)
+        def append(conn):
+            for tier in tiers:
+                self._insert_stat(conn, tier, entry)
+                cutoff = (now - LOG_RETENTION[tier]).timestamp()
+                conn.execute("DELETE FROM system_stats WHERE tier = ? AND ts < ?", (tier, cutoff))
+        self._run_write(append)
+
+    def load_site_stats(self, service_name):
+        conn = self._conn()
+        return {
+            tier: self._rows_to_dicts(conn.execute(
+                "SELECT data FROM site_stats WHERE service_name = ? AND tier = ? ORDER BY ts", (service_name, tier)))
+            for tier in LOG_RETENTION
+        }
+
+    def append_site_stats(self, entries, tier):
+        cutoff = (datetime.now(timezone.utc) - LOG_RETENTION[tier]).timestamp()
+        def append(conn):
+            # Todos os sites numa única transação (os baldes fecham juntos)
+            conn.executemany(
+                "INSERT INTO site_stats (service_name, tier, ts, data) VALUES (?, ?, ?, ?)",
+                [(service_name, tier, parse_log_timestamp(entry['timestamp']).timestamp(),
+                  json.dumps(entry, separators=(',', ':'))) for service_name, entry in entries.items()])
+            conn.execute("DELETE FROM site_stats WHERE tier = ? AND ts < ?", (tier, cutoff))
+        self._run_write(append)
+
+    def remove_site_stats(self, service_name):
+        self._run_write(lambda conn: conn.execute("DELETE FROM site_stats WHERE service_name = ?", (service_name,)))
+
+    def list_jobs(self):
+        return self._rows_to_dicts(self._conn().execute("SELECT data FROM file_jobs ORDER BY created"))
+
+    def save_job(self, job):
+        def save(conn):
+            conn.execute("INSERT OR REPLACE INTO file_jobs (id, created, data) VALUES (?, ?, ?)",
+                         (job['id'], job['created'], json.dumps(job, separators=(',', ':'))))
+            conn.execute("DELETE FROM file_jobs WHERE id NOT IN (SELECT id FROM file_jobs ORDER BY created DESC LIMIT ?)",
+                         (FILE_JOBS_HISTORY,))
+        self._run_write(save)
+
+    def list_provisions(self):
+        return self._rows_to_dicts(self._conn().execute("SELECT data FROM provisions ORDER BY created"))
+
+    def save_provision(self, record):
+        self.save_provisions([record])
+
+    def save_provisions(self, records):
+        def save(conn):
+            conn.executemany("INSERT OR REPLACE INTO provisions (id, domain, created, data) VALUES (?, ?, ?, ?)",
+                             [(record['id'], record['domain'], record['created'], json.dumps(record, separators=(',', ':')))
+                              for record in records])
+            conn.execute("DELETE FROM provisions WHERE id NOT IN (SELECT id FROM provisions ORDER BY created DESC LIMIT ?)",
+                         (PROVISIONING_HISTORY,))
+        self._run_write(save)
+
+
+def create_storage_backend():
+    """Instancia o backend configurado em STORAGE_BACKEND."""
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStorageBackend(SQLITE_DB_FILE, SITES_DATA_FILE, USERS_DATA_FILE, SYSTEM_LOG_FILE)
+    if STORAGE_BACKEND != 'json':
+        print(f"Aviso: STORAGE_BACKEND '{STORAGE_BACKEND}' desconhecido. Usando 'json'.")
+    return JsonStorageBackend(SITES_DATA_FILE, USERS_DATA_FILE, STATS_DATA_DIR, legacy_stats_file=SYSTEM_LOG_FILE)
+
+storage = create_storage_backend()
 
 def load_sites():
-    """Carrega os dados dos sites do arquivo JSON."""
-    if not os.path.exists(SITES_DATA_FILE):
-        return []
-    try:
-        with open(SITES_DATA_FILE, 'r') as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        flash("Erro ao ler o arquivo de dados dos sites (JSON inválido).", 'error')
-        return [] # Retorna lista vazia em caso de erro de leitura
-    except Exception as e:
-         flash(f"Erro inesperado ao carregar sites: {e}", 'error')
-         return []
+    """Retorna a lista de sites do backend de armazenamento."""
+    sites = storage.list_sites()
+    if storage.load_error:
+        flash(f"Erro ao ler o arquivo de dados dos sites: {storage.load_error}", 'error')
+    return sites
 
 
 def save_sites(sites):
-    """Salva os dados dos sites no arquivo JSON."""
+    """Substitui a lista completa de sites no backend de armazenamento."""
     try:
-        with open(SITES_DATA_FILE, 'w') as f:
-            json.dump(sites, f, indent=4)
+        storage.replace_sites(sites)
     except Exception as e:
-        flash(f"Erro crítico: Não foi possível salvar os dados dos sites em {SITES_DATA_FILE}: {e}", 'error')
+        flash(f"Erro crítico: Não foi possível salvar os dados dos sites: {e}", 'error')
 
 
 def generate_nginx_config(template_name, domain, **kwargs):
@@ -362,10 +2243,10 @@ def generate_nginx_config(template_name, domain, **kwargs):
             f.write(config)
         return config_path
     except FileNotFoundError:
-        flash(f"Erro: Template Nginx '{template_name}' não encontrado.", 'error')
+        notify(f"Erro: Template Nginx '{template_name}' não encontrado.", 'error')
         return None
     except Exception as e:
-        flash(f"Erro ao gerar configuração Nginx para {domain}: {e}", 'error')
+        notify(f"Erro ao gerar configuração Nginx para {domain}: {e}", 'error')
         return None
 
 def enable_nginx_site(domain):
@@ -380,20 +2261,9 @@ def enable_nginx_site(domain):
         result = run_command(['sudo', 'ln', '-s', config_path, link_path])
         return result is not None and result.returncode == 0
     else:
-        flash(f"Arquivo de configuração não encontrado para habilitar: {config_path}", 'error')
+        notify(f"Arquivo de configuração não encontrado para habilitar: {config_path}", 'error')
         return False
 
-def reload_nginx():
-    """Recarrega a configuração do Nginx."""
-    # ATENÇÃO: PERMISSÕES!
-    result = run_command(['sudo', 'systemctl', 'reload', 'nginx'])
-    if result and result.returncode == 0:
-         flash("Nginx recarregado com sucesso.", 'success')
-         return True
-    else:
-         flash("Falha ao recarregar Nginx.", 'error')
-         return False
-
 def disable_nginx_site(domain):
     """Remove o link simbólico para desabilitar o site no Nginx."""
     link_path = os.path.join(NGINX_SITES_ENABLED, domain)
@@ -410,16 +2280,482 @@ def remove_nginx_config(domain):
         return result is not None and result.returncode == 0
     return True # Não existe, considera sucesso
 
+# --- Cliente systemd (D-Bus, com fallback para systemctl) ---
+# As operações com unidades (daemon-reload, enable, start, stop, consultas de estado...)
+# passam por 'systemd'. Com o jeepney instalado elas viram chamadas RPC numa conexão
+# persistente com o barramento do sistema, sem um 'sudo systemctl' (fork + PAM) por
+# operação, e várias unidades saem numa única consulta (ListUnitsByNames). Alterar unidades
+# pelo D-Bus exige root ou uma regra do polkit liberando o usuário do painel, por exemplo
+# em /etc/polkit-1/rules.d/50-cicopanel.rules:
+#     polkit.addRule(function(action, subject) {
+#         if (action.id.indexOf("org.freedesktop.systemd1.") == 0 && subject.user == "painel")
+#             return polkit.Result.YES;
+#     });
+# Sem o jeepney, sem barramento ou sem permissão, a operação usa o caminho antigo
+# ('sudo systemctl' pelo command_executor).
+
+try:
+    from jeepney import DBusAddress, Message, new_method_call, unwrap_msg, DBusErrorResponse # pip install jeepney
+    from jeepney.io.blocking import open_dbus_connection
+except ImportError:
+    open_dbus_connection = None
+
+SYSTEMD_TRANSIENT_STATES = ('activating', 'deactivating', 'reloading')
+SYSTEMD_DBUS_DENIED_ERRORS = ('org.freedesktop.DBus.Error.AccessDenied', 'org.freedesktop.DBus.Error.InteractiveAuthorizationRequired')
+
+
+class SystemdError(Exception):
+    pass
+
+
+class SystemdUnavailable(SystemdError):
+    """O caminho D-Bus não pode atender (sem conexão ou, com denied, sem permissão): usar o systemctl."""
+
+    def __init__(self, message, denied=False):
+        super().__init__(message)
+        self.denied = denied
+
+
+class SystemctlBackend:
+    """Caminho antigo: um 'sudo systemctl' por operação (com várias unidades por comando)."""
+
+    name = 'systemctl'
+
+    def _run(self, args, check=True):
+        result = run_command(['sudo', 'systemctl', *args], check=False)
+        if check and (result is None or result.returncode != 0):
+            raise SystemdError((result.stderr.strip() if result else '') or f"systemctl {args[0]} falhou.")
+        return result
+
+    def daemon_reload(self):
+        self._run(['daemon-reload'])
+
+    def enable(self, units):
+        self._run(['enable', *units])
+
+    def disable(self, units):
+        self._run(['disable', *units])
+
+    def reload(self, units):
+        return self._change('reload', units, ('active',))
+
+    def reset_failed(self, units=None):
+        self._run(['reset-failed', *(units or [])])
+
+    def _change(self, verb, units, expected):
+        result = self._run([verb, *units], check=False) # Espera os jobs; a falha de uma unidade não impede as outras
+        if result is not None and result.returncode == 0:
+            return dict.fromkeys(units)
+        details = (result.stderr.strip() if result else '') or f"systemctl {verb} falhou."
+        if len(units) == 1:
+            return {units[0]: details}
+        try:
+            states = self.status(units) # Descobre quais unidades do comando falharam
+        except SystemdError:
+            states = {}
+        return {unit: None if states.get(unit, {}).get('active_state') in expected else
+                f"{details} (estado: {states.get(unit, {}).get('active_state', 'desconhecido')})" for unit in units}
+
+    def start(self, units):
+        return self._change('start', units, ('active', 'reloading'))
+
+    def stop(self, units):
+        return self._change('stop', units, ('inactive', 'failed'))
+
+    def restart(self, units):
+        return self._change('restart', units, ('active', 'reloading'))
+
+    def _show(self, units, properties):
+        # Consultas não precisam de sudo nem passam pelo log do run_command (o coletor chama a cada amostra)
+        result = command_executor.run(['systemctl', 'show', f"--property=Id,{','.join(properties)}", *units], timeout=SYSTEMD_DBUS_TIMEOUT)
+        if not result.ok:
+            raise SystemdError(result.error or result.stderr.strip() or "systemctl show falhou.")
+        blocks = [dict(line.split('=', 1) for line in block.splitlines() if '=' in line) for block in result.stdout.split('\n\n')]
+        return [block for block in blocks if block.get('Id')]
+
+    def status(self, units):
+        if not units:
+            return {}
+        blocks = self._show(units, ['LoadState', 'ActiveState', 'SubState'])
+        # O Id de um alias é o nome principal; a saída vem na ordem pedida
+        return {unit: {'load_state': block.get('LoadState'), 'active_state': block.get('ActiveState'), 'sub_state': block.get('SubState')}
+                for unit, block in zip(units, blocks)}
+
+    def main_pids(self, units):
+        if not units:
+            return {}
+        return {unit: int(block['MainPID']) for unit, block in zip(units, self._show(units, ['MainPID']))
+                if block.get('MainPID', '0') not in ('0', '')}
+
+
+class DBusSystemdBackend:
+    """Chamadas ao org.freedesktop.systemd1 numa conexão persistente (reaberta se cair)."""
+
+    name = 'dbus'
+
+    def __init__(self, timeout, job_timeout):
+        self.timeout = timeout
+        self.job_timeout = job_timeout
+        self._conn = None
+        self._lock = threading.Lock() # A conexão bloqueante não é thread-safe
+        self.manager = DBusAddress('/org/freedesktop/systemd1', bus_name='org.freedesktop.systemd1',
+                                   interface='org.freedesktop.systemd1.Manager')
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+
+    def _call(self, address, method, signature=None, body=()):
+        message = new_method_call(address, method, signature, body)
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = open_dbus_connection(bus='SYSTEM')
+                    reply = self._conn.send_and_get_reply(message, timeout=self.timeout)
+                    return unwrap_msg(reply) if isinstance(reply, Message) else reply
+                except DBusErrorResponse as e:
+                    if e.name in SYSTEMD_DBUS_DENIED_ERRORS:
+                        raise SystemdUnavailable(f"sem permissão para {method} ({e.name})", denied=True)
+                    raise SystemdError(e.data[0] if e.data else e.name)
+                except TimeoutError:
+                    self._close() # Respostas atrasadas não podem ser lidas como a da próxima chamada
+                    raise SystemdError(f"tempo esgotado em {method}")
+                except (OSError, ValueError) as e: # Conexão caiu (ex: dbus reiniciado): reabre uma vez
+                    self._close()
+                    if attempt:
+                        raise SystemdUnavailable(f"barramento do sistema indisponível: {e}")
+
+    def daemon_reload(self):
+        self._call(self.manager, 'Reload')
+
+    def enable(self, units):
+        # Ao contrário do 'systemctl enable', não recarrega o manager: quem cria unidades já chama daemon_reload()
+        self._call(self.manager, 'EnableUnitFiles', 'asbb', (list(units), False, False))
+
+    def disable(self, units):
+        self._call(self.manager, 'DisableUnitFiles', 'asb', (list(units), False))
+
+    def reset_failed(self, units=None):
+        if not units:
+            self._call(self.manager, 'ResetFailed')
+            return
+        for unit in units:
+            self._call(self.manager, 'ResetFailedUnit', 's', (unit,))
+
+    def _change(self, method, units, expected):
+        """Enfileira os jobs de todas as unidades e espera (até job_timeout) eles terminarem."""
+        errors = {}
+        for unit in units:
+            try:
+                self._call(self.manager, method, 'ss', (unit, 'replace'))
+            except SystemdUnavailable:
+                raise
+            except SystemdError as e:
+                errors[unit] = str(e)
+        waiting = [unit for unit in units if unit not in errors]
+        deadline = time.monotonic() + self.job_timeout
+        states = self._list_units(waiting)
+        while any(state['job_id'] or state['active_state'] in SYSTEMD_TRANSIENT_STATES for state in states.values()) and \
+                time.monotonic() < deadline:
+            time.sleep(0.1)
+            states = self._list_units(waiting)
+        for unit in waiting:
+            active_state = states.get(unit, {}).get('active_state', 'desconhecido')
+            errors[unit] = None if active_state in expected else f"{method} terminou com a unidade em '{active_state}'."
+        return {unit: errors[unit] for unit in units}
+
+    def start(self, units):
+        return self._change('StartUnit', units, ('active', 'reloading'))
+
+    def stop(self, units):
+        return self._change('StopUnit', units, ('inactive', 'failed'))
+
+    def restart(self, units):
+        return self._change('RestartUnit', units, ('active', 'reloading'))
+
+    def reload(self, units):
+        return self._change('ReloadUnit', units, ('active',))
+
+    def _list_units(self, units):
+        if not units:
+            return {}
+        # a(ssssssouso): nome, descrição, load, active, sub, seguido, caminho, id do job, tipo do job, caminho do job
+        (rows,) = self._call(self.manager, 'ListUnitsByNames', 'as', (list(units),))
+        return {row[0]: {'load_state': row[2], 'active_state': row[3], 'sub_state': row[4], 'path': row[6], 'job_id': row[7]}
+                for row in rows}
+
+    def status(self, units):
+        return {unit: {key: state[key] for key in ('load_state', 'active_state', 'sub_state')}
+                for unit, state in self._list_units(units).items()}
+
+    def main_pids(self, units):
+        pids = {}
+        for unit, state in self._list_units(units).items():
+            if state['load_state'] != 'loaded':
+                continue
+            service = DBusAddress(state['path'], bus_name='org.freedesktop.systemd1', interface='org.freedesktop.DBus.Properties')
+            ((_, pid),) = self._call(service, 'Get', 'ss', ('org.freedesktop.systemd1.Service', 'MainPID'))
+            if pid:
+                pids[unit] = pid
+        return pids
+
+
+class SystemdClient:
+    """
+    Fachada usada pelo painel: tenta o D-Bus e cai para o systemctl quando ele não pode atender.
+    Operações negadas pelo polkit ficam no systemctl; sem barramento, o D-Bus é tentado de novo
+    após SYSTEMD_DBUS_RETRY segundos. start/stop/restart retornam {unidade: erro ou None}.
+    """
+
+    def __init__(self, use_dbus):
+        self.systemctl = SystemctlBackend()
+        self.dbus = None
+        if use_dbus and open_dbus_connection is not None and platform.system() == 'Linux':
+            self.dbus = DBusSystemdBackend(SYSTEMD_DBUS_TIMEOUT, SYSTEMD_JOB_TIMEOUT)
+        self._denied = set() # Operações que o polkit não libera para este usuário
+        self._retry_at = 0
+
+    def _call(self, operation, *args):
+        if self.dbus is not None and operation not in self._denied and time.monotonic() >= self._retry_at:
+            try:
+                return getattr(self.dbus, operation)(*args)
+            except SystemdUnavailable as e:
+                print(f"Aviso: systemd via D-Bus indisponível para '{operation}' ({e}). Usando systemctl.")
+                if e.denied:
+                    self._denied.add(operation)
+                else:
+                    self._retry_at = time.monotonic() + SYSTEMD_DBUS_RETRY
+        return getattr(self.systemctl, operation)(*args)
+
+    @property
+    def backend(self):
+        """'dbus' ou 'systemctl': o caminho das consultas de estado no momento."""
+        if self.dbus is not None and 'status' not in self._denied and time.monotonic() >= self._retry_at:
+            return self.dbus.name
+        return self.systemctl.name
+
+    def daemon_reload(self):
+        return self._call('daemon_reload')
+
+    def enable(self, units):
+        return self._call('enable', list(units))
+
+    def disable(self, units):
+        return self._call('disable', list(units))
+
+    def reset_failed(self, units=None):
+        return self._call('reset_failed', list(units) if units else None)
+
+    def start(self, units):
+        return self._call('start', list(units))
+
+    def stop(self, units):
+        return self._call('stop', list(units))
+
+    def restart(self, units):
+        return self._call('restart', list(units))
+
+    def reload(self, units):
+        return self._call('reload', list(units))
+
+    def status(self, units):
+        """{unidade: {'load_state', 'active_state', 'sub_state'}} de várias unidades numa consulta."""
+        return self._call('status', list(units))
+
+    def main_pids(self, units):
+        return self._call('main_pids', list(units))
+
+
+systemd = SystemdClient(SYSTEMD_DBUS_ENABLED)
+
+def systemd_try(operation, *args):
+    """Chama systemd.<operation> registrando (sem propagar) a falha, como o check=False dos comandos."""
+    try:
+        getattr(systemd, operation)(*args)
+        return True
+    except SystemdError as e:
+        print(f"Aviso: systemd {operation} falhou: {e}")
+        return False
+
+
+# --- Recarga do Nginx (agrupada) ---
+# reload_nginx() não recarrega na hora: o pedido entra numa fila e a thread do agendador
+# espera NGINX_RELOAD_DEBOUNCE segundos sem pedidos novos (no máximo NGINX_RELOAD_MAX_DELAY
+# desde o primeiro) para atender todos com uma única recarga. Antes, 'nginx -t' valida a
+# configuração uma vez. Se o erro aponta para um site do lote, esse site é desfeito (rollback
+# do pedido ou remoção do link em sites-enabled), quem pediu recebe o erro e o teste é refeito
+# com os demais. Cada pedido recebe o resultado por um Future.
+
+class NginxReloadOutcome:
+    """Resultado de um pedido de recarga."""
+
+    def __init__(self, ok, message, output='', rolled_back=False, batch_size=0):
+        self.ok = ok
+        self.message = message
+        self.output = output # Saída do nginx -t quando a configuração foi rejeitada
+        self.rolled_back = rolled_back # A alteração deste pedido foi desfeita
+        self.batch_size = batch_size # Pedidos atendidos pela mesma recarga
+
+    def to_dict(self):
+        return {"ok": self.ok, "message": self.message, "output": self.output,
+                "rolled_back": self.rolled_back, "batch_size": self.batch_size}
+
+
+class NginxReloadRequest:
+    __slots__ = ('domain', 'rollback', 'future')
+
+    def __init__(self, domain, rollback):
+        self.domain = domain
+        self.rollback = rollback
+        self.future = Future()
+
+
+class NginxReloadScheduler:
+    """Agrupa pedidos de recarga do Nginx, valida com nginx -t e recarrega uma vez por lote."""
+
+    def __init__(self, debounce, max_delay):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._pending = []
+        self._first_at = self._last_at = None
+        self._thread = None
+        self.requests = 0
+        self.reloads = 0
+
+    def request(self, domain=None, rollback=None):
+        """
+        Agenda uma recarga e retorna o Future com o NginxReloadOutcome. 'domain' é o site
+        alterado; rollback() desfaz a alteração se o nginx -t a rejeitar (padrão: desabilitar o site).
+        """
+        reload_request = NginxReloadRequest(domain, rollback)
+        with self._cond:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_at = now
+            self._last_at = now
+            self._pending.append(reload_request)
+            self.requests += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return reload_request.future
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                remaining = min(self._last_at + self.debounce, self._first_at + self.max_delay) - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._pending = self._pending, []
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self._process(batch)
+            except Exception as e:
+                print(f"Erro inesperado ao recarregar o Nginx: {e}")
+                outcome = NginxReloadOutcome(False, f"Erro inesperado ao recarregar o Nginx: {e}", batch_size=len(batch))
+                for reload_request in batch:
+                    if not reload_request.future.done():
+                        reload_request.future.set_result(outcome)
+
+    def _offenders(self, output, active):
+        """Pedidos do lote cujo arquivo de site aparece no erro do nginx -t."""
+        site_dirs = {os.path.normpath(NGINX_SITES_ENABLED), os.path.normpath(NGINX_SITES_AVAILABLE)}
+        names = {os.path.basename(path) for path in re.findall(r'(?: in |")(/[^\s":]+)', output)
+                 if os.path.dirname(os.path.normpath(path)) in site_dirs}
+        return [reload_request for reload_request in active if reload_request.domain in names]
+
+    def _rollback(self, reload_request):
+        try:
+            if reload_request.rollback:
+                return bool(reload_request.rollback())
+            return disable_nginx_site(reload_request.domain)
+        except Exception as e:
+            print(f"Erro ao desfazer a configuração Nginx de '{reload_request.domain}': {e}")
+            return False
+
+    def _process(self, batch):
+        active = list(batch)
+        while True:
+            result = run_command(['sudo', 'nginx', '-t'], check=False)
+            if result is not None and result.returncode == 0:
+                break
+            output = f"{result.stderr}{result.stdout}".strip() if result else "nginx -t não pôde ser executado."
+            offenders = self._offenders(output, active)
+            if not offenders:
+                # Erro fora dos sites do lote (ou sem arquivo identificável): nada é recarregado
+                outcome = NginxReloadOutcome(False, f"Configuração do Nginx inválida (nginx -t), recarga cancelada: {output}",
+                                             output, batch_size=len(batch))
+                for reload_request in active:
+                    reload_request.future.set_result(outcome)
+                return
+            for reload_request in offenders:
+                rolled_back = self._rollback(reload_request)
+                action = "desfeita" if rolled_back else "NÃO pôde ser desfeita (verifique manualmente)"
+                print(f"Nginx: configuração de '{reload_request.domain}' rejeitada pelo nginx -t e {action}.")
+                reload_request.future.set_result(NginxReloadOutcome(
+                    False, f"A configuração Nginx de '{reload_request.domain}' foi rejeitada pelo nginx -t e {action}: {output}",
+                    output, rolled_back, len(batch)))
+                active.remove(reload_request)
+            if not active:
+                return # Tudo foi desfeito: a configuração em uso continua a mesma
+
+        try:
+            details = systemd.reload(['nginx.service'])['nginx.service']
+        except SystemdError as e:
+            details = str(e) or 'N/A'
+        self.reloads += 1
+        if details is None:
+            outcome = NginxReloadOutcome(True, "Nginx recarregado com sucesso.", batch_size=len(batch))
+        else:
+            outcome = NginxReloadOutcome(False, f"Falha ao recarregar Nginx. Detalhes: {details}", batch_size=len(batch))
+        print(f"Nginx: {len(active)} pedido(s) de recarga atendido(s) por uma recarga ({'ok' if outcome.ok else 'falhou'}).")
+        for reload_request in active:
+            reload_request.future.set_result(outcome)
+
+
+nginx_reloader = NginxReloadScheduler(NGINX_RELOAD_DEBOUNCE, NGINX_RELOAD_MAX_DELAY)
+
+def reload_nginx(domain=None, rollback=None, wait=True):
+    """
+    Pede uma recarga do Nginx (agrupada com os pedidos próximos e validada com nginx -t).
+    'domain' identifica o site alterado, desfeito se o nginx -t rejeitar a configuração dele.
+    Retorna True/False; com wait=False retorna o Future com o NginxReloadOutcome.
+    """
+    future = nginx_reloader.request(domain, rollback)
+    if not wait:
+        return future
+    try:
+        outcome = future.result(timeout=NGINX_RELOAD_WAIT_TIMEOUT)
+    except FutureTimeoutError:
+        outcome = NginxReloadOutcome(False, "Tempo esgotado aguardando a recarga do Nginx.")
+    notify(outcome.message, 'success' if outcome.ok else 'error')
+    return outcome.ok
+
 def stop_disable_remove_systemd(service_name):
     """Para, desabilita e remove um serviço systemd (APENAS LINUX)."""
     if platform.system() == 'Windows':
-        flash("Gerenciamento de serviços Systemd não é suportado no Windows.", "warning")
+        notify("Gerenciamento de serviços Systemd não é suportado no Windows.", "warning")
         print(f"Skipping systemd removal for {service_name} on Windows.")
         return True # Retorna True para não impedir a remoção do site no JSON
 
     # Verifica se o diretório SYSTEMD_SERVICE_DIR existe (indicativo de systemd)
     if not os.path.isdir(SYSTEMD_SERVICE_DIR):
-         flash(f"Diretório de serviços systemd ({SYSTEMD_SERVICE_DIR}) não encontrado. Pulando gerenciamento de serviço.", 'warning')
+         notify(f"Diretório de serviços systemd ({SYSTEMD_SERVICE_DIR}) não encontrado. Pulando gerenciamento de serviço.", 'warning')
          return True
 
     service_file_path = os.path.join(SYSTEMD_SERVICE_DIR, service_name)
@@ -428,22 +2764,20 @@ def stop_disable_remove_systemd(service_name):
         return True # Se não existe, considera sucesso na remoção
 
     print(f"Parando serviço: {service_name}")
-    run_command(['sudo', 'systemctl', 'stop', service_name], check=False) # Não falha se já estiver parado
+    systemd_try('stop', [service_name]) # Não falha se já estiver parado
     print(f"Desabilitando serviço: {service_name}")
-    run_command(['sudo', 'systemctl', 'disable', service_name], check=False) # Não falha se já estiver desabilitado
+    systemd_try('disable', [service_name]) # Não falha se já estiver desabilitado
     service_path = os.path.join(SYSTEMD_SERVICE_DIR, service_name)
     print(f"Removendo arquivo do serviço: {service_path}")
     result = run_command(['sudo', 'rm', service_path])
+    # Recarrega após remover (mesmo se falhou) e limpa o estado de falha, se houver
+    systemd_try('daemon_reload')
+    systemd_try('reset_failed', [service_name])
     if result and result.returncode == 0:
         print(f"Serviço {service_name} removido com sucesso.")
-        run_command(['sudo', 'systemctl', 'daemon-reload']) # Recarrega após remover
-        run_command(['sudo', 'systemctl', 'reset-failed']) # Limpa estado de falha se houver
         return True
     else:
-        flash(f"Falha ao remover o arquivo do serviço systemd: {service_name}", 'error')
-        # Tenta recarregar daemon mesmo assim
-        run_command(['sudo', 'systemctl', 'daemon-reload'], check=False)
-        run_command(['sudo', 'systemctl', 'reset-failed'], check=False)
+        notify(f"Falha ao remover o arquivo do serviço systemd: {service_name}", 'error')
         return False
 
 def disable_nginx_site(domain):
@@ -465,13 +2799,13 @@ def remove_nginx_config(domain):
 def stop_disable_remove_systemd(service_name):
     """Para, desabilita e remove um serviço systemd (APENAS LINUX)."""
     if platform.system() == 'Windows':
-        flash("Gerenciamento de serviços Systemd não é suportado no Windows.", "warning")
+        notify("Gerenciamento de serviços Systemd não é suportado no Windows.", "warning")
         print(f"Skipping systemd removal for {service_name} on Windows.")
         return True # Retorna True para não impedir a remoção do site no JSON
 
     # Verifica se o diretório SYSTEMD_SERVICE_DIR existe (indicativo de systemd)
     if not os.path.isdir(SYSTEMD_SERVICE_DIR):
-         flash(f"Diretório de serviços systemd ({SYSTEMD_SERVICE_DIR}) não encontrado. Pulando gerenciamento de serviço.", 'warning')
+         notify(f"Diretório de serviços systemd ({SYSTEMD_SERVICE_DIR}) não encontrado. Pulando gerenciamento de serviço.", 'warning')
          return True
 
     service_file_path = os.path.join(SYSTEMD_SERVICE_DIR, service_name)
@@ -480,27 +2814,28 @@ def stop_disable_remove_systemd(service_name):
         return True # Se não existe, considera sucesso na remoção
 
     print(f"Parando serviço: {service_name}")
-    run_command(['sudo', 'systemctl', 'stop', service_name], check=False) # Não falha se já estiver parado
+    systemd_try('stop', [service_name]) # Não falha se já estiver parado
     print(f"Desabilitando serviço: {service_name}")
-    run_command(['sudo', 'systemctl', 'disable', service_name], check=False) # Não falha se já estiver desabilitado
+    systemd_try('disable', [service_name]) # Não falha se já estiver desabilitado
     service_path = os.path.join(SYSTEMD_SERVICE_DIR, service_name)
     print(f"Removendo arquivo do serviço: {service_path}")
     result = run_command(['sudo', 'rm', service_path])
+    # Recarrega após remover (mesmo se falhou) e limpa o estado de falha, se houver
+    systemd_try('daemon_reload')
+    systemd_try('reset_failed', [service_name])
     if result and result.returncode == 0:
         print(f"Serviço {service_name} removido com sucesso.")
-        run_command(['sudo', 'systemctl', 'daemon-reload']) # Recarrega após remover
-        run_command(['sudo', 'systemctl', 'reset-failed']) # Limpa estado de falha se houver
         return True
     else:
-        flash(f"Falha ao remover o arquivo do serviço systemd: {service_name}", 'error')
-        # Tenta recarregar daemon mesmo assim
-        run_command(['sudo', 'systemctl', 'daemon-reload'], check=False)
-        run_command(['sudo', 'systemctl', 'reset-failed'], check=False)
+        notify(f"Falha ao remover o arquivo do serviço systemd: {service_name}", 'error')
         return False
 
 
-def create_systemd_service(domain, command, port, workdir=None):
-    """Cria e habilita um serviço systemd para a aplicação."""
+def write_systemd_unit(domain, command, port, workdir=None):
+    """
+    Grava o arquivo .service do site em SYSTEMD_SERVICE_DIR, sem daemon-reload nem start
+    (ver create_systemd_service e a ativação em lote do provisionamento). Retorna o nome do serviço ou None.
+    """
     service_name = f"site-{domain.replace('.', '-')}.service"
     service_path = os.path.join(SYSTEMD_SERVICE_DIR, service_name)
 
@@ -519,10 +2854,10 @@ def create_systemd_service(domain, command, port, workdir=None):
                  # Isso pode falhar dependendo de como o script é executado (ex: sudo direto)
                  user_info = pwd.getpwuid(os.geteuid())
                  workdir = user_info.pw_dir
-                 flash(f"Diretório de trabalho não especificado, usando home do usuário atual: {workdir}. Considere especificar.", "warning")
+                 notify(f"Diretório de trabalho não especificado, usando home do usuário atual: {workdir}. Considere especificar.", "warning")
              except KeyError:
                  workdir = "/tmp" # Fallback muito básico
-                 flash("Não foi possível determinar o diretório home do usuário. Usando /tmp como WorkDir. Especifique um diretório!", "error")
+                 notify("Não foi possível determinar o diretório home do usuário. Usando /tmp como WorkDir. Especifique um diretório!", "error")
 
     # Substitui {{PORTA}} no comando, se existir
     final_command = command.replace('{{PORTA}}', str(port))
@@ -551,55 +2886,982 @@ WantedBy=multi-user.target
         # ATENÇÃO: PERMISSÕES!
         with open(f'/tmp/{service_name}', 'w') as f: # Escreve primeiro em /tmp
              f.write(service_content)
-        run_command(['sudo', 'mv', f'/tmp/{service_name}', service_path])
+        if not run_command(['sudo', 'mv', f'/tmp/{service_name}', service_path]):
+            return None
         run_command(['sudo', 'chmod', '644', service_path]) # Permissões padrão
+        return service_name
+    except Exception as e:
+        notify(f"Erro ao gravar o serviço systemd '{service_name}': {e}", 'error')
+        return None
 
+def create_systemd_service(domain, command, port, workdir=None):
+    """Cria e habilita um serviço systemd para a aplicação."""
+    service_name = write_systemd_unit(domain, command, port, workdir)
+    if not service_name:
+        return None
+    try:
         # Recarrega o daemon, habilita e inicia o serviço
-        run_command(['sudo', 'systemctl', 'daemon-reload'])
-        run_command(['sudo', 'systemctl', 'enable', service_name])
-        result = run_command(['sudo', 'systemctl', 'start', service_name])
+        for operation, args in (('daemon_reload', ()), ('enable', ([service_name],))):
+            try:
+                getattr(systemd, operation)(*args)
+            except SystemdError as e:
+                notify(f"Erro no systemd ({operation}) para '{service_name}': {e}", 'error')
+        error = systemd.start([service_name])[service_name]
 
-        if result and result.returncode == 0:
-            flash(f"Serviço systemd '{service_name}' criado e iniciado.", 'success')
+        if error is None:
+            notify(f"Serviço systemd '{service_name}' criado e iniciado.", 'success')
             return service_name
         else:
-            flash(f"Falha ao iniciar o serviço systemd '{service_name}'. Verifique os logs com 'journalctl -u {service_name}'", 'error')
+            notify(f"Falha ao iniciar o serviço systemd '{service_name}' ({error}). Verifique os logs com 'journalctl -u {service_name}'", 'error')
             return None
 
     except Exception as e:
-        flash(f"Erro ao criar/gerenciar serviço systemd '{service_name}': {e}", 'error')
+        notify(f"Erro ao criar/gerenciar serviço systemd '{service_name}': {e}", 'error')
         return None
 
+# --- Resolução do IP Público ---
+# O IP é resolvido uma vez na inicialização e depois periodicamente em background.
+# As páginas apenas leem o cache, nunca esperam por HTTP externo.
+
+public_ip_cache = {'ip': None, 'source': None, 'resolved_at': 0.0}
+public_ip_lock = threading.Lock()
+public_ip_refresh_event = threading.Event() # Acorda a thread para uma resolução antecipada
+public_ip_thread = None
+
+def get_local_ip_fallback():
+    """Retorna um IPv4 das interfaces locais (psutil), preferindo endereços públicos."""
+    candidates = []
+    try:
+        for iface_name, addrs in psutil.net_if_addrs().items():
+            for addr in addrs:
+                if addr.family != socket.AF_INET:
+                    continue
+                try:
+                    ip_obj = ipaddress.ip_address(addr.address)
+                except ValueError:
+                    continue
+                if ip_obj.is_loopback or ip_obj.is_link_local:
+                    continue
+                candidates.append(ip_obj)
+    except Exception as e:
+        print(f"Erro ao listar interfaces locais para fallback de IP: {e}")
+        return None
+
+    if not candidates:
+        return None
+    # Um IP global em alguma interface é quase certamente o IP público (VPS sem NAT)
+    global_ips = [ip for ip in candidates if ip.is_global]
+    return str(global_ips[0] if global_ips else candidates[0])
+
+def resolve_public_ip():
+    """Consulta os serviços externos (com timeout) e atualiza o cache. Retorna o IP ou None."""
+    for service_url in PUBLIC_IP_SERVICES:
+        try:
+            response = requests.get(service_url, timeout=PUBLIC_IP_TIMEOUT)
+            response.raise_for_status()
+            ip = str(ipaddress.ip_address(response.text.strip()))
+        except Exception as e:
+            print(f"Falha ao obter IP público via {service_url}: {e}")
+            continue
+        with public_ip_lock:
+            public_ip_cache['ip'] = ip
+            public_ip_cache['source'] = service_url
+            public_ip_cache['resolved_at'] = time.time()
+        return ip
+    return None
+
+def run_public_ip_resolver():
+    """Mantém o cache do IP público atualizado em background."""
+    print("Iniciando resolvedor de IP público...")
+    while True:
+        ip = resolve_public_ip()
+        # Em caso de falha tenta de novo mais cedo, mantendo o último valor conhecido
+        wait_time = PUBLIC_IP_TTL if ip else PUBLIC_IP_RETRY_INTERVAL
+        public_ip_refresh_event.wait(wait_time)
+        public_ip_refresh_event.clear()
+
+def start_public_ip_resolver():
+    """Inicia a thread do resolvedor (uma única vez). Não faz nada se o IP estiver fixado."""
+    global public_ip_thread
+    if PUBLIC_IP_OVERRIDE:
+        return
+    with public_ip_lock:
+        if public_ip_thread is not None and public_ip_thread.is_alive():
+            return
+        public_ip_thread = threading.Thread(target=run_public_ip_resolver, daemon=True)
+        public_ip_thread.start()
+
 def get_public_ip():
-    ip = requests.get('https://api.ipify.org').text
-    return ip
+    """Retorna o IP público sem bloquear: valor fixo, cache, ou IP das interfaces locais."""
+    if PUBLIC_IP_OVERRIDE:
+        return PUBLIC_IP_OVERRIDE
+
+    start_public_ip_resolver() # Garante a thread mesmo quando o app roda via WSGI
+    with public_ip_lock:
+        ip = public_ip_cache['ip']
+        resolved_at = public_ip_cache['resolved_at']
+
+    if ip:
+        if time.time() - resolved_at > PUBLIC_IP_TTL:
+            public_ip_refresh_event.set() # Cache velho: pede atualização, mas responde com o último valor
+        return ip
+
+    return get_local_ip_fallback() or 'Indisponível'
 
 def get_ssl_cert(domain, email):
     """Solicita um certificado SSL usando Certbot."""
     if not email:
-        flash("Email do administrador é necessário para obter certificado SSL.", "error")
+        notify("Email do administrador é necessário para obter certificado SSL.", "error")
+        return False
+
+    # ATENÇÃO: PERMISSÕES! Precisa rodar certbot com privilégios.
+    # --nginx: Usa o plugin nginx para configurar automaticamente
+    # --non-interactive: Não pede confirmação
+    # --agree-tos: Aceita os termos de serviço
+    # -m: Email para notificações (expiração, etc.)
+    # -d: Domínio(s) para o certificado
+    # --redirect: (Opcional) Força HTTPS redirecionando HTTP
+    command = [
+        'sudo', 'certbot', '--nginx', '--non-interactive', '--agree-tos',
+        '-m', email, '-d', domain, '--redirect'
+    ]
+    result = run_command(command)
+    if result and result.returncode == 0:
+        notify(f"Certificado SSL obtido e configurado para {domain}.", 'success')
+        return True
+    else:
+        notify(f"Falha ao obter certificado SSL para {domain}. Verifique a saída do Certbot.", 'error')
+        # Tenta recarregar o nginx mesmo assim, caso o certbot tenha modificado algo mas falhado
+        reload_nginx()
         return False
 
-    # ATENÇÃO: PERMISSÕES! Precisa rodar certbot com privilégios.
-    # --nginx: Usa o plugin nginx para configurar automaticamente
-    # --non-interactive: Não pede confirmação
-    # --agree-tos: Aceita os termos de serviço
-    # -m: Email para notificações (expiração, etc.)
-    # -d: Domínio(s) para o certificado
-    # --redirect: (Opcional) Força HTTPS redirecionando HTTP
-    command = [
-        'sudo', 'certbot', '--nginx', '--non-interactive', '--agree-tos',
-        '-m', email, '-d', domain, '--redirect'
-    ]
-    result = run_command(command)
-    if result and result.returncode == 0:
-        flash(f"Certificado SSL obtido e configurado para {domain}.", 'success')
-        return True
-    else:
-        flash(f"Falha ao obter certificado SSL para {domain}. Verifique a saída do Certbot.", 'error')
-        # Tenta recarregar o nginx mesmo assim, caso o certbot tenha modificado algo mas falhado
-        reload_nginx()
-        return False
+
+# --- Provisionamento de Sites (em background) ---
+# Criar um site passa por várias etapas lentas (systemctl, nginx -t, certbot...). A rota
+# /add_site só valida o formulário e enfileira; as etapas rodam aqui, em background, e cada
+# uma grava status, horários, duração e as mensagens das funções auxiliares no registro do
+# provisionamento (storage.save_provision), consultado pelo painel via /api/provisioning.
+# Todas as etapas podem ser repetidas: numa nova tentativa (ou após reiniciar o painel)
+# o pipeline continua da primeira etapa que não terminou. Se uma etapa obrigatória falha,
+# o que as anteriores deixaram no servidor (config do Nginx, link em sites-enabled, serviço
+# systemd) é desfeito, pois o domínio não chegou ao registro e delete_site não o alcançaria;
+# o diretório do site é mantido. "Abandonar" repete essa limpeza e encerra o provisionamento.
+
+PROVISION_STEPS = [
+    ('directory', "Criar diretório"),
+    ('nginx_config', "Gerar configuração do Nginx"),
+    ('service', "Criar serviço systemd"),
+    ('nginx_enable', "Habilitar site no Nginx"),
+    ('nginx_reload', "Recarregar Nginx"),
+    ('register', "Registrar site"),
+    ('ssl', "Obter certificado SSL"),
+    ('permissions', "Definir permissões"),
+    ('home_symlink', "Criar link na home"),
+]
+PROVISION_OPTIONAL_STEPS = {'ssl', 'permissions', 'home_symlink'} # Falhas viram aviso; o site já funciona
+PROVISION_ACTIVE_STATES = ('queued', 'running', 'abandoning')
+
+
+def validate_site_fields(fields):
+    """
+    Valida os campos de um site (formulário de /add_site ou linha de um manifesto) e monta a
+    especificação usada pelo provisionamento. Retorna (spec, None) ou (None, mensagem de erro).
+    Não verifica se o domínio está livre (ver domain_unavailable).
+    """
+    def text(key):
+        value = fields.get(key)
+        return '' if value is None else str(value).strip()
+
+    domain = text('domain').lower()
+    site_type = text('site_type') or text('type')
+    admin_email = text('admin_email')
+    if not domain:
+        return None, "O domínio é obrigatório."
+    # O email é sempre requerido pelo formulário HTML; aqui só a verificação de campo vazio
+    if not admin_email:
+        return None, "O campo Email é obrigatório."
+    spec = {"domain": domain, "type": site_type, "admin_email": admin_email,
+            "get_ssl": text('get_ssl').lower() in ('true', '1', 'yes', 'sim', 'on')}
+
+    if site_type == 'php':
+        path = text('path')
+        if not path:
+            return None, "O caminho para os arquivos PHP é obrigatório."
+        if '..' in path or not path.startswith('/'): # Medida de segurança básica
+            return None, "Caminho inválido."
+        spec['path'] = path
+    elif site_type == 'python_node':
+        try:
+            port = int(text('port'))
+        except ValueError:
+            return None, "A porta deve ser um número válido."
+        command = text('command')
+        workdir = text('workdir')
+        if not command:
+            return None, "O comando de inicialização é obrigatório."
+        # O campo workdir é 'required' no formulário HTML para python_node
+        if not workdir:
+            return None, "O diretório de trabalho é obrigatório para sites App."
+        if '..' in workdir or not workdir.startswith('/'):
+            return None, "Diretório de trabalho inválido."
+        spec.update(port=port, command=command, workdir=workdir)
+    else:
+        return None, "Tipo de site inválido."
+    return spec, None
+
+def domain_unavailable(domain):
+    """Mensagem de erro se o domínio já está registrado ou sendo provisionado; senão None."""
+    if storage.get_site(domain):
+        return f"O domínio '{domain}' já existe."
+    if provisioning.active_for(domain):
+        return f"O domínio '{domain}' já está sendo provisionado."
+    return None
+
+def ports_in_use():
+    """{porta: domínio} dos sites registrados e dos que estão sendo provisionados."""
+    ports = {}
+    records = [record.get('spec') or {} for record in provisioning.list(active_only=True)]
+    for site in storage.list_sites() + records:
+        try:
+            ports.setdefault(int(site['port']), site.get('domain'))
+        except (KeyError, TypeError, ValueError):
+            continue # Site PHP (sem porta) ou porta inválida gravada à mão
+    return ports
+
+def parse_site_manifest(text, kind=None):
+    """
+    Lê um manifesto de sites: JSON (lista ou {"sites": [...]}) ou CSV com cabeçalho
+    (domain,site_type,path,port,command,workdir,get_ssl,admin_email,owner). 'kind' é
+    'json' ou 'csv' (None: deduz pelo conteúdo). ValueError se não puder ser lido.
+    """
+    text = text.lstrip('\ufeff')
+    if kind is None:
+        kind = 'json' if text.lstrip()[:1] in ('[', '{') else 'csv'
+    if kind == 'json':
+        rows = json.loads(text)
+        if isinstance(rows, dict):
+            rows = rows.get('sites')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("o JSON deve ser uma lista de sites ou {\"sites\": [...]}.")
+        return rows
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or 'domain' not in [name.strip() for name in reader.fieldnames]:
+        raise ValueError("o CSV precisa de uma linha de cabeçalho com a coluna 'domain'.")
+    return [{key.strip(): value for key, value in row.items() if key} for row in reader]
+
+def validate_site_manifest(rows, default_owner):
+    """
+    Valida todas as linhas de um manifesto antes de provisionar qualquer site. Retorna
+    (especificações, erros); cada erro é {"row": n, "domain": ..., "error": ...} (n a partir de 1).
+    """
+    if not rows:
+        return [], [{"row": 0, "domain": None, "error": "O manifesto não tem sites."}]
+    if len(rows) > PROVISIONING_BULK_MAX_SITES:
+        return [], [{"row": 0, "domain": None,
+                     "error": f"O manifesto tem {len(rows)} sites; o máximo por lote é {PROVISIONING_BULK_MAX_SITES}."}]
+    specs, errors = [], []
+    seen_domains, seen_ports = {}, {}
+    used_ports = ports_in_use()
+    for number, row in enumerate(rows, start=1):
+        spec, error = validate_site_fields(row)
+        domain = spec['domain'] if spec else (str(row.get('domain') or '').strip().lower() or None)
+        if error is None and domain in seen_domains:
+            error = f"Domínio repetido no manifesto (linha {seen_domains[domain]})."
+        if error is None and spec.get('port') in seen_ports:
+            error = f"Porta {spec['port']} repetida no manifesto (linha {seen_ports[spec['port']]})."
+        if error is None and spec.get('port') in used_ports:
+            error = f"Porta {spec['port']} já usada pelo site '{used_ports[spec['port']]}'."
+        if error is None:
+            error = domain_unavailable(domain)
+        if error is None:
+            owner = str(row.get('owner') or '').strip() or default_owner
+            if owner != 'cico' and storage.get_user(owner) is None:
+                error = f"Usuário '{owner}' não encontrado."
+            spec['owner'] = owner
+        if error is not None:
+            errors.append({"row": number, "domain": domain, "error": error})
+            continue
+        seen_domains[domain] = number
+        if spec.get('port') is not None:
+            seen_ports[spec['port']] = number
+        specs.append(spec)
+    return specs, errors
+
+
+class ProvisionStepSkipped(Exception):
+    """A etapa não se aplica a este site (ex: serviço systemd de um site PHP)."""
+
+
+class ProvisionError(Exception):
+    pass
+
+
+class ProvisionConflictError(Exception):
+    pass
+
+
+class SiteProvisioning:
+    """Estado de um provisionamento: a especificação do site e o andamento de cada etapa."""
+
+    def __init__(self, username, spec, record=None):
+        record = record or {}
+        self.id = record.get('id') or os.urandom(8).hex()
+        self.username = username
+        self.spec = dict(spec) # Campos do formulário: domain, type, path/port/command/workdir, get_ssl, admin_email
+        self.domain = self.spec['domain']
+        self.site = dict(record.get('site') or {}) # Dados gravados no registro de sites (preenchidos pelas etapas)
+        self.status = record.get('status', 'queued')
+        self.message = record.get('message')
+        self.attempts = record.get('attempts', 1)
+        self.batch_id = record.get('batch_id') # Lote de /api/provisioning/bulk (None: site avulso)
+        self.cleanup_incomplete = record.get('cleanup_incomplete', False) # Alguma etapa não pôde ser desfeita
+        self.created = record.get('created', time.time())
+        self.started = record.get('started')
+        self.finished = record.get('finished')
+        saved_steps = {step['name']: step for step in record.get('steps', [])}
+        self.steps = [dict(saved_steps.get(name) or {
+            'name': name, 'label': label, 'status': 'pending',
+            'started': None, 'finished': None, 'duration': None, 'messages': [],
+        }) for name, label in PROVISION_STEPS]
+        self.version = 0 # Incrementado a cada mudança (acorda quem acompanha /events)
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(record.get('username'), record.get('spec') or {'domain': record.get('domain')}, record)
+
+    @property
+    def target_directory(self):
+        return self.spec.get('path') if self.spec.get('type') == 'php' else self.spec.get('workdir')
+
+    def step(self, name):
+        return next(step for step in self.steps if step['name'] == name)
+
+    def warnings(self):
+        return [step['name'] for step in self.steps if step['status'] == 'failed' and step['name'] in PROVISION_OPTIONAL_STEPS]
+
+    def to_dict(self):
+        return {
+            "id": self.id, "domain": self.domain, "username": self.username, "spec": self.spec,
+            "site": self.site, "status": self.status, "message": self.message, "attempts": self.attempts,
+            "batch_id": self.batch_id, "cleanup_incomplete": self.cleanup_incomplete,
+            "steps": [dict(step, messages=list(step['messages'])) for step in self.steps],
+            "warnings": self.warnings(),
+            "created": self.created, "started": self.started, "finished": self.finished,
+            "duration": (self.finished or time.time()) - self.started if self.started else None,
+        }
+
+
+def provision_step_directory(provision):
+    directory = provision.target_directory
+    if not directory:
+        raise ProvisionError("Diretório do site não informado.")
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        raise ProvisionError(f"Erro ao criar diretório '{directory}': {e}. Verifique as permissões do diretório pai.")
+    notify(f"Diretório '{directory}' criado (ou já existia).", 'info')
+
+def provision_step_nginx_config(provision):
+    spec = provision.spec
+    if spec['type'] == 'php':
+        config_path = generate_nginx_config('php_site.conf', provision.domain, root_path=spec['path'])
+    else:
+        config_path = generate_nginx_config('proxy_site.conf', provision.domain, port=spec['port'])
+    if not config_path:
+        raise ProvisionError(f"Falha ao gerar a configuração do Nginx para {provision.domain}.")
+
+def provision_step_service(provision):
+    spec = provision.spec
+    if spec['type'] != 'python_node':
+        raise ProvisionStepSkipped()
+    service_name = create_systemd_service(provision.domain, spec['command'], spec['port'], spec.get('workdir'))
+    if not service_name:
+        raise ProvisionError(f"Falha ao criar o serviço systemd de {provision.domain}.")
+    provision.site['service_name'] = service_name
+
+def provision_step_service_unit(provision):
+    """Etapa 'service' num lote: só grava a unidade (daemon-reload/enable/start são um só para o lote)."""
+    spec = provision.spec
+    if spec['type'] != 'python_node':
+        raise ProvisionStepSkipped()
+    service_name = write_systemd_unit(provision.domain, spec['command'], spec['port'], spec.get('workdir'))
+    if not service_name:
+        raise ProvisionError(f"Falha ao gravar o serviço systemd de {provision.domain}.")
+    provision.site['service_name'] = service_name
+
+def provision_step_nginx_enable(provision):
+    if not enable_nginx_site(provision.domain):
+        raise ProvisionError(f"Falha ao habilitar o site {provision.domain} no Nginx.")
+
+def provision_step_nginx_reload(provision):
+    # Se o nginx -t rejeitar a config deste site, o agendador remove o link de sites-enabled;
+    # por isso a etapa garante o link de novo (uma nova tentativa recomeça daqui)
+    if not enable_nginx_site(provision.domain):
+        raise ProvisionError(f"Falha ao habilitar o site {provision.domain} no Nginx.")
+    if not reload_nginx(provision.domain):
+        raise ProvisionError("O Nginx não aceitou a configuração do site. Corrija e tente novamente.")
+
+def provision_step_register(provision):
+    site = storage.get_site(provision.domain)
+    if site is not None:
+        if site.get('provision_id') != provision.id:
+            raise ProvisionError(f"O domínio '{provision.domain}' foi registrado por outra operação.")
+        storage.update_site(provision.domain, provision.site) # Nova tentativa: só atualiza
+        return
+    try:
+        storage.add_site(provision.site)
+    except StoreConflictError as e:
+        raise ProvisionError(str(e))
+
+def provision_step_ssl(provision):
+    if not provision.spec.get('get_ssl'):
+        raise ProvisionStepSkipped()
+    ssl_success = get_ssl_cert(provision.domain, provision.spec.get('admin_email'))
+    provision.site['ssl_enabled'] = ssl_success
+    storage.update_site(provision.domain, {'ssl_enabled': ssl_success})
+    if not ssl_success:
+        raise ProvisionError(f"O site {provision.domain} foi criado, mas houve falha ao obter o certificado SSL. O site pode estar acessível via HTTP.")
+
+def provision_step_permissions(provision):
+    if platform.system() != 'Linux':
+        raise ProvisionStepSkipped()
+    if not set_directory_permissions(provision.target_directory, provision.username):
+        raise ProvisionError("Não foi possível definir as permissões do diretório.")
+
+def provision_step_home_symlink(provision):
+    if platform.system() != 'Linux':
+        raise ProvisionStepSkipped()
+    if not create_home_symlink(provision.target_directory, provision.username, provision.domain):
+        raise ProvisionError("Não foi possível criar o link simbólico na home.")
+
+PROVISION_STEP_FUNCTIONS = {
+    'directory': provision_step_directory,
+    'nginx_config': provision_step_nginx_config,
+    'service': provision_step_service,
+    'nginx_enable': provision_step_nginx_enable,
+    'nginx_reload': provision_step_nginx_reload,
+    'register': provision_step_register,
+    'ssl': provision_step_ssl,
+    'permissions': provision_step_permissions,
+    'home_symlink': provision_step_home_symlink,
+}
+
+
+def undo_step_nginx_config(provision):
+    if not remove_nginx_config(provision.domain):
+        raise ProvisionError(f"Falha ao remover a configuração do Nginx de {provision.domain}.")
+
+def undo_step_service(provision):
+    if provision.spec.get('type') != 'python_node':
+        return
+    # A etapa pode ter falhado depois de gravar a unidade (ex: start), antes de guardar o nome
+    service_name = provision.site.get('service_name') or f"site-{provision.domain.replace('.', '-')}.service"
+    if not stop_disable_remove_systemd(service_name):
+        raise ProvisionError(f"Falha ao remover o serviço systemd '{service_name}'.")
+
+def undo_step_nginx_enable(provision):
+    if not disable_nginx_site(provision.domain):
+        raise ProvisionError(f"Falha ao desabilitar o site {provision.domain} no Nginx.")
+
+def undo_step_nginx_reload(provision):
+    # O Nginx já carregou o site: tira o link e recarrega para que ele deixe de responder
+    undo_step_nginx_enable(provision)
+    if not reload_nginx():
+        raise ProvisionError("O Nginx não recarregou após remover o site.")
+
+# Etapas que deixam algo no servidor. 'directory' fica de fora: os arquivos do site são mantidos.
+# 'register' também: é a última obrigatória, então um provisionamento que falhou não registrou nada.
+PROVISION_UNDO_FUNCTIONS = {
+    'nginx_config': undo_step_nginx_config,
+    'service': undo_step_service,
+    'nginx_enable': undo_step_nginx_enable,
+    'nginx_reload': undo_step_nginx_reload,
+}
+
+
+class ProvisioningManager:
+    """Executa os provisionamentos num pool de threads e guarda o andamento de cada um."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._cond = threading.Condition()
+        self._provisions = {} # id -> SiteProvisioning (ativos e os desta execução)
+
+    def start(self, resume=True):
+        """
+        Cria o pool e (com resume) retoma os provisionamentos que uma execução anterior deixou
+        pela metade. Sites de um lote interrompido são retomados um a um, pelo caminho avulso.
+        """
+        with self._cond:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='provision')
+            resumed = []
+            for record in (storage.list_provisions() if resume else []):
+                if record.get('status') in PROVISION_ACTIVE_STATES:
+                    provision = SiteProvisioning.from_dict(record)
+                    for step in provision.steps:
+                        if step['status'] == 'running': # Interrompida no meio: repete a etapa inteira
+                            step['status'] = 'pending'
+                    if provision.status != 'abandoning':
+                        provision.status = 'queued'
+                    provision.message = "Retomado após reinício do painel."
+                    self._provisions[provision.id] = provision
+                    resumed.append(provision)
+        for provision in resumed:
+            print(f"Retomando provisionamento de {provision.domain} ({provision.id}).")
+            if provision.status == 'abandoning':
+                self._persist(provision)
+                self._executor.submit(self._run_abandon, provision)
+            else:
+                self._enqueue(provision)
+
+    def _persist(self, provision, save=True):
+        """Registra uma mudança (acorda quem acompanha) e grava; em lotes save=False e _persist_batch grava tudo junto."""
+        with self._cond:
+            provision.version += 1
+            record = provision.to_dict()
+            self._cond.notify_all()
+        if not save:
+            return
+        try:
+            storage.save_provision(record)
+        except Exception as e:
+            print(f"Aviso: Falha ao gravar o provisionamento {provision.id}: {e}")
+
+    def _persist_batch(self, provisions):
+        with self._cond:
+            records = [provision.to_dict() for provision in provisions]
+            self._cond.notify_all()
+        try:
+            storage.save_provisions(records)
+        except Exception as e:
+            print(f"Aviso: Falha ao gravar os provisionamentos do lote: {e}")
+
+    def _enqueue(self, provision):
+        self._persist(provision)
+        self._executor.submit(self._run, provision)
+
+    def active_for(self, domain):
+        with self._cond:
+            return next((p for p in self._provisions.values()
+                         if p.domain == domain and p.status in PROVISION_ACTIVE_STATES), None)
+
+    def _new_provision(self, username, spec, batch_id=None):
+        provision = SiteProvisioning(username, spec, {'batch_id': batch_id})
+        provision.site = {
+            "domain": provision.domain, "type": spec['type'], "ssl_enabled": False,
+            "created_by_user": username, "admin_email": spec.get('admin_email'),
+            "provision_id": provision.id,
+        }
+        if spec['type'] == 'php':
+            provision.site['path'] = spec['path']
+        else:
+            provision.site.update(port=spec['port'], command=spec['command'], workdir=spec.get('workdir'))
+        return provision
+
+    def submit(self, username, spec):
+        """Enfileira o provisionamento de um site. ProvisionConflictError se o domínio já está em andamento."""
+        self.start()
+        provision = self._new_provision(username, spec)
+        with self._cond:
+            if any(p.domain == provision.domain and p.status in PROVISION_ACTIVE_STATES for p in self._provisions.values()):
+                raise ProvisionConflictError(f"O domínio '{provision.domain}' já está sendo provisionado.")
+            self._provisions[provision.id] = provision
+        self._enqueue(provision)
+        return provision
+
+    def _load_locked(self, provision_id):
+        provision = self._provisions.get(provision_id)
+        if provision is None:
+            record = next((r for r in storage.list_provisions() if r.get('id') == provision_id), None)
+            if record is not None:
+                provision = SiteProvisioning.from_dict(record)
+        return provision
+
+    def retry(self, provision_id):
+        """
+        Repete a partir da primeira etapa que não terminou (inclui as opcionais que falharam e as
+        que foram desfeitas após a falha).
+        """
+        self.start()
+        with self._cond:
+            provision = self._load_locked(provision_id)
+            if provision is None:
+                return None
+            if provision.status in PROVISION_ACTIVE_STATES:
+                raise ProvisionConflictError("O provisionamento ainda está em andamento.")
+            if provision.status == 'abandoned':
+                raise ProvisionConflictError("O provisionamento foi abandonado. Adicione o site novamente.")
+            if provision.status == 'done' and not provision.warnings():
+                raise ProvisionConflictError("O provisionamento já foi concluído sem falhas.")
+            if any(p.domain == provision.domain and p.status in PROVISION_ACTIVE_STATES for p in self._provisions.values()):
+                raise ProvisionConflictError(f"O domínio '{provision.domain}' já está sendo provisionado.")
+            for step in provision.steps:
+                if step['status'] == 'failed':
+                    step['status'] = 'pending'
+            provision.status = 'queued'
+            provision.message = None
+            provision.finished = None
+            provision.cleanup_incomplete = False
+            provision.attempts += 1
+            self._provisions[provision.id] = provision
+        self._enqueue(provision)
+        return provision
+
+    def abandon(self, provision_id):
+        """Desfaz (em background) o que um provisionamento que falhou deixou no servidor e o encerra."""
+        self.start()
+        with self._cond:
+            provision = self._load_locked(provision_id)
+            if provision is None:
+                return None
+            if provision.status != 'failed':
+                raise ProvisionConflictError("Só um provisionamento que falhou pode ser abandonado.")
+            if any(p.domain == provision.domain and p.status in PROVISION_ACTIVE_STATES for p in self._provisions.values()):
+                raise ProvisionConflictError(f"O domínio '{provision.domain}' já está sendo provisionado.")
+            provision.status = 'abandoning'
+            provision.message = "Desfazendo as etapas concluídas..."
+            self._provisions[provision.id] = provision
+        self._persist(provision)
+        self._executor.submit(self._run_abandon, provision)
+        return provision
+
+    def _run_abandon(self, provision):
+        try:
+            self._undo(provision)
+        except Exception as e:
+            print(f"Erro inesperado ao abandonar o provisionamento de {provision.domain}: {e}")
+            provision.cleanup_incomplete = True
+        provision.finished = time.time()
+        if provision.cleanup_incomplete:
+            provision.status = 'failed'
+            provision.message = "Não foi possível desfazer todas as etapas. Veja as mensagens e tente abandonar de novo."
+        else:
+            provision.status = 'abandoned'
+            provision.message = f"Provisionamento de {provision.domain} abandonado; o diretório do site foi mantido."
+        print(f"Provisionamento de {provision.domain}: {provision.message}")
+        self._persist(provision)
+
+    def _undo(self, provision, save=True):
+        """
+        Desfaz, da última para a primeira, as etapas que deixaram algo no servidor: as concluídas
+        (que passam a 'undone' e rodam de novo numa nova tentativa) e a que falhou no meio.
+        Atualiza cleanup_incomplete e retorna True se tudo foi desfeito.
+        """
+        complete = True
+        for step in reversed(provision.steps):
+            undo = PROVISION_UNDO_FUNCTIONS.get(step['name'])
+            if undo is None or step['status'] not in ('done', 'failed'):
+                continue
+
+            def collect(message, category, step=step):
+                if len(step['messages']) < PROVISIONING_MAX_MESSAGES:
+                    step['messages'].append({"category": category, "message": message})
+
+            message_sink.collect = collect
+            try:
+                undo(provision)
+                if step['status'] == 'done':
+                    step['status'] = 'undone'
+                    step['messages'].append({"category": "info", "message": "Etapa desfeita após a falha do provisionamento."})
+            except Exception as e:
+                complete = False
+                step['messages'].append({"category": "error", "message": f"Falha ao desfazer a etapa: {e}"})
+            finally:
+                message_sink.collect = None
+            self._persist(provision, save)
+        provision.cleanup_incomplete = not complete
+        return complete
+
+    def _run_step(self, provision, step, work=None, save=True):
+        """Executa uma etapa (work substitui a função padrão). Retorna False se o provisionamento deve parar."""
+        def collect(message, category):
+            if len(step['messages']) < PROVISIONING_MAX_MESSAGES:
+                step['messages'].append({"category": category, "message": message})
+            self._persist(provision, save)
+
+        step.update(status='running', started=time.time(), finished=None, duration=None, messages=[])
+        self._persist(provision, save)
+        message_sink.collect = collect
+        try:
+            (work or PROVISION_STEP_FUNCTIONS[step['name']])(provision)
+            step['status'] = 'done'
+        except ProvisionStepSkipped:
+            step['status'] = 'skipped'
+        except Exception as e:
+            step['status'] = 'failed'
+            category = 'warning' if step['name'] in PROVISION_OPTIONAL_STEPS else 'error'
+            step['messages'].append({"category": category, "message": str(e)})
+            if not isinstance(e, ProvisionError):
+                print(f"Erro inesperado na etapa '{step['name']}' do provisionamento de {provision.domain}: {e}")
+        finally:
+            message_sink.collect = None
+            step['finished'] = time.time()
+            step['duration'] = step['finished'] - step['started']
+        self._persist(provision, save)
+        return step['status'] != 'failed' or step['name'] in PROVISION_OPTIONAL_STEPS
+
+    def _run(self, provision):
+        provision.status = 'running'
+        provision.started = provision.started or time.time()
+        self._persist(provision)
+        for step in provision.steps:
+            if step['status'] in ('done', 'skipped'):
+                continue
+            if not self._run_step(provision, step):
+                break
+        self._finish(provision)
+
+    def _failed_step(self, provision):
+        return next((step for step in provision.steps
+                     if step['status'] == 'failed' and step['name'] not in PROVISION_OPTIONAL_STEPS), None)
+
+    def _finish(self, provision, save=True, undo=True):
+        """Fecha o provisionamento. Se falhou, desfaz as etapas (undo=False: o chamador já desfez)."""
+        failed_step = self._failed_step(provision)
+        if failed_step is not None:
+            message = f"Falha na etapa '{failed_step['label']}': {failed_step['messages'][-1]['message']}"
+            if undo:
+                self._undo(provision, save) # Ainda 'running': o domínio continua reservado durante a limpeza
+            if provision.cleanup_incomplete:
+                message += " Algumas etapas não puderam ser desfeitas: use 'Abandonar' para tentar a limpeza de novo."
+            provision.status = 'failed'
+            provision.message = message
+        else:
+            provision.status = 'done'
+            warnings = provision.warnings()
+            provision.message = (f"Site {provision.domain} criado com avisos ({len(warnings)} etapa(s) opcional(is) falharam)."
+                                 if warnings else f"Site {provision.domain} criado com sucesso.")
+        provision.finished = time.time()
+        print(f"Provisionamento de {provision.domain}: {provision.message}")
+        self._persist(provision, save)
+        with self._cond:
+            self._forget_old_locked()
+
+    # --- Lotes (manifesto com vários sites) ---
+
+    def submit_batch(self, username, specs):
+        """
+        Provisiona vários sites como um lote (ver _run_batch). 'owner' em cada especificação
+        define o dono do site (padrão: username). Retorna o id do lote (relatório em batch_report).
+        """
+        self.start()
+        batch_id = os.urandom(8).hex()
+        provisions = [self._new_provision(spec.get('owner') or username, spec, batch_id) for spec in specs]
+        with self._cond:
+            busy = sorted({p.domain for p in self._provisions.values() if p.status in PROVISION_ACTIVE_STATES} &
+                          {p.domain for p in provisions})
+            if busy:
+                raise ProvisionConflictError(f"Domínio(s) já sendo provisionado(s): {', '.join(busy)}.")
+            for provision in provisions:
+                self._provisions[provision.id] = provision
+        self._persist_batch(provisions)
+        threading.Thread(target=self._run_batch, args=(provisions,), daemon=True).start()
+        return batch_id
+
+    def _run_phase(self, provisions, names, workers, overrides=None):
+        """Roda as etapas 'names' de cada site em paralelo. Retorna os sites que podem continuar."""
+        overrides = overrides or {}
+
+        def run(provision):
+            for step in provision.steps:
+                if step['name'] in names and step['status'] not in ('done', 'skipped'):
+                    if not self._run_step(provision, step, overrides.get(step['name']), save=False):
+                        return False
+            return True
+
+        if provisions:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='provision-batch') as pool:
+                results = list(pool.map(run, provisions))
+            self._persist_batch(provisions)
+            provisions = [provision for provision, ok in zip(provisions, results) if ok]
+        return provisions
+
+    def _activate_services(self, provisions):
+        """Um daemon-reload, um enable e um start (jobs de todas as unidades juntos) para as unidades gravadas pelo lote."""
+        units = {provision.site['service_name']: provision for provision in provisions
+                 if provision.step('service')['status'] == 'done' and provision.site.get('service_name')}
+        if not units:
+            return provisions
+        started = time.time()
+        names = sorted(units)
+        systemd_try('daemon_reload')
+        systemd_try('enable', names)
+        try:
+            errors = systemd.start(names) # A falha de uma unidade não impede as outras
+        except SystemdError as e:
+            errors = dict.fromkeys(names, str(e))
+        elapsed = time.time() - started
+        failed = set()
+        for name, provision in units.items():
+            step = provision.step('service')
+            step['finished'] = time.time()
+            step['duration'] = (step['duration'] or 0) + elapsed
+            if errors.get(name) is None:
+                step['messages'].append({"category": "success",
+                                         "message": f"Serviço systemd '{name}' iniciado (ativado junto com {len(names)} serviço(s) em {elapsed:.1f}s)."})
+            else:
+                step['status'] = 'failed'
+                step['messages'].append({"category": "error",
+                                         "message": f"Falha ao iniciar o serviço systemd '{name}' ({errors[name]}). Verifique os logs com 'journalctl -u {name}'"})
+                failed.add(provision.id)
+        self._persist_batch(provisions)
+        return [provision for provision in provisions if provision.id not in failed]
+
+    def _reload_nginx_batch(self, provisions):
+        """Pede a recarga de todos os sites de uma vez: o nginx_reloader atende o lote com um nginx -t e uma recarga."""
+        futures = {provision.id: reload_nginx(provision.domain, wait=False) for provision in provisions
+                   if provision.step('nginx_reload')['status'] not in ('done', 'skipped')}
+
+        def wait_reload(provision):
+            try:
+                outcome = futures[provision.id].result(timeout=NGINX_RELOAD_WAIT_TIMEOUT)
+            except FutureTimeoutError:
+                outcome = NginxReloadOutcome(False, "Tempo esgotado aguardando a recarga do Nginx.")
+            notify(outcome.message, 'success' if outcome.ok else 'error')
+            if not outcome.ok:
+                raise ProvisionError("O Nginx não aceitou a configuração do site. Corrija e tente novamente.")
+
+        return self._run_phase(provisions, ('nginx_reload',), PROVISIONING_BULK_WORKERS, {'nginx_reload': wait_reload})
+
+    def _register_batch(self, provisions):
+        """Grava todos os sites do lote no registro numa única operação."""
+        pending = [provision for provision in provisions if provision.step('register')['status'] not in ('done', 'skipped')]
+        started = time.time()
+        try:
+            skipped = set(storage.add_sites([provision.site for provision in pending]))
+        except Exception as e:
+            print(f"Aviso: Falha ao registrar os sites do lote de uma vez ({e}). Registrando um a um.")
+            skipped = {provision.domain for provision in pending}
+        elapsed = time.time() - started
+
+        def register(provision):
+            if provision.domain in skipped:
+                provision_step_register(provision) # Já existia: atualiza se é deste provisionamento, senão falha
+            else:
+                notify(f"Registrado numa única gravação com {len(pending)} site(s) ({elapsed:.2f}s).", 'info')
+
+        return self._run_phase(provisions, ('register',), PROVISIONING_BULK_WORKERS, {'register': register})
+
+    def _run_batch(self, provisions):
+        """
+        Lote: as etapas locais rodam em paralelo por site e as caras uma vez para todos: um
+        daemon-reload (mais um enable/start com todas as unidades), uma recarga do Nginx e uma
+        gravação no registro de sites. Os certificados saem com até PROVISIONING_BULK_SSL_WORKERS
+        certbot ao mesmo tempo. Um site que falha sai do lote; os demais continuam.
+        """
+        for provision in provisions:
+            provision.status = 'running'
+            provision.started = time.time()
+        self._persist_batch(provisions)
+        try:
+            alive = self._run_phase(provisions, ('directory', 'nginx_config', 'service', 'nginx_enable'),
+                                    PROVISIONING_BULK_WORKERS, {'service': provision_step_service_unit})
+            alive = self._activate_services(alive)
+            alive = self._reload_nginx_batch(alive)
+            alive = self._register_batch(alive)
+            self._run_phase(alive, ('ssl',), PROVISIONING_BULK_SSL_WORKERS)
+            self._run_phase(alive, ('permissions', 'home_symlink'), PROVISIONING_BULK_WORKERS)
+        except Exception as e:
+            print(f"Erro inesperado no lote de provisionamento: {e}")
+            for provision in provisions:
+                step = next((step for step in provision.steps if step['status'] in ('pending', 'running')), None)
+                if step is not None and provision.status == 'running':
+                    step['status'] = 'failed'
+                    step['messages'].append({"category": "error", "message": f"Erro inesperado no lote: {e}"})
+        finally:
+            # Os sites que falharam são desfeitos em paralelo (as recargas do Nginx se agrupam)
+            failed = [provision for provision in provisions if self._failed_step(provision) is not None]
+            if failed:
+                with ThreadPoolExecutor(max_workers=PROVISIONING_BULK_WORKERS, thread_name_prefix='provision-batch') as pool:
+                    list(pool.map(lambda provision: self._undo(provision, save=False), failed))
+            for provision in provisions:
+                self._finish(provision, save=False, undo=False)
+            self._persist_batch(provisions)
+
+    def wait_batch(self, batch_id, timeout=None):
+        """Espera todos os sites do lote terminarem e retorna o relatório."""
+        with self._cond:
+            self._cond.wait_for(lambda: not any(p.batch_id == batch_id and p.status in PROVISION_ACTIVE_STATES
+                                                for p in self._provisions.values()), timeout=timeout)
+        return self.batch_report(batch_id)
+
+    def batch_report(self, batch_id):
+        """Resultado por site de um lote (None se o lote não existe)."""
+        records = [record for record in self.list() if record.get('batch_id') == batch_id]
+        if not records:
+            return None
+        sites = []
+        for record in sorted(records, key=lambda r: r['domain']):
+            failed_step = next((step['name'] for step in record['steps']
+                                if step['status'] == 'failed' and step['name'] not in PROVISION_OPTIONAL_STEPS), None)
+            sites.append({
+                "id": record['id'], "domain": record['domain'], "owner": record.get('username'),
+                "status": record['status'], "message": record.get('message'), "failed_step": failed_step,
+                "warnings": record.get('warnings', []), "duration": record.get('duration'),
+                "steps": {step['name']: step['status'] for step in record['steps']},
+            })
+        counts = {status: sum(1 for site in sites if site['status'] == status) for status in ('queued', 'running', 'done', 'failed')}
+        durations = [record['duration'] for record in records if record.get('duration') is not None]
+        started = min((record['started'] for record in records if record.get('started')), default=None)
+        finished = max((record['finished'] for record in records if record.get('finished')), default=None)
+        return {
+            "batch_id": batch_id, "total": len(sites), **counts,
+            "with_warnings": sum(1 for site in sites if site['warnings']),
+            "finished": not any(site['status'] in PROVISION_ACTIVE_STATES for site in sites),
+            "elapsed": finished - started if started and finished else None,
+            "site_time_total": sum(durations), "sites": sites,
+        }
+
+    def _forget_old_locked(self):
+        finished = [p for p in self._provisions.values() if p.status not in PROVISION_ACTIVE_STATES]
+        for provision in sorted(finished, key=lambda p: p.created)[:max(0, len(finished) - PROVISIONING_HISTORY)]:
+            del self._provisions[provision.id]
+
+    def get(self, provision_id):
+        with self._cond:
+            provision = self._provisions.get(provision_id)
+            if provision is not None:
+                return provision.to_dict()
+        return next((record for record in storage.list_provisions() if record.get('id') == provision_id), None)
+
+    def list(self, username=None, active_only=False):
+        """Registros (mais recentes primeiro), os desta execução com o andamento atual."""
+        records = {record['id']: record for record in storage.list_provisions()}
+        with self._cond:
+            records.update((p.id, p.to_dict()) for p in self._provisions.values())
+        return sorted((record for record in records.values()
+                       if (username is None or record.get('username') == username) and
+                          (not active_only or record.get('status') in PROVISION_ACTIVE_STATES)),
+                      key=lambda record: record.get('created', 0), reverse=True)
+
+    def follow(self, provision_id, timeout, heartbeat):
+        """
+        Gera o registro a cada mudança até o provisionamento terminar (ou 'timeout' segundos).
+        Sem mudanças por 'heartbeat' segundos gera None (a rota envia uma linha de keep-alive).
+        """
+        deadline = time.monotonic() + timeout
+        seen = -1
+        while True:
+            with self._cond:
+                provision = self._provisions.get(provision_id)
+                if provision is None:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._cond.wait_for(lambda: provision.version != seen, timeout=min(heartbeat, remaining))
+                changed = provision.version != seen
+                seen = provision.version
+                record = provision.to_dict() if changed else None
+            yield record
+            if record is not None and record['status'] not in PROVISION_ACTIVE_STATES:
+                return
+
+
+provisioning = ProvisioningManager(PROVISIONING_WORKERS)
 
 
 # --- Rotas Flask ---
@@ -620,8 +3882,8 @@ def login():
             flash("Usuário e senha são obrigatórios.", 'error')
             return render_template('login.html')
 
-        users = load_users()
-        user = next((u for u in users if u['username'] == username), None)
+        load_users() # Garante que o usuário padrão exista
+        user = storage.get_user(username)
 
         if user and verify_password(user['password'], password):
             session['username'] = user['username']
@@ -649,9 +3911,10 @@ def system_stats_history():
     """Retorna os logs de estatísticas do sistema em JSON."""
     try:
         logs = load_system_logs()
-        # Opcional: Poderíamos filtrar/processar os logs aqui se necessário
-        # Por exemplo, garantir que os timestamps são facilmente consumíveis pelo JS
-        # Mas o formato ISO 8601 UTC já é bom.
+        # Inclui os baldes ainda em andamento (marcados com 'partial') para que os
+        # gráficos de 24h/7 dias mostrem o período atual antes de ele fechar
+        for tier, entry in rollup_engine.partial_entries():
+            logs.setdefault(tier, []).append(entry)
         return jsonify(logs)
     except Exception as e:
         print(f"Erro ao obter histórico de estatísticas: {e}")
@@ -663,24 +3926,28 @@ def system_stats_history():
 @login_required
 def index():
     """Exibe a página inicial com a lista de sites (filtrada por usuário), IP público e usuários (se admin)."""
-    all_sites = load_sites()
     public_ip = get_public_ip() # Busca o IP público
     current_user = session.get('username')
     is_admin = (current_user == 'cico')
 
-    # Filtra os sites com base no usuário logado
+    # Filtra os sites com base no usuário logado (índice por dono no registro)
     if is_admin:
-        sites_to_display = all_sites # Admin vê todos
+        sites_to_display = load_sites() # Admin vê todos
     else:
-        sites_to_display = [site for site in all_sites if site.get('created_by_user') == current_user]
+        sites_to_display = storage.sites_by_owner(current_user)
 
     # Carrega usuários se o usuário logado for 'cico' para disponibilizar na aba
     users_list = None
     if is_admin:
         users_list = load_users()
 
+    # Uso de disco de cada site, do índice em background (None enquanto não indexado)
+    start_disk_indexer()
+    disk_usage = {site['domain']: site_disk_usage(site) for site in sites_to_display}
+
     # Passa os sites filtrados, IP, usuários (se aplicável) e status de admin para o template
-    return render_template('index.html', sites=sites_to_display, public_ip=public_ip, users=users_list, is_admin=is_admin)
+    return render_template('index.html', sites=sites_to_display, public_ip=public_ip, users=users_list, is_admin=is_admin,
+                           disk_usage=disk_usage)
 
 
 # Rota única para estatísticas do sistema
@@ -689,228 +3956,260 @@ def index():
 def system_stats():
     """Retorna as estatísticas atuais do sistema em JSON."""
     try:
-        cpu = psutil.cpu_percent(interval=0.1)
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/') # Uso do disco raiz '/'
-        stats = {
-            'cpu_usage': cpu,
-            'memory_usage': memory.percent,
-            'memory_total': round(memory.total / (1024**3), 2), # GB
-            'memory_used': round(memory.used / (1024**3), 2),   # GB
-            'disk_usage': disk.percent,
-            'disk_total': round(disk.total / (1024**3), 2),     # GB
-            'disk_used': round(disk.used / (1024**3), 2)        # GB
-        }
+        # Lê a última amostra do sampler em background (sem o bloqueio de 100 ms do cpu_percent)
+        sample = get_latest_sample()
+        stats = {key: value for key, value in sample.items() if key != 'epoch'}
         return jsonify(stats)
     except Exception as e:
         print(f"Erro ao obter estatísticas do sistema: {e}")
         # Retorna um objeto de erro ou valores padrão em caso de falha
         return jsonify({"error": str(e), "cpu_usage": 0, "memory_usage": 0, "disk_usage": 0}), 500
 
-@app.route('/add_site', methods=['POST'])
+@app.route('/system_stats_recent')
 @login_required
-def add_site():
-    """Processa o formulário para adicionar um novo site."""
-    domain = request.form.get('domain', '').strip().lower()
-    site_type = request.form.get('site_type')
-    get_ssl = request.form.get('get_ssl') == 'true'
-    admin_email = request.form.get('admin_email', '').strip()
-
-    # Validação básica
-    if not domain:
-        flash("O domínio é obrigatório.", 'error')
-        return redirect(url_for('index'))
-
-    sites = load_sites()
-    if any(site['domain'] == domain for site in sites):
-        flash(f"O domínio '{domain}' já existe.", 'error')
-        return redirect(url_for('index'))
-
-    # REMOVIDA validação 'if get_ssl and not admin_email:' pois o email agora é sempre requerido pelo formulário HTML.
-    # Validação de formato de email poderia ser adicionada aqui se desejado.
-    if not admin_email: # Verificação básica se o email veio vazio (apesar do required do HTML)
-        flash("O campo Email é obrigatório.", 'error')
-        return redirect(url_for('index'))
-
-    new_site_data = {
-        "domain": domain,
-        "type": site_type,
-        "ssl_enabled": False # Inicialmente falso
+def system_stats_recent():
+    """Retorna as amostras em resolução total dos últimos N minutos (colunas, para gráficos)."""
+    try:
+        minutes = float(request.args.get('minutes', 10))
+    except ValueError:
+        return jsonify({"error": "Parâmetro 'minutes' inválido."}), 400
+    minutes = max(0.0, min(minutes, METRICS_BUFFER_MINUTES))
+
+    start_metrics_sampler()
+    timestamps, values = metrics_buffer.window(minutes * 60)
+    result = {
+        'interval': METRICS_SAMPLE_INTERVAL,
+        'timestamps': [datetime.fromtimestamp(ts, timezone.utc).isoformat().replace('+00:00', 'Z') for ts in timestamps],
     }
-    nginx_config_path = None
-    service_name = None
-
-    # --- Lógica para PHP ---
-    if site_type == 'php':
-        path = request.form.get('path', '').strip()
-        if not path:
-            flash("O caminho para os arquivos PHP é obrigatório.", 'error')
-            return redirect(url_for('index'))
-        if '..' in path or not path.startswith('/'): # Medida de segurança básica
-             flash("Caminho inválido.", 'error')
-             return redirect(url_for('index'))
+    for field, column in values.items():
+        result[field] = [round(v, 2) for v in column]
+    return jsonify(result)
 
-        new_site_data['path'] = path
-
-        # 1. Criar diretório (se não existir)
-        # ATENÇÃO: PERMISSÕES! O usuário que roda o Flask precisa poder escrever no diretório pai (ex: /var/www)
-        try:
-            # Cria o diretório com permissão para o Nginx (geralmente www-data) ler
-            # run_command(['sudo', 'mkdir', '-p', path]) # Cria diretório
-            # run_command(['sudo', 'chown', f'www-data:www-data', path]) # Define dono (ajuste www-data se necessário)
-            # run_command(['sudo', 'chmod', '755', path]) # Permissões
-            # **Abordagem alternativa mais simples (mas menos segura se o Flask roda como root):**
-            os.makedirs(path, exist_ok=True) # Cria diretório (se rodar como root, pertence a root)
-            # Idealmente, ajustar permissões depois com chown/chmod
-            flash(f"Diretório '{path}' criado (ou já existia). Verifique as permissões!", 'info') # Avisa sobre permissões
-        except Exception as e:
-            flash(f"Erro ao criar diretório '{path}': {e}", 'error')
-            return redirect(url_for('index'))
+@app.route('/site_stats')
+@login_required
+def site_stats():
+    """Última amostra de recursos de cada site visível ao usuário (dono ou admin), por service_name."""
+    start_metrics_sampler()
+    current_user = session.get('username')
+    sites = load_sites() if current_user == 'cico' else storage.sites_by_owner(current_user)
+    latest = site_collector.latest
+    return jsonify({
+        site['service_name']: dict(latest.get(site['service_name']) or {}, domain=site.get('domain'),
+                                   running=site['service_name'] in latest)
+        for site in sites if site.get('service_name')
+    })
+
+@app.route('/site_stats/<service_name>')
+@login_required
+def site_stats_history(service_name):
+    """Histórico de recursos de um serviço nos níveis de retenção (+ baldes em andamento)."""
+    if not SITE_SERVICE_RE.match(service_name):
+        return jsonify({"error": "Nome de serviço inválido."}), 400
+    site = storage.site_by_service(service_name)
+    if not site:
+        return jsonify({"error": f"Serviço '{service_name}' não encontrado."}), 404
+    current_user = session.get('username')
+    if current_user != 'cico' and site.get('created_by_user') != current_user:
+        return jsonify({"error": "Acesso negado."}), 403
+    try:
+        logs = storage.load_site_stats(service_name)
+        for tier, entry in site_collector.engine(service_name).partial_entries():
+            logs.setdefault(tier, []).append(entry)
+        logs['latest'] = site_collector.latest.get(service_name)
+        return jsonify(logs)
+    except Exception as e:
+        print(f"Erro ao obter histórico de recursos de {service_name}: {e}")
+        return jsonify({"error": str(e), 'log_5min': [], 'log_30min': [], 'log_24h': []}), 500
 
-        # 2. Gerar config Nginx
-        nginx_config_path = generate_nginx_config('php_site.conf', domain, root_path=path)
-        if not nginx_config_path:
-             # Erro já foi sinalizado pela função
-             return redirect(url_for('index'))
+@sock.route('/ws/system_stats')
+def system_stats_ws(ws):
+    """
+    Envia as estatísticas ao vivo: uma mensagem completa e depois apenas os campos alterados.
+    O cliente deve mandar qualquer mensagem (ex: 'ping') a cada LIVE_STATS_IDLE_TIMEOUT segundos;
+    clientes ociosos (aba em segundo plano, conexão esquecida) são desconectados.
+    """
+    if 'username' not in session:
+        ws.close(reason=1008, message='Login necessário.')
+        return
+    start_metrics_sampler()
+    stats_broadcaster.subscribe()
+    last_seq = 0
+    last_seen = time.monotonic()
+    try:
+        while True:
+            last_seq, message = stats_broadcaster.wait(last_seq, timeout=1)
+            if message is not None:
+                ws.send(message)
+            while ws.receive(timeout=0) is not None: # Qualquer mensagem do cliente conta como atividade
+                last_seen = time.monotonic()
+            if time.monotonic() - last_seen > LIVE_STATS_IDLE_TIMEOUT:
+                ws.close(reason=1000, message='Inativo.')
+                return
+    finally:
+        stats_broadcaster.unsubscribe()
 
-    # --- Lógica para Python/Node.js ---
-    elif site_type == 'python_node':
-        try:
-            port = int(request.form.get('port'))
-        except (ValueError, TypeError):
-            flash("A porta deve ser um número válido.", 'error')
-            return redirect(url_for('index'))
+@app.route('/add_site', methods=['POST'])
+@login_required
+def add_site():
+    """
+    Valida o formulário de novo site e enfileira o provisionamento (ver ProvisioningManager).
+    A resposta volta na hora; o andamento fica em /api/provisioning/<id>. Clientes que pedem
+    JSON (Accept: application/json) recebem 202 com o registro do provisionamento.
+    """
+    wants_json = request.accept_mimetypes.best == 'application/json'
 
-        command = request.form.get('command', '').strip()
-        workdir = request.form.get('workdir', '').strip() or None # Pega o workdir ou None
+    def reject(message, status=400):
+        if wants_json:
+            return jsonify({"success": False, "error": message}), status
+        flash(message, 'error')
+        return redirect(url_for('index'))
 
-        if not command:
-            flash("O comando de inicialização é obrigatório.", 'error')
-            return redirect(url_for('index'))
-        if workdir and ('..' in workdir or not workdir.startswith('/')):
-             flash("Diretório de trabalho inválido.", 'error')
-             return redirect(url_for('index'))
+    spec, error = validate_site_fields(request.form)
+    if error:
+        return reject(error)
+    error = domain_unavailable(spec['domain'])
+    if error:
+        return reject(error, 409)
+    domain = spec['domain']
 
-        new_site_data['port'] = port
-        new_site_data['command'] = command
-        new_site_data['workdir'] = workdir # Workdir é validado antes
+    # Diretório, Nginx, systemd, SSL, registro, permissões e link rodam em background
+    try:
+        provision = provisioning.submit(session.get('username'), spec)
+    except ProvisionConflictError as e:
+        return reject(str(e), 409)
+
+    if wants_json:
+        return jsonify({"success": True, "provision_id": provision.id, "provision": provision.to_dict(),
+                        "message": f"Provisionamento de {domain} iniciado."}), 202
+    flash(f"Provisionamento de {domain} iniciado. Acompanhe o andamento no painel.", 'info')
+    return redirect(url_for('index'))
 
-        # 1. Criar diretório de trabalho (se não existir)
-        # O campo workdir é 'required' no formulário HTML para python_node
-        if workdir:
-             try:
-                 # Cria o diretório (e diretórios pais, se necessário)
-                 # Não falha se já existir
-                 os.makedirs(workdir, exist_ok=True)
-                 # As permissões serão ajustadas posteriormente pela função set_directory_permissions
-                 flash(f"Diretório de trabalho '{workdir}' criado (ou já existia). As permissões serão definidas a seguir.", 'info')
-             except Exception as e:
-                 flash(f"Erro crítico ao criar diretório de trabalho '{workdir}': {e}. Verifique as permissões do diretório pai.", 'error')
-                 return redirect(url_for('index'))
-        else:
-             # Isso não deve acontecer devido ao 'required' no HTML, mas é uma salvaguarda.
-             flash("Erro interno: O diretório de trabalho não foi fornecido para o site App.", 'error')
-             return redirect(url_for('index'))
-
-
-        # 2. Gerar config Nginx (Reverse Proxy)
-        nginx_config_path = generate_nginx_config('proxy_site.conf', domain, port=port)
-        if not nginx_config_path:
-             # Se o workdir foi criado, talvez removê-lo? Por ora, não.
-             return redirect(url_for('index'))
-
-        # 3. Criar e iniciar serviço Systemd
-        # Passa o workdir que agora sabemos que existe (ou a criação falhou e retornou antes)
-        service_name = create_systemd_service(domain, command, port, workdir)
-        if not service_name:
-            # Tentar limpar a config do Nginx e o diretório criado? (Opcional)
-            if nginx_config_path and os.path.exists(nginx_config_path):
-                 run_command(['sudo', 'rm', nginx_config_path], check=False)
-            # Não removemos o diretório workdir automaticamente em caso de falha no serviço
-            # para permitir depuração ou tentativa manual.
-            return redirect(url_for('index'))
-        new_site_data['service_name'] = service_name
 
-    else:
-        flash("Tipo de site inválido.", 'error')
-        return redirect(url_for('index'))
+# --- Rotas do Provisionamento de Sites ---
 
-    # --- Passos Comuns (Nginx enable, reload, SSL) ---
+def provision_visible(record):
+    """Provisionamentos são visíveis ao usuário que os iniciou e ao admin."""
+    current_user = session.get('username')
+    return record is not None and (current_user == 'cico' or record.get('username') == current_user)
 
-    # 3. Habilitar site no Nginx
-    if not enable_nginx_site(domain):
-        flash(f"Falha ao habilitar o site {domain} no Nginx.", 'error')
-        # Limpar? Remover config, parar/desabilitar serviço?
-        if service_name: run_command(['sudo', 'systemctl', 'stop', service_name], check=False)
-        if service_name: run_command(['sudo', 'systemctl', 'disable', service_name], check=False)
-        if nginx_config_path and os.path.exists(nginx_config_path): run_command(['sudo', 'rm', nginx_config_path], check=False)
-        return redirect(url_for('index'))
+@app.route('/api/provisioning', methods=['GET'])
+@login_required
+def api_provisioning_list():
+    """Provisionamentos do usuário logado (admin: de todos), mais recentes primeiro; ?active=true só os em andamento."""
+    current_user = session.get('username')
+    username = None if current_user == 'cico' else current_user
+    active_only = request.args.get('active', 'false').lower() == 'true'
+    return jsonify({"success": True, "provisions": provisioning.list(username, active_only)})
 
-    # 4. Recarregar Nginx (inicialmente para HTTP)
-    if not reload_nginx():
-        # Se falhar aqui, o link simbólico existe, mas o Nginx não recarregou
-        # Tentar desfazer?
-        link_path = os.path.join(NGINX_SITES_ENABLED, domain)
-        if os.path.exists(link_path): run_command(['sudo', 'rm', link_path], check=False)
-        # Parar serviço etc...
-        return redirect(url_for('index'))
+@app.route('/api/provisioning/bulk', methods=['POST'])
+@login_required
+def api_provisioning_bulk():
+    """
+    Provisiona vários sites a partir de um manifesto (somente admin): JSON no corpo (lista ou
+    {"sites": [...]}), CSV no corpo (Content-Type: text/csv) ou arquivo 'manifest' (.json/.csv)
+    enviado como formulário. Tudo é validado antes: com qualquer erro nada é provisionado e a
+    resposta (400) lista os erros por linha. ?dry_run=true só valida. Resposta 202 com o batch_id.
+    """
+    if session.get('username') != 'cico':
+        return jsonify({"success": False, "error": "Permissão negada."}), 403
+    try:
+        upload = request.files.get('manifest')
+        if upload is not None:
+            extension = os.path.splitext(upload.filename or '')[1].lower()
+            rows = parse_site_manifest(upload.read().decode('utf-8'), {'.json': 'json', '.csv': 'csv'}.get(extension))
+        else:
+            kind = 'csv' if request.mimetype == 'text/csv' else 'json' if request.is_json else None
+            rows = parse_site_manifest(request.get_data(as_text=True), kind)
+    except ValueError as e: # Inclui JSONDecodeError e UnicodeDecodeError
+        return jsonify({"success": False, "error": f"Manifesto inválido: {e}"}), 400
+
+    specs, errors = validate_site_manifest(rows, session.get('username'))
+    if errors:
+        return jsonify({"success": False, "errors": errors,
+                        "error": f"{len(errors)} erro(s) no manifesto. Nenhum site foi provisionado."}), 400
+    if request.args.get('dry_run', 'false').lower() == 'true':
+        return jsonify({"success": True, "dry_run": True, "sites": len(specs),
+                        "message": f"Manifesto válido: {len(specs)} site(s)."})
+    try:
+        batch_id = provisioning.submit_batch(session.get('username'), specs)
+    except ProvisionConflictError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    return jsonify({"success": True, "batch_id": batch_id, "report": provisioning.batch_report(batch_id),
+                    "message": f"Provisionamento de {len(specs)} site(s) iniciado."}), 202
 
-    # 5. Obter SSL (se solicitado)
-    if get_ssl:
-        ssl_success = get_ssl_cert(domain, admin_email)
-        # O Certbot (com --nginx) deve ter modificado a config e recarregado o Nginx
-        new_site_data['ssl_enabled'] = ssl_success
-        if not ssl_success:
-             flash(f"O site {domain} foi criado, mas houve falha ao obter o certificado SSL. O site pode estar acessível via HTTP.", "warning")
-             # O site ainda pode funcionar em HTTP, então não desfazemos tudo necessariamente.
-    else:
-         flash(f"Site {domain} criado com sucesso (HTTP apenas).", 'success')
+@app.route('/api/provisioning/bulk/<batch_id>', methods=['GET'])
+@login_required
+def api_provisioning_bulk_report(batch_id):
+    """Relatório por site de um lote (somente admin)."""
+    if session.get('username') != 'cico':
+        return jsonify({"success": False, "error": "Permissão negada."}), 403
+    report = provisioning.batch_report(batch_id)
+    if report is None:
+        return jsonify({"success": False, "error": "Lote não encontrado."}), 404
+    return jsonify({"success": True, "report": report})
 
+@app.route('/api/provisioning/<provision_id>', methods=['GET'])
+@login_required
+def api_provisioning_status(provision_id):
+    record = provisioning.get(provision_id)
+    if not provision_visible(record):
+        return jsonify({"success": False, "error": "Provisionamento não encontrado."}), 404
+    return jsonify({"success": True, "provision": record})
 
-    # Adiciona o usuário que criou o site aos dados
-    new_site_data['created_by_user'] = session.get('username')
+@app.route('/api/provisioning/<provision_id>/retry', methods=['POST'])
+@login_required
+def api_provisioning_retry(provision_id):
+    """Tenta de novo a partir da etapa que falhou (as etapas já concluídas não são repetidas)."""
+    if not provision_visible(provisioning.get(provision_id)):
+        return jsonify({"success": False, "error": "Provisionamento não encontrado."}), 404
+    try:
+        provision = provisioning.retry(provision_id)
+    except ProvisionConflictError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    return jsonify({"success": True, "provision": provision.to_dict(),
+                    "message": f"Nova tentativa de provisionamento de {provision.domain} iniciada."}), 202
 
-    # Adiciona o email fornecido (sempre obrigatório agora)
-    new_site_data['admin_email'] = admin_email
+@app.route('/api/provisioning/<provision_id>/abandon', methods=['POST'])
+@login_required
+def api_provisioning_abandon(provision_id):
+    """Desfaz o que um provisionamento que falhou deixou no servidor (Nginx, systemd) e o encerra."""
+    if not provision_visible(provisioning.get(provision_id)):
+        return jsonify({"success": False, "error": "Provisionamento não encontrado."}), 404
+    try:
+        provision = provisioning.abandon(provision_id)
+    except ProvisionConflictError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    return jsonify({"success": True, "provision": provision.to_dict(),
+                    "message": f"Desfazendo o provisionamento de {provision.domain}."}), 202
 
-    # 6. Salvar dados do site (ANTES de permissões/link para ter o registro mesmo se falharem)
-    sites.append(new_site_data)
-    save_sites(sites)
+@app.route('/api/provisioning/<provision_id>/events', methods=['GET'])
+@login_required
+def api_provisioning_events(provision_id):
+    """
+    Stream NDJSON do provisionamento: uma linha {"provision": ...} a cada mudança e
+    {"heartbeat": true} a cada PROVISIONING_HEARTBEAT segundos parado. Termina quando
+    o provisionamento acaba (ou após PROVISIONING_EVENTS_TIMEOUT segundos).
+    """
+    record = provisioning.get(provision_id)
+    if not provision_visible(record):
+        return jsonify({"success": False, "error": "Provisionamento não encontrado."}), 404
 
-    # --- Passos Adicionais: Permissões e Link Simbólico (APÓS salvar no JSON) ---
-    if platform.system() == 'Linux':
-        logged_in_user = session.get('username')
-        target_directory = None
-        if site_type == 'php' and path:
-            target_directory = path
-        elif site_type == 'python_node' and workdir: # Usa workdir se fornecido
-            target_directory = workdir
-        elif site_type == 'python_node' and path: # Fallback para path se workdir não foi dado mas path existe (caso de guess)
-             target_directory = path
-
-        if logged_in_user and target_directory:
-             print(f"Tentando aplicar pós-configuração para usuário '{logged_in_user}' e diretório '{target_directory}'")
-             # 7. Definir permissões no diretório para o usuário logado
-             set_directory_permissions(target_directory, logged_in_user)
-
-             # 8. Criar link simbólico na home do usuário logado
-             create_home_symlink(target_directory, logged_in_user, domain)
-        else:
-             print("Skipping permission/symlink steps: Linux only, requires logged-in user and target directory.")
-             if not logged_in_user: flash("Não foi possível determinar o usuário logado para permissões/link.", "warning")
-             if not target_directory: flash("Diretório alvo não determinado para permissões/link.", "warning")
+    def generate():
+        if record['status'] not in PROVISION_ACTIVE_STATES: # Já terminou (ou é de uma execução anterior)
+            yield json.dumps({"provision": record}) + '\n'
+            return
+        for update in provisioning.follow(provision_id, PROVISIONING_EVENTS_TIMEOUT, PROVISIONING_HEARTBEAT):
+            yield json.dumps({"provision": update} if update is not None else {"heartbeat": True}) + '\n'
 
-    # 9. Redirecionar para a página inicial
-    # Flash messages já foram adicionadas pelas funções auxiliares
-    return redirect(url_for('index'))
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/ssl_action/<domain>', methods=['POST'])
 @login_required
 def ssl_action(domain):
     """Tenta criar ou renovar o certificado SSL para um domínio."""
-    sites = load_sites()
-    site = next((s for s in sites if s['domain'] == domain), None)
+    site = storage.get_site(domain)
 
     if not site:
         flash(f"Site '{domain}' não encontrado.", 'error')
@@ -928,6 +4227,7 @@ def ssl_action(domain):
     # --- Fim da Verificação ---
 
     admin_email = site.get('admin_email')
+    site_changes = {}
 
     # Se o SSL já estava ativo, tenta renovar (precisa do email)
     if site.get('ssl_enabled'):
@@ -967,13 +4267,17 @@ def ssl_action(domain):
         success = get_ssl_cert(domain, admin_email)
         # Se teve sucesso, atualiza o email no JSON caso tenha sido usado o padrão do admin
         if success and is_admin and not site.get('admin_email'):
-             site['admin_email'] = admin_email
+             site_changes['admin_email'] = admin_email
 
 
     # Atualiza o status no JSON baseado no resultado
     # Mesmo que já fosse True, atualiza para refletir o resultado da última operação
-    site['ssl_enabled'] = success
-    save_sites(sites)
+    # Aplica só os campos alterados sobre o registro atual (o certbot pode ter demorado)
+    site_changes['ssl_enabled'] = success
+    try:
+        storage.update_site(domain, site_changes)
+    except Exception as e:
+        flash(f"Erro crítico: Não foi possível salvar os dados dos sites: {e}", 'error')
 
     # Mensagem final já foi dada por get_ssl_cert
     return redirect(url_for('index'))
@@ -983,12 +4287,7 @@ def ssl_action(domain):
 @login_required
 def delete_site(domain):
     """Remove um site existente, verificando a permissão do usuário."""
-    sites = load_sites()
-    site_to_delete = None
-    for site in sites:
-        if site['domain'] == domain:
-            site_to_delete = site
-            break
+    site_to_delete = storage.get_site(domain)
 
     if not site_to_delete:
         flash(f"Site com domínio '{domain}' não encontrado.", 'error')
@@ -1032,8 +4331,18 @@ def delete_site(domain):
         flash("Falha ao recarregar o Nginx após modificações.", 'warning')
 
     # 5. Remover dados do site do JSON
-    sites = [s for s in sites if s['domain'] != domain]
-    save_sites(sites)
+    try:
+        storage.remove_site(domain)
+    except Exception as e:
+        flash(f"Erro crítico: Não foi possível salvar os dados dos sites: {e}", 'error')
+
+    # Histórico de recursos do serviço (não é mais necessário)
+    if site_to_delete.get('service_name'):
+        try:
+            storage.remove_site_stats(site_to_delete['service_name'])
+            site_collector.forget(site_to_delete['service_name'])
+        except Exception as e:
+            print(f"Aviso: Não foi possível remover o histórico de recursos de {domain}: {e}")
 
     # --- Passos Adicionais de Remoção (Pós JSON) ---
 
@@ -1072,12 +4381,18 @@ def delete_site(domain):
         print(f"Tentando remover o diretório recursivamente: {directory_to_remove}")
         # Verifica se o diretório existe antes de tentar remover
         if os.path.isdir(directory_to_remove):
-            # Usa sudo rm -rf pois pode ter sido criado por root ou outro usuário
-            result_rm_dir = run_command(['sudo', 'rm', '-rf', directory_to_remove], check=False)
-            if result_rm_dir and result_rm_dir.returncode == 0:
-                flash(f"Diretório '{directory_to_remove}' removido com sucesso.", 'success') # Mudei para success para clareza
+            # Usa sudo rm -rf pois pode ter sido criado por root ou outro usuário.
+            # Em sites grandes pode levar minutos: roda em background e o resultado vai para o log.
+            # Antes o diretório é renomeado (na mesma pasta, instantâneo): um site adicionado de novo
+            # com o mesmo caminho enquanto o rm ainda roda não tem os arquivos apagados.
+            parent_dir, base_name = os.path.split(directory_to_remove.rstrip('/'))
+            trash_path = os.path.join(parent_dir, f".{base_name}.removendo-{os.urandom(4).hex()}")
+            result_mv = run_command(['sudo', 'mv', '-T', directory_to_remove, trash_path], check=False)
+            if result_mv and result_mv.returncode == 0:
+                submit_command(['sudo', 'rm', '-rf', trash_path], callback=log_command_result)
+                flash(f"Remoção do diretório '{directory_to_remove}' iniciada em background.", 'info')
             else:
-                flash(f"ERRO: Falha ao remover o diretório '{directory_to_remove}'. Verifique permissões ou remova manualmente. Detalhes: {result_rm_dir.stderr if result_rm_dir else 'N/A'}", 'error')
+                flash(f"Não foi possível mover o diretório '{directory_to_remove}' para remoção. Remova-o manualmente.", 'warning')
         else:
              flash(f"Diretório '{directory_to_remove}' não encontrado ou não é um diretório. Remoção do diretório pulada.", 'info')
     else:
@@ -1144,10 +4459,8 @@ def add_user():
             # 2. Tentar definir a senha do usuário do sistema
             print(f"Usuário {username} criado, definindo senha...")
             # Usa chpasswd para definir a senha de forma não interativa
-            # CUIDADO: Isso envolve passar a senha via pipe ou similar.
-            cmd_passwd = f"echo '{username}:{password}' | sudo chpasswd"
-            # run_command atual não lida bem com pipes no comando diretamente, usamos shell=True com cuidado
-            result_passwd = run_command(cmd_passwd, check=False, shell=True)
+            # A senha vai pela entrada padrão: não aparece na linha de comando nem no log
+            result_passwd = run_command(['sudo', 'chpasswd'], check=False, input=f"{username}:{password}\n")
 
             if result_passwd is not None and result_passwd.returncode == 0:
                 print(f"Senha definida para o usuário do sistema {username}.")
@@ -1176,8 +4489,14 @@ def add_user():
 
     # 3. Se a criação no sistema foi bem-sucedida (ou se não for Linux), adiciona ao JSON
     if system_user_created or platform.system() != 'Linux':
-        users_list.append({"username": username, "password": password})
-        save_users(users_list)
+        try:
+            storage.add_user({"username": username, "password": password})
+        except StoreConflictError as e:
+            flash(f"Erro: {e}", 'error')
+            return redirect(url_for('users_management_page'))
+        except Exception as e:
+            flash(f"Erro crítico: Não foi possível salvar os dados dos usuários: {e}", 'error')
+            return redirect(url_for('users_management_page'))
         if system_user_created:
             flash(f"Usuário '{username}' adicionado com sucesso ao painel e ao sistema (com shell /bin/bash para acesso SSH).", 'success')
         else: # Caso não seja Linux
@@ -1233,8 +4552,11 @@ def delete_user(username):
 
     # 2. Se a remoção do sistema foi bem-sucedida (ou não aplicável), remove do JSON
     if system_user_deleted or platform.system() != 'Linux':
-        users_list = [u for u in users_list if u['username'] != username]
-        save_users(users_list)
+        try:
+            storage.remove_user(username)
+        except Exception as e:
+            flash(f"Erro crítico: Não foi possível salvar os dados dos usuários: {e}", 'error')
+            return redirect(url_for('users_management_page'))
         if system_user_deleted and platform.system() == 'Linux':
             flash(f"Usuário '{username}' removido com sucesso do painel e do sistema.", 'success')
         else:
@@ -1264,8 +4586,7 @@ def get_service_logs(service_name):
         return Response("<html><body><h1>Erro: Nome de serviço inválido.</h1></body></html>", status=400, mimetype='text/html')
 
     # 2. Verificar se o serviço pertence a um site gerenciado
-    sites = load_sites()
-    site_found = next((s for s in sites if s.get('service_name') == service_name), None)
+    site_found = storage.site_by_service(service_name)
 
     if not site_found:
         flash(f"Serviço '{service_name}' não encontrado ou não associado a um site gerenciado.", 'error')
@@ -1424,22 +4745,465 @@ def get_service_logs(service_name):
     return Response(stream_with_context(generate_log_stream(service_name)), mimetype='text/html')
 
 
+# --- Observador inotify (Linux) ---
+# Um único fd inotify para o painel, via ctypes (sem dependências extras). Os watches
+# são por diretório, com contagem de referências para que vários consumidores possam
+# observar o mesmo diretório; os eventos são entregues aos listeners como o caminho do
+# diretório cujo conteúdo mudou (ou None quando a fila do kernel transbordou).
+# IN_MODIFY cobre arquivos que crescem sem serem fechados (logs); como um log gera um evento
+# por escrita, esses avisos saem no máximo a cada INOTIFY_MODIFY_INTERVAL por diretório (o
+# último sempre sai, ao fim do intervalo). Os demais eventos são entregues na hora.
+
+class InotifyWatcher:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    DIR_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, tamanho do nome
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 falhou')
+        self._lock = threading.Lock()
+        self._wd_paths = {}
+        self._path_wds = {}
+        self._refs = {}
+        self._listeners = []
+        self._modify_sent = {} # caminho -> quando o último aviso de IN_MODIFY saiu
+        self._modify_pending = set() # Diretórios com IN_MODIFY segurado até o fim do intervalo
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def watch(self, path):
+        """Observa um diretório. Retorna False se não foi possível (limite de watches, permissão...)."""
+        with self._lock:
+            if path in self._path_wds:
+                self._refs[path] += 1
+                return True
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.DIR_EVENTS | self.IN_ONLYDIR)
+            if wd < 0:
+                return False
+            self._path_wds[path] = wd
+            self._wd_paths[wd] = path
+            self._refs[path] = 1
+            return True
+
+    def unwatch(self, path):
+        with self._lock:
+            refs = self._refs.get(path)
+            if not refs:
+                return
+            if refs > 1:
+                self._refs[path] = refs - 1
+                return
+            del self._refs[path]
+            wd = self._path_wds.pop(path)
+            self._wd_paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def _due_modifications(self, now):
+        """Diretórios com IN_MODIFY segurado cujo intervalo já passou."""
+        due = {path for path in self._modify_pending if now - self._modify_sent.get(path, 0) >= INOTIFY_MODIFY_INTERVAL}
+        self._modify_pending -= due
+        for path in due:
+            self._modify_sent[path] = now
+        if len(self._modify_sent) > 4096: # Esquece os diretórios sem escrita recente
+            self._modify_sent = {path: sent for path, sent in self._modify_sent.items()
+                                 if now - sent < INOTIFY_MODIFY_INTERVAL or path in self._modify_pending}
+        return due
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.fd, selectors.EVENT_READ)
+        while True:
+            timeout = None
+            if self._modify_pending:
+                now = time.monotonic()
+                timeout = max(0, min(self._modify_sent.get(path, 0) + INOTIFY_MODIFY_INTERVAL - now
+                                     for path in self._modify_pending))
+            data = b''
+            if selector.select(timeout):
+                try:
+                    data = os.read(self.fd, 65536)
+                except InterruptedError:
+                    continue
+            now = time.monotonic()
+            changed = set()
+            offset = 0
+            while offset + self.EVENT.size <= len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.add(None) # Eventos perdidos: qualquer diretório pode ter mudado
+                    continue
+                with self._lock:
+                    path = self._wd_paths.get(wd)
+                    if mask & self.IN_IGNORED and path is not None:
+                        # O kernel removeu o watch (diretório apagado ou desmontado)
+                        del self._wd_paths[wd]
+                        self._path_wds.pop(path, None)
+                        self._refs.pop(path, None)
+                if path is None:
+                    continue
+                if mask & self.DIR_EVENTS == self.IN_MODIFY: # Só escrita: limitado por diretório
+                    if now - self._modify_sent.get(path, 0) >= INOTIFY_MODIFY_INTERVAL:
+                        self._modify_sent[path] = now
+                        changed.add(path)
+                    else:
+                        self._modify_pending.add(path)
+                    continue
+                changed.add(path)
+            changed |= self._due_modifications(now)
+            for path in changed:
+                for callback in self._listeners:
+                    try:
+                        callback(path)
+                    except Exception as e:
+                        print(f"Erro em listener do inotify: {e}")
+
+
+inotify_watcher = None
+inotify_lock = threading.Lock()
+
+def get_inotify_watcher():
+    """Watcher compartilhado (a thread de leitura inicia na primeira chamada). None se indisponível."""
+    global inotify_watcher
+    if not INOTIFY_ENABLED or platform.system() != 'Linux':
+        return None
+    with inotify_lock:
+        if inotify_watcher is None:
+            try:
+                inotify_watcher = InotifyWatcher()
+            except (OSError, AttributeError) as e:
+                print(f"Aviso: inotify indisponível, usando apenas varreduras periódicas: {e}")
+                inotify_watcher = False
+                return None
+            threading.Thread(target=inotify_watcher.run, daemon=True).start()
+        return inotify_watcher or None
+
+
+# --- Índice de Uso de Disco por Site ---
+# Um indexador em background percorre a raiz de cada site com os.scandir e guarda o total
+# por diretório. Um diretório só é relido quando (inode, mtime) muda, ou quando foi marcado
+# como alterado (inotify ou rotas do file manager): as passadas seguintes fazem só um stat
+# por diretório. Alterações no conteúdo de um arquivo não mudam o mtime do diretório; sem
+# inotify elas são capturadas pela releitura completa a cada DISK_INDEX_FULL_RESCAN.
+
+class DirectoryUsage:
+    __slots__ = ('key', 'files_bytes', 'files_count', 'subdirs', 'files', 'totals')
+
+    def __init__(self, key, files_bytes, files_count, subdirs, files=None):
+        self.key = key # (inode, mtime_ns) do diretório quando foi lido
+        self.files_bytes = files_bytes # Arquivos diretos + o próprio diretório
+        self.files_count = files_count
+        self.subdirs = subdirs
+        self.files = files # Nomes dos arquivos (só com FM_SEARCH_NAME_INDEX)
+        self.totals = (files_bytes, files_count) # (bytes, arquivos) incluindo subdiretórios
+
+
+class DiskUsageIndex:
+    """Totais de uso de disco (blocos alocados, como o du) por diretório das raízes dos sites."""
+
+    def __init__(self):
+        self._nodes = {} # caminho absoluto -> DirectoryUsage (leitura sem lock; nós trocados por atribuição)
+        self._dirty = set() # None = overflow do inotify: todas as raízes precisam ser relidas
+        self._overflow_rescanned = set() # Raízes já relidas por inteiro desde o último overflow
+        self._dirty_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._watched = set()
+        self._unwatched = set() # Diretórios sem watch (sem inotify ou limite atingido); tentados de novo a cada passada
+        self.version = 0 # Muda a cada diretório relido ou removido
+
+    def usage(self, path):
+        """(bytes, arquivos) de um diretório já indexado, ou None."""
+        node = self._nodes.get(os.path.abspath(path))
+        return node.totals if node else None
+
+    def names(self, path):
+        """(subpastas, arquivos) de um diretório indexado cujo (inode, mtime) não mudou, ou None."""
+        node = self._nodes.get(path)
+        if node is None or node.files is None:
+            return None
+        st = os.stat(path, follow_symlinks=False)
+        if node.key != (st.st_ino, st.st_mtime_ns):
+            return None
+        return node.subdirs, node.files
+
+    def mark_dirty(self, path):
+        """Força a releitura de um diretório (ex: arquivo regravado no lugar) na próxima passada."""
+        with self._dirty_lock:
+            self._dirty.add(os.path.abspath(path) if path else None)
+            if not path:
+                self._overflow_rescanned.clear() # Novo overflow: vale também para as já relidas
+        self._changed.set()
+
+    def wait_for_changes(self, timeout):
+        triggered = self._changed.wait(timeout)
+        self._changed.clear()
+        return triggered
+
+    def _take_dirty(self, root):
+        prefix = root.rstrip(os.sep) + os.sep
+        with self._dirty_lock:
+            taken = {path for path in self._dirty if path is not None and (path == root or path.startswith(prefix))}
+            self._dirty -= taken
+            if None in self._dirty and root not in self._overflow_rescanned:
+                self._overflow_rescanned.add(root)
+                return None # Overflow do inotify: esta raiz deve ser relida por inteiro
+            return taken
+
+    def dirty_roots(self, roots):
+        """Raízes que têm diretórios marcados como alterados."""
+        with self._dirty_lock:
+            overflow = None in self._dirty
+            return [root for root in roots
+                    if (overflow and root not in self._overflow_rescanned) or
+                    any(path is not None and (path == root or path.startswith(root.rstrip(os.sep) + os.sep)) for path in self._dirty)]
+
+    def settle_overflow(self, roots):
+        """Desmarca o overflow quando todas as raízes já foram relidas por inteiro depois dele."""
+        with self._dirty_lock:
+            if None in self._dirty and all(root in self._overflow_rescanned for root in roots):
+                self._dirty.discard(None)
+                self._overflow_rescanned.clear()
+
+    def _scan(self, path, st):
+        files_bytes = st.st_blocks * 512
+        files_count = 0
+        subdirs = []
+        files = [] if FM_SEARCH_NAME_INDEX else None
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    else:
+                        files_bytes += entry.stat(follow_symlinks=False).st_blocks * 512
+                        files_count += 1
+                        if files is not None:
+                            files.append(entry.name)
+                except OSError:
+                    continue # Removido durante a leitura ou sem permissão
+        self.version += 1
+        return DirectoryUsage((st.st_ino, st.st_mtime_ns), files_bytes, files_count, subdirs, files)
+
+    def _refresh_dir(self, path, full, dirty, seen, watcher):
+        """
+        Atualiza a árvore sob 'path' e retorna os totais dele. Iterativo (pilha explícita), para
+        que uma árvore muito profunda não estoure o limite de recursão. OSError só para 'path'.
+        """
+        visited = {} # caminho -> nó, em pré-ordem (pais antes dos filhos)
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            try:
+                st = os.stat(current, follow_symlinks=False)
+                node = self._nodes.get(current)
+                if node is None or full or current in dirty or node.key != (st.st_ino, st.st_mtime_ns):
+                    node = self._scan(current, st)
+                    self._nodes[current] = node
+            except OSError:
+                if current == path:
+                    raise
+                continue # Removido durante a leitura ou sem permissão
+            visited[current] = node
+            seen.add(current)
+            if not watcher:
+                self._unwatched.add(current)
+            elif current not in self._watched:
+                if watcher.watch(current):
+                    self._watched.add(current)
+                    self._unwatched.discard(current)
+                else:
+                    self._unwatched.add(current)
+            stack.extend(os.path.join(current, name) for name in node.subdirs)
+        for current, node in reversed(visited.items()): # Filhos antes dos pais
+            total_bytes, total_files = node.files_bytes, node.files_count
+            for name in node.subdirs:
+                child = visited.get(os.path.join(current, name))
+                if child is not None:
+                    total_bytes += child.totals[0]
+                    total_files += child.totals[1]
+            node.totals = (total_bytes, total_files)
+        return visited[path].totals
+
+    def _recompute(self, path):
+        node = self._nodes.get(path)
+        if node is None:
+            return
+        total_bytes, total_files = node.files_bytes, node.files_count
+        for name in node.subdirs:
+            child = self._nodes.get(os.path.join(path, name))
+            if child is not None:
+                total_bytes += child.totals[0]
+                total_files += child.totals[1]
+        node.totals = (total_bytes, total_files)
+
+    def refresh_changes(self, root):
+        """
+        Relê apenas os diretórios marcados como alterados sob 'root' e recalcula os totais
+        dos ancestrais: O(entradas alteradas + profundidade), sem percorrer a árvore.
+        """
+        root = os.path.abspath(root)
+        dirty = self._take_dirty(root)
+        if dirty is None or root not in self._nodes:
+            return self.refresh(root, full=dirty is None)
+        watcher = get_inotify_watcher()
+        for path in sorted(dirty, key=len): # Pais antes dos filhos
+            old = self._nodes.get(path)
+            if old is None:
+                continue # Diretório novo: o pai (também alterado) já o indexou
+            try:
+                node = self._scan(path, os.stat(path, follow_symlinks=False))
+            except OSError:
+                continue # Removido: o evento do diretório pai cuida da limpeza
+            self._nodes[path] = node
+            for name in set(old.subdirs) - set(node.subdirs):
+                self._forget(os.path.join(path, name))
+            for name in node.subdirs:
+                child = os.path.join(path, name)
+                if child not in self._nodes:
+                    try:
+                        self._refresh_dir(child, False, set(), set(), watcher)
+                    except OSError:
+                        continue
+            self._recompute(path)
+            parent = path
+            while parent != root and parent.startswith(root):
+                parent = os.path.dirname(parent)
+                self._recompute(parent)
+
+    def refresh(self, root, full=False):
+        """Atualiza a árvore de uma raiz. Só relê os diretórios alterados, a menos que full=True."""
+        root = os.path.abspath(root)
+        dirty = self._take_dirty(root)
+        if dirty is None:
+            full, dirty = True, set()
+        seen = set()
+        self._refresh_dir(root, full, dirty, seen, get_inotify_watcher())
+        self._forget(root, keep=seen)
+
+    def unwatched_count(self, root):
+        """Diretórios sob 'root' sem watch inotify: alterações neles só aparecem numa releitura completa."""
+        root = os.path.abspath(root)
+        prefix = root.rstrip(os.sep) + os.sep
+        return sum(1 for path in list(self._unwatched) if path == root or path.startswith(prefix))
+
+    def _forget(self, root, keep=()):
+        """Remove os nós (e watches) de diretórios sob 'root' que não existem mais."""
+        prefix = root.rstrip(os.sep) + os.sep
+        for path in [p for p in self._nodes if (p == root or p.startswith(prefix)) and p not in keep]:
+            del self._nodes[path]
+            self._unwatched.discard(path)
+            self.version += 1
+            if path in self._watched:
+                self._watched.discard(path)
+                inotify_watcher.unwatch(path)
+
+    def forget_roots_except(self, roots):
+        """Descarta raízes de sites removidos."""
+        roots = [os.path.abspath(root) for root in roots]
+        prefixes = tuple(root.rstrip(os.sep) + os.sep for root in roots)
+        for path in [p for p in self._nodes if p not in roots and not p.startswith(prefixes)]:
+            self._nodes.pop(path, None)
+            self._unwatched.discard(path)
+            if path in self._watched:
+                self._watched.discard(path)
+                inotify_watcher.unwatch(path)
+
+
+disk_index = DiskUsageIndex()
+disk_indexer_thread = None
+disk_indexer_lock = threading.Lock()
+
+def site_root_dir(site):
+    """Diretório raiz de um site: 'workdir' para apps, senão 'path' (PHP)."""
+    path_key = 'workdir' if site.get('type') == 'python_node' and site.get('workdir') else 'path'
+    return site.get(path_key)
+
+def site_disk_usage(site):
+    """(bytes, arquivos) da raiz do site segundo o índice, ou None se ainda não indexado."""
+    root = site_root_dir(site)
+    return disk_index.usage(root) if root else None
+
+def run_disk_indexer():
+    print(f"Iniciando indexador de uso de disco (intervalo de {DISK_INDEX_INTERVAL}s)...")
+    watcher = get_inotify_watcher()
+    if watcher:
+        watcher.add_listener(disk_index.mark_dirty)
+    last_full = {}
+    last_pass = None
+    while True:
+        roots = sorted({os.path.abspath(root) for root in map(site_root_dir, storage.list_sites())
+                        if root and os.path.isabs(root) and os.path.isdir(root)})
+        if last_pass is None or time.monotonic() - last_pass >= DISK_INDEX_INTERVAL:
+            # Passada periódica: um stat por diretório em todas as raízes (pega sites novos)
+            for root in roots:
+                # Releitura completa só quando o inotify não cobre a árvore inteira
+                full = disk_index.unwatched_count(root) > 0 and time.monotonic() - last_full.get(root, 0) >= DISK_INDEX_FULL_RESCAN
+                try:
+                    disk_index.refresh(root, full=full)
+                except OSError as e:
+                    print(f"Aviso: Falha ao indexar o uso de disco de '{root}': {e}")
+                    continue
+                if full or root not in last_full:
+                    last_full[root] = time.monotonic()
+            disk_index.forget_roots_except(roots)
+            last_pass = time.monotonic()
+        else:
+            # Acordado por alterações: relê só os diretórios marcados das raízes afetadas
+            for root in disk_index.dirty_roots(roots):
+                try:
+                    disk_index.refresh_changes(root)
+                except OSError as e:
+                    print(f"Aviso: Falha ao atualizar o uso de disco de '{root}': {e}")
+        disk_index.settle_overflow(roots)
+        if disk_index.wait_for_changes(max(0, DISK_INDEX_INTERVAL - (time.monotonic() - last_pass))):
+            time.sleep(DISK_INDEX_DEBOUNCE) # Agrupa rajadas de alterações (extração, cópia...)
+
+def start_disk_indexer():
+    """Inicia a thread do indexador (uma única vez)."""
+    global disk_indexer_thread
+    with disk_indexer_lock:
+        if disk_indexer_thread is not None and disk_indexer_thread.is_alive():
+            return
+        disk_indexer_thread = threading.Thread(target=run_disk_indexer, daemon=True)
+        disk_indexer_thread.start()
+
+def file_manager_changed(*paths):
+    """Registra que o file manager alterou 'paths' (diretórios) para os índices/caches."""
+    for path in paths:
+        disk_index.mark_dirty(path)
+        listing_cache.invalidate(path)
+
+
 # --- Funções Auxiliares do File Manager ---
 
 def get_site_base_path(domain):
     """Obtém o caminho base absoluto para o gerenciador de arquivos de um site."""
-    sites = load_sites()
-    site = next((s for s in sites if s['domain'] == domain), None)
+    site = storage.get_site(domain)
     if not site:
         return None
 
     # Prioriza 'workdir' para apps, senão usa 'path' para PHP
-    path_key = 'workdir' if site.get('type') == 'python_node' and site.get('workdir') else 'path'
-    base_dir = site.get(path_key)
+    base_dir = site_root_dir(site)
 
     if not base_dir or not os.path.isabs(base_dir):
          # Se não encontrar ou não for absoluto, retorna None para indicar erro
-         print(f"Erro: Caminho base inválido ou não encontrado para o site {domain} na chave {path_key}.")
+         print(f"Erro: Caminho base inválido ou não encontrado para o site {domain}.")
          return None
 
     # Garante que o diretório base exista
@@ -1456,8 +5220,7 @@ def get_site_base_path(domain):
 
 def check_file_manager_permission(domain):
     """Verifica se o usuário logado tem permissão para acessar o file manager deste site."""
-    sites = load_sites()
-    site = next((s for s in sites if s['domain'] == domain), None)
+    site = storage.get_site(domain)
     if not site:
         return False # Site não existe
 
@@ -1500,13 +5263,1223 @@ def sanitize_path(base_path, relative_path):
     # ATENÇÃO: abspath não impede sair do diretório base por si só
     full_path = os.path.abspath(unsafe_full_path)
 
-    # **Verificação CRUCIAL: Garante que o caminho final esteja DENTRO do base_path**
-    # Compara os caminhos absolutos normalizados
-    if os.path.commonpath([base_path, full_path]) != os.path.abspath(base_path):
-        print(f"Erro de Segurança: Tentativa de acesso fora do diretório base detectada. Base: '{base_path}', Solicitado: '{relative_path}', Resolvido: '{full_path}'")
-        return None # Caminho inseguro!
+    # **Verificação CRUCIAL: Garante que o caminho final esteja DENTRO do base_path**
+    # Compara os caminhos absolutos normalizados
+    if os.path.commonpath([base_path, full_path]) != os.path.abspath(base_path):
+        print(f"Erro de Segurança: Tentativa de acesso fora do diretório base detectada. Base: '{base_path}', Solicitado: '{relative_path}', Resolvido: '{full_path}'")
+        return None # Caminho inseguro!
+
+    # A verificação acima é só textual: um link simbólico dentro do site (ex: 'x' -> /root)
+    # levaria send_file/open para fora dele. Confere também o caminho com os links resolvidos.
+    real_base = os.path.realpath(base_path)
+    real_path = os.path.realpath(full_path)
+    if os.path.commonpath([real_base, real_path]) != real_base:
+        print(f"Erro de Segurança: Link simbólico aponta para fora do diretório base. Base: '{base_path}', Solicitado: '{relative_path}', Destino: '{real_path}'")
+        return None
+
+    return full_path
+
+# --- Listagem de Diretórios (File Manager) ---
+# os.scandir entrega nome e tipo de cada entrada sem stat (d_type). Com sort='name' só
+# os itens da página recebem stat; 'size'/'mtime' precisam do stat de todas as entradas.
+# A página é escolhida com heapq (O(n log k)) a partir de um cursor com a chave de
+# ordenação do último item, estável mesmo se a pasta mudar entre uma página e outra.
+# As entradas (e os stats já feitos) ficam no cache de listagens abaixo, então navegar
+# de volta a uma pasta ou paginar não relê o diretório.
+
+class CachedListing:
+    """Entradas de um diretório (nome, é_pasta) + stat dos arquivos, lido sob demanda."""
+    __slots__ = ('path', 'key', 'rows', 'stats', 'version', 'loaded', 'watched')
+
+    def __init__(self, path, key, rows, version, watched):
+        self.path = path
+        self.key = key # (inode, mtime_ns) do diretório na leitura
+        self.rows = rows
+        self.stats = {}
+        self.version = version
+        self.loaded = time.monotonic()
+        self.watched = watched
+
+    def stat(self, name, is_dir):
+        # Pastas: sempre atuais (o mtime delas muda sem evento no diretório pai)
+        if is_dir:
+            return os.stat(os.path.join(self.path, name))
+        stat_info = self.stats.get(name)
+        if stat_info is None:
+            stat_info = self.stats[name] = os.stat(os.path.join(self.path, name))
+        return stat_info
+
+
+class DirectoryListingCache:
+    """
+    Cache LRU das listagens de diretórios vistos recentemente, por caminho absoluto sanitizado.
+
+    Cada diretório em cache tem um watch inotify (liberado na remoção do cache), então
+    qualquer alteração no diretório o invalida na hora; as rotas do file manager também
+    invalidam o que alteram (file_manager_changed). O (inode, mtime) é conferido a cada
+    acesso e, sem watch, a entrada expira em FM_LIST_CACHE_TTL segundos.
+    """
+
+    def __init__(self, max_dirs, max_entries):
+        self.max_dirs = max_dirs
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._total_rows = 0
+        self._lock = threading.Lock()
+        self._version = time.time_ns() # Versão de cada leitura (base do ETag); não se repete entre reinícios
+        self._invalidations = 0
+        self._listening = False
+
+    def _watcher(self):
+        watcher = get_inotify_watcher()
+        if watcher and not self._listening:
+            self._listening = True
+            watcher.add_listener(self.invalidate)
+        return watcher
+
+    def _drop(self, path):
+        cached = self._entries.pop(path, None)
+        if cached is not None:
+            self._total_rows -= len(cached.rows)
+            if cached.watched:
+                inotify_watcher.unwatch(path)
+
+    def invalidate(self, path):
+        """Descarta a listagem de 'path' (None: todas, ex: overflow do inotify)."""
+        with self._lock:
+            self._invalidations += 1
+            if path is None:
+                for cached_path in list(self._entries):
+                    self._drop(cached_path)
+            else:
+                self._drop(os.path.abspath(path))
+
+    def get(self, path):
+        """Listagem válida de 'path', do cache ou lida agora com os.scandir."""
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None:
+                if cached.key == key and (cached.watched or time.monotonic() - cached.loaded < FM_LIST_CACHE_TTL):
+                    self._entries.move_to_end(path)
+                    return cached
+                self._drop(path)
+            invalidations = self._invalidations
+            self._version += 1
+            version = self._version
+
+        # O watch vem antes da leitura para não perder alterações feitas durante ela
+        watcher = self._watcher()
+        watched = bool(watcher) and watcher.watch(path)
+        rows = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        rows.append((entry.name, entry.is_dir())) # Segue links simbólicos, como os.path.isdir
+                    except OSError:
+                        continue
+        except OSError:
+            if watched:
+                watcher.unwatch(path)
+            raise
+        listing = CachedListing(path, key, rows, version, watched)
+
+        with self._lock:
+            if self._invalidations != invalidations or path in self._entries:
+                # Algo mudou durante a leitura (ou outra requisição já guardou): usa sem guardar
+                if watched:
+                    watcher.unwatch(path)
+                listing.watched = False
+                return listing
+            self._entries[path] = listing
+            self._total_rows += len(rows)
+            while self._entries and (len(self._entries) > self.max_dirs or self._total_rows > self.max_entries):
+                oldest = next(iter(self._entries))
+                if oldest == path and len(self._entries) == 1:
+                    break # Uma pasta maior que o limite: fica só ela
+                self._drop(oldest)
+        return listing
+
+
+listing_cache = DirectoryListingCache(FM_LIST_CACHE_MAX_DIRS, FM_LIST_CACHE_MAX_ENTRIES)
+
+LIST_SORT_KEYS = ('name', 'size', 'mtime')
+
+def encode_list_cursor(row):
+    """Cursor opaco: (grupo, chave, nome) do último item da página."""
+    return base64.urlsafe_b64encode(json.dumps(list(row[:3]), separators=(',', ':')).encode()).decode()
+
+def decode_list_cursor(cursor, sort='name'):
+    """(grupo, chave, nome) do cursor, ou None se for inválido ou de outra ordenação."""
+    try:
+        group, key, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    # A chave é comparada com as das linhas: um tipo diferente (ex: texto com sort=size) daria TypeError
+    key_types = (str,) if sort == 'name' else (int, float)
+    if group not in (0, 1) or isinstance(group, bool) or isinstance(key, bool) or not isinstance(key, key_types) or not isinstance(name, str):
+        return None
+    return group, key, name
+
+def list_directory_page(listing, sort='name', descending=False, name_filter='', folders_only=False,
+                        cursor=None, limit=FM_LIST_PAGE_SIZE):
+    """
+    Uma página da listagem, ordenada no servidor com as pastas primeiro. 'listing' é o
+    CachedListing do diretório (listing_cache.get). Retorna (linhas, total_filtrado,
+    próximo_cursor); cada linha é (grupo, chave, nome).
+    """
+    needle = name_filter.casefold()
+    rows = []
+    for name, is_dir in listing.rows:
+        if needle and needle not in name.casefold():
+            continue
+        if folders_only and not is_dir:
+            continue
+        try:
+            if sort == 'name':
+                key = name.casefold()
+            elif sort == 'mtime':
+                key = listing.stat(name, is_dir).st_mtime
+            elif is_dir:
+                usage = disk_index.usage(os.path.join(listing.path, name))
+                key = usage[0] if usage else 0
+            else:
+                key = listing.stat(name, is_dir).st_size
+        except OSError:
+            continue # Link quebrado ou sem permissão: pula, como antes
+        rows.append((0 if is_dir else 1, key, name))
+
+    total = len(rows)
+    if cursor is not None:
+        group, cursor_key, cursor_name = cursor
+        def after_cursor(row):
+            if row[0] != group:
+                return row[0] > group
+            if descending:
+                return (row[1], row[2]) < (cursor_key, cursor_name)
+            return (row[1], row[2]) > (cursor_key, cursor_name)
+        rows = [row for row in rows if after_cursor(row)]
+
+    select = heapq.nlargest if descending else heapq.nsmallest
+    page = []
+    for group in (0, 1): # Pastas, depois arquivos
+        remaining = limit - len(page)
+        if remaining <= 0:
+            break
+        page += select(remaining, (row for row in rows if row[0] == group), key=lambda row: (row[1], row[2]))
+    next_cursor = encode_list_cursor(page[-1]) if page and len(rows) > len(page) else None
+    return page, total, next_cursor
+
+def directory_item(listing, row):
+    """Item da resposta de listagem a partir de uma linha de list_directory_page."""
+    group, _, name = row
+    is_dir = group == 0
+    stat_info = listing.stat(name, is_dir) # Arquivos: em cache se já foi lido para ordenar
+    # Pastas: total do índice de uso de disco (None enquanto não indexada)
+    dir_usage = disk_index.usage(os.path.join(listing.path, name)) if is_dir else None
+    return {
+        "name": name,
+        "is_dir": is_dir,
+        "size": stat_info.st_size if not is_dir else (dir_usage[0] if dir_usage else None),
+        "modified": stat_info.st_mtime
+    }
+
+def stream_directory_listing(listing, relative_path, page, total, next_cursor):
+    """Gera o JSON da listagem em blocos, sem montar a resposta inteira em memória."""
+    yield '{"success":true,"path":%s,"total":%d,"next_cursor":%s,"files":[' % (
+        json.dumps(relative_path), total, json.dumps(next_cursor))
+    chunk = []
+    first = True
+    for row in page:
+        try:
+            item = json.dumps(directory_item(listing, row), separators=(',', ':'))
+        except OSError as e:
+            print(f"Erro ao acessar item '{os.path.join(listing.path, row[2])}': {e}. Pulando.")
+            continue
+        chunk.append(item if first else ',' + item)
+        first = False
+        if len(chunk) >= 200:
+            yield ''.join(chunk)
+            chunk = []
+    yield ''.join(chunk) + ']}'
+
+# --- Busca de Arquivos (File Manager) ---
+# Percorre a árvore a partir de uma pasta do site (os.scandir, sem seguir links) e envia cada
+# resultado assim que é encontrado: uma linha JSON por resultado (NDJSON) e, por último, uma
+# linha de resumo com "done". Nome: glob (sem curingas, busca por trecho) ou regex. Conteúdo:
+# texto ou regex nos primeiros FM_SEARCH_MAX_READ bytes de cada arquivo, pulando binários.
+# Com FM_SEARCH_NAME_INDEX o índice de uso de disco também guarda os nomes dos arquivos, e
+# uma pasta cujo (inode, mtime) não mudou é lida do índice: numa árvore já indexada, a busca
+# por nome custa um stat por pasta.
+# Regex do usuário: com o módulo re2 (sem backtracking) ela roda aqui mesmo; sem ele, a busca
+# inteira roda num processo filho que é morto se passar do limite. O 're' do Python segura o
+# GIL durante um match e uma regex como (a+)+$ travaria o painel inteiro.
+
+try:
+    import re2 # Regex em tempo linear (opcional: pip install google-re2)
+except ImportError:
+    re2 = None
+
+SEARCH_NAME_MODES = ('glob', 'regex')
+SEARCH_CONTENT_MODES = ('text', 'regex')
+SEARCH_TYPES = ('all', 'file', 'dir')
+
+def compile_user_regex(pattern, ignore_case, multiline=False):
+    """Compila a regex do usuário com o re2, se disponível. re.error se for inválida."""
+    if re2 is None:
+        return re.compile(pattern, (re.IGNORECASE if ignore_case else 0) | (re.MULTILINE if multiline else 0))
+    inline = ('i' if ignore_case else '') + ('m' if multiline else '')
+    prefix = f'(?{inline})' if inline else ''
+    if isinstance(pattern, bytes):
+        prefix = prefix.encode('ascii')
+    try:
+        return re2.compile(prefix + pattern)
+    except Exception as e: # Cada binding do re2 tem sua própria exceção
+        raise re.error(str(e))
+
+def compile_name_matcher(pattern, mode, ignore_case):
+    """Função nome -> bool. re.error se a regex for inválida."""
+    if mode == 'regex':
+        return compile_user_regex(pattern, ignore_case).search
+    if not any(char in pattern for char in '*?['):
+        pattern = f'*{pattern}*'
+    return re.compile(fnmatch.translate(pattern), re.IGNORECASE if ignore_case else 0).match
+
+def compile_content_pattern(pattern, mode, ignore_case):
+    """Regex de bytes para o conteúdo (UTF-8). re.error se a regex for inválida."""
+    encoded = pattern.encode('utf-8')
+    if mode == 'regex':
+        return compile_user_regex(encoded, ignore_case, multiline=True)
+    return re.compile(re.escape(encoded), (re.IGNORECASE if ignore_case else 0) | re.MULTILINE)
+
+def search_needs_isolation(name_mode, content_mode, name_pattern, content):
+    """True se a busca usa regex do usuário no 're' (pode não terminar) e há fork para isolá-la."""
+    uses_regex = (name_pattern and name_mode == 'regex') or (content and content_mode == 'regex')
+    return bool(uses_regex) and re2 is None and 'fork' in multiprocessing.get_all_start_methods()
+
+def grep_file(path, pattern):
+    """[{line, text}] das linhas que casam no início do arquivo; None se parecer binário."""
+    with open(path, 'rb') as f:
+        data = f.read(FM_SEARCH_MAX_READ)
+    if b'\0' in data[:8192]:
+        return None
+    matches = []
+    line_no, counted_to, last_line_start = 1, 0, -1
+    for match in pattern.finditer(data):
+        line_start = data.rfind(b'\n', 0, match.start()) + 1
+        if line_start == last_line_start:
+            continue # Uma entrada por linha
+        line_no += data.count(b'\n', counted_to, line_start)
+        counted_to = last_line_start = line_start
+        line_end = data.find(b'\n', match.end())
+        line = data[line_start:line_end if line_end >= 0 else len(data)]
+        matches.append({"line": line_no, "text": line[:FM_SEARCH_LINE_LENGTH].decode('utf-8', 'replace').rstrip('\r')})
+        if len(matches) >= FM_SEARCH_MATCHES_PER_FILE:
+            break
+    return matches
+
+def directory_names(path, use_index=True):
+    """(subpastas, arquivos, veio_do_índice) de uma pasta."""
+    names = disk_index.names(path) if use_index else None
+    if names is not None:
+        return names[0], names[1], True
+    subdirs, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                (subdirs if entry.is_dir(follow_symlinks=False) else files).append(entry.name)
+            except OSError:
+                continue
+    return subdirs, files, False
+
+def search_files(base_path, start_path, name_match=None, content_pattern=None, item_type='all',
+                 max_results=FM_SEARCH_MAX_RESULTS, time_limit=FM_SEARCH_TIME_LIMIT, use_index=True):
+    """
+    Gera um dict por resultado (caminho relativo a base_path) e, por último, o resumo.
+    Pastas entram nos resultados só na busca por nome (e com item_type 'all' ou 'dir').
+    """
+    started = time.monotonic()
+    deadline = started + time_limit
+    results = scanned_dirs = indexed_dirs = grepped_files = 0
+    stopped = None
+    stack = [start_path]
+    while stack and stopped is None:
+        directory = stack.pop()
+        try:
+            subdirs, files, from_index = directory_names(directory, use_index)
+        except OSError:
+            continue # Removida durante a busca ou sem permissão
+        scanned_dirs += 1
+        indexed_dirs += from_index
+        stack.extend(os.path.join(directory, name) for name in sorted(subdirs, reverse=True)) # Ordem alfabética
+        candidates = []
+        if content_pattern is None and item_type != 'file':
+            candidates.extend((name, True) for name in sorted(subdirs))
+        if item_type != 'dir':
+            candidates.extend((name, False) for name in sorted(files))
+        for name, is_dir in candidates:
+            if time.monotonic() > deadline:
+                stopped = 'timeout'
+                break
+            if name_match is not None and not name_match(name):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+                matches = None
+                if content_pattern is not None:
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    grepped_files += 1
+                    matches = grep_file(path, content_pattern)
+                    if not matches:
+                        continue
+            except OSError:
+                continue
+            item = {
+                "path": os.path.relpath(path, base_path).replace(os.sep, '/'),
+                "name": name,
+                "is_dir": is_dir,
+                "size": None if is_dir else st.st_size,
+                "modified": st.st_mtime,
+            }
+            if matches is not None:
+                item["matches"] = matches
+            yield item
+            results += 1
+            if results >= max_results:
+                stopped = 'limit'
+                break
+        else:
+            if time.monotonic() > deadline and stack:
+                stopped = 'timeout'
+    yield {
+        "done": True, "results": results, "truncated": stopped is not None, "reason": stopped,
+        "scanned_dirs": scanned_dirs, "indexed_dirs": indexed_dirs, "grepped_files": grepped_files,
+        "elapsed_ms": int((time.monotonic() - started) * 1000),
+    }
+
+def _search_files_child(conn, args):
+    """Processo filho da busca isolada: envia cada item pelo pipe."""
+    try:
+        for item in search_files(*args):
+            conn.send(item)
+    finally:
+        conn.close()
+
+def search_files_isolated(base_path, start_path, name_match=None, content_pattern=None, item_type='all',
+                          max_results=FM_SEARCH_MAX_RESULTS, time_limit=FM_SEARCH_TIME_LIMIT):
+    """
+    search_files() num processo filho (fork), morto se passar de time_limit + FM_SEARCH_KILL_GRACE:
+    o limite normal só é conferido entre arquivos, não dentro de um match. O filho não consulta o
+    índice de disco (o lock dele pode ter sido copiado travado no fork).
+    """
+    started = time.monotonic()
+    deadline = started + time_limit + FM_SEARCH_KILL_GRACE
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    args = (base_path, start_path, name_match, content_pattern, item_type, max_results, time_limit, False)
+    process = multiprocessing.get_context('fork').Process(target=_search_files_child, args=(sender, args), daemon=True)
+    process.start()
+    sender.close()
+    results = 0
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not receiver.poll(remaining):
+                break # Preso num match: o resumo é montado aqui
+            try:
+                item = receiver.recv()
+            except EOFError:
+                break # O filho terminou (ou morreu) sem enviar o resumo
+            yield item
+            if item.get('done'):
+                return
+            results += 1
+        yield {
+            "done": True, "results": results, "truncated": True, "reason": 'timeout',
+            "elapsed_ms": int((time.monotonic() - started) * 1000),
+        }
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.kill() # Também quando o cliente desconecta no meio da busca
+        process.join(1)
+
+# --- Visualizador/Editor de Arquivos (File Manager) ---
+# Leituras por faixa (bytes ou linhas) via mmap: abrir o fim de um log de vários GB só toca
+# as páginas lidas. A gravação é atômica (arquivo temporário na mesma pasta + os.replace) e
+# exige o ETag (ou o mtime) da versão que o usuário abriu: se o arquivo mudou desde então,
+# a resposta é 412 e nada é sobrescrito. O modo "seguir" (tail -f) envia em NDJSON o que é
+# acrescentado ao arquivo, reabrindo-o se for rotacionado.
+
+editor_write_lock = threading.Lock() # Precondição e os.replace sem intercalar entre requisições
+
+class EditConflict(Exception):
+    """O arquivo mudou desde a versão aberta no editor."""
+
+    def __init__(self, st):
+        super().__init__("O arquivo foi modificado por outra pessoa ou processo desde que foi aberto.")
+        self.st = st
+
+
+def file_etag(st):
+    return f'{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}'
+
+def read_file_range(path, offset=0, length=None, start_line=None, line_count=None, tail_lines=None):
+    """
+    Lê uma faixa via mmap: bytes (offset/length), linhas (start_line a partir de 1 e line_count)
+    ou as últimas tail_lines linhas, sempre limitada a FM_VIEW_MAX_BYTES. Retorna
+    (stat, início, fim, dados); no modo por linhas a faixa termina numa quebra de linha.
+    """
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        if size == 0:
+            return st, 0, 0, b'' # mmap não aceita arquivos vazios
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if tail_lines is not None:
+                end = size
+                start = size - 1 if mm[size - 1] == 0x0a else size # A quebra final não abre uma linha
+                for _ in range(tail_lines):
+                    start = mm.rfind(b'\n', 0, start)
+                    if start < 0:
+                        break
+                start += 1
+                if end - start > FM_VIEW_MAX_BYTES:
+                    # Linhas longas demais: começa na primeira linha completa dentro do limite
+                    limit = end - FM_VIEW_MAX_BYTES
+                    newline = mm.find(b'\n', limit, end)
+                    start = newline + 1 if 0 <= newline < end - 1 else limit
+            elif start_line is not None:
+                start = 0
+                for _ in range(start_line - 1):
+                    start = mm.find(b'\n', start) + 1
+                    if not start:
+                        start = size
+                        break
+                limit = min(size, start + FM_VIEW_MAX_BYTES)
+                end = start
+                for _ in range(line_count):
+                    newline = mm.find(b'\n', end, limit)
+                    if newline < 0:
+                        end = limit
+                        break
+                    end = newline + 1
+            else:
+                start = min(offset, size)
+                end = min(size, start + min(length or FM_VIEW_MAX_BYTES, FM_VIEW_MAX_BYTES))
+            return st, start, end, mm[start:end]
+
+def write_file_atomic(path, data, expected_etag=None, expected_mtime=None, create=False):
+    """
+    Grava 'data' em 'path' (temporário + fsync + os.replace), mantendo modo e dono do original.
+    create=True só cria (FileExistsError se já existe); senão o arquivo precisa existir
+    (FileNotFoundError) e bater com expected_etag/expected_mtime (EditConflict).
+    Retorna o os.stat da nova versão.
+    """
+    dir_name = os.path.dirname(path)
+    with editor_write_lock:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if create:
+            if st is not None:
+                raise FileExistsError(path)
+        else:
+            if st is None:
+                raise FileNotFoundError(path)
+            if ((expected_etag is not None and expected_etag != file_etag(st)) or
+                    (expected_mtime is not None and expected_mtime != st.st_mtime)):
+                raise EditConflict(st)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp', dir=dir_name)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if st is not None:
+                os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+                if hasattr(os, 'geteuid') and os.geteuid() == 0:
+                    os.chown(tmp_path, st.st_uid, st.st_gid)
+            else:
+                os.chmod(tmp_path, 0o644) # mkstemp cria com 0600
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        # Garante que a renomeação também chegue ao disco
+        try:
+            dir_fd = os.open(dir_name, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass # Alguns sistemas de arquivos não permitem fsync em diretórios
+        return os.stat(path)
+
+def follow_file(path, offset, duration):
+    """
+    Gera eventos com o que é acrescentado a 'path' a partir de 'offset' (tail -f) durante
+    'duration' segundos: {"offset", "data"}; {"truncated"} / {"rotated"} quando o arquivo
+    é truncado ou trocado; {"offset"} sozinho como sinal de vida (detecta desconexão).
+    """
+    deadline = time.monotonic() + duration
+    decoder = codecs.getincrementaldecoder('utf-8')('replace') # Não corta caracteres entre blocos
+    last_event = time.monotonic()
+    f = open(path, 'rb')
+    try:
+        while time.monotonic() < deadline:
+            try:
+                rotated = os.stat(path).st_ino != os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = False # Entre a rotação e a criação do novo arquivo: continua no antigo
+            if rotated:
+                f.close()
+                f = open(path, 'rb')
+                offset = 0
+                decoder.reset()
+                yield {"rotated": True, "offset": 0}
+            size = os.fstat(f.fileno()).st_size
+            if size < offset:
+                offset = 0
+                decoder.reset()
+                yield {"truncated": True, "offset": 0}
+            if size > offset:
+                f.seek(offset)
+                data = f.read(min(size - offset, FM_VIEW_MAX_BYTES))
+                offset += len(data)
+                last_event = time.monotonic()
+                yield {"offset": offset, "data": decoder.decode(data)}
+                continue
+            if time.monotonic() - last_event >= FM_TAIL_HEARTBEAT:
+                last_event = time.monotonic()
+                yield {"offset": offset}
+            time.sleep(FM_TAIL_POLL_INTERVAL)
+    finally:
+        f.close()
+
+# --- Upload em Partes (File Manager) ---
+# init cria a sessão e um arquivo temporário oculto no diretório de destino, já com o
+# tamanho final; cada parte chega num PUT com o seu offset e é gravada direto no arquivo
+# (os.pwrite, sem o parser de multipart guardar o corpo inteiro); finalize confere que
+# todas as faixas chegaram e o checksum opcional e renomeia atomicamente. O estado das
+# sessões fica em UPLOAD_STATE_DIR: um envio interrompido (inclusive por reinício do
+# painel) continua de onde parou, pois init com o mesmo arquivo devolve a mesma sessão.
+
+class UploadSession:
+    __slots__ = ('upload_id', 'username', 'domain', 'target_dir', 'filename', 'size', 'chunk_size',
+                 'checksum', 'received', 'updated', 'lock')
+
+    def __init__(self, upload_id, username, domain, target_dir, filename, size, chunk_size,
+                 checksum=None, received=None, updated=None):
+        self.upload_id = upload_id
+        self.username = username
+        self.domain = domain
+        self.target_dir = target_dir
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.checksum = checksum # (algoritmo, hex) do arquivo inteiro, conferido no finalize
+        self.received = received or [] # Faixas [início, fim) já gravadas, ordenadas e unidas
+        self.updated = updated or time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def temp_path(self):
+        return os.path.join(self.target_dir, f".{self.filename}.{self.upload_id}.upload")
+
+    @property
+    def destination(self):
+        return os.path.join(self.target_dir, self.filename)
+
+    def received_bytes(self):
+        return sum(end - start for start, end in self.received)
+
+    def add_range(self, start, end):
+        ranges = sorted(self.received + [[start, end]])
+        merged = [ranges[0]]
+        for range_start, range_end in ranges[1:]:
+            if range_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], range_end)
+            else:
+                merged.append([range_start, range_end])
+        self.received = merged
+
+    def complete(self):
+        return self.size == 0 or self.received == [[0, self.size]]
+
+    def to_dict(self):
+        return {
+            "upload_id": self.upload_id, "username": self.username, "domain": self.domain,
+            "target_dir": self.target_dir, "filename": self.filename, "size": self.size,
+            "chunk_size": self.chunk_size, "checksum": list(self.checksum) if self.checksum else None,
+            "received": self.received, "updated": self.updated,
+        }
+
+    def status(self):
+        """Resposta da API (sem caminhos absolutos do servidor)."""
+        return {
+            "upload_id": self.upload_id, "filename": self.filename, "size": self.size,
+            "chunk_size": self.chunk_size, "received": self.received,
+            "received_bytes": self.received_bytes(), "parallel": FM_UPLOAD_PARALLEL,
+        }
+
+
+def parse_upload_checksum(value):
+    """'sha256:<hex>' -> ('sha256', '<hex>'); None se vazio. ValueError se inválido."""
+    if not value:
+        return None
+    algorithm, _, digest = value.partition(':')
+    algorithm = algorithm.lower()
+    if algorithm not in UPLOAD_CHECKSUM_ALGORITHMS or not re.fullmatch(r'[0-9a-fA-F]+', digest or ''):
+        raise ValueError(f"Checksum inválido. Use '<algoritmo>:<hex>' com: {', '.join(UPLOAD_CHECKSUM_ALGORITHMS)}.")
+    return algorithm, digest.lower()
+
+
+class UploadManager:
+    """Sessões de upload em andamento, persistidas em um JSON por sessão em 'state_dir'."""
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self._sessions = None # Carregadas do disco no primeiro uso
+        self._lock = threading.Lock()
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.state_dir, f"{upload_id}.json")
+
+    def _load_locked(self):
+        if self._sessions is not None:
+            return
+        self._sessions = {}
+        if not os.path.isdir(self.state_dir):
+            return
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.state_dir, name)) as f:
+                    data = json.load(f)
+                data['checksum'] = tuple(data['checksum']) if data.get('checksum') else None
+                session = UploadSession(**data)
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                print(f"Aviso: Estado de upload '{name}' inválido, ignorando: {e}")
+                continue
+            self._sessions[session.upload_id] = session
+
+    def _save(self, session):
+        """Grava o estado da sessão (chamado com session.lock)."""
+        os.makedirs(self.state_dir, exist_ok=True)
+        state_path = self._state_path(session.upload_id)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(session.to_dict(), f, separators=(',', ':'))
+        os.replace(state_path + '.tmp', state_path)
+
+    def _discard_locked(self, session, remove_temp=True):
+        self._sessions.pop(session.upload_id, None)
+        for path in ((session.temp_path,) if remove_temp else ()) + (self._state_path(session.upload_id),):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Aviso: Falha ao remover '{path}' do upload {session.upload_id}: {e}")
+
+    def _purge_expired_locked(self):
+        limit = time.time() - FM_UPLOAD_SESSION_TTL
+        for session in [s for s in self._sessions.values() if s.updated < limit]:
+            print(f"Upload {session.upload_id} ('{session.filename}') expirado, removendo o arquivo parcial.")
+            self._discard_locked(session)
+
+    def create(self, username, domain, target_dir, filename, size, checksum=None):
+        """Nova sessão, ou a sessão interrompida do mesmo arquivo (retomada). Retorna (sessão, retomada)."""
+        with self._lock:
+            self._load_locked()
+            self._purge_expired_locked()
+            for session in self._sessions.values():
+                if (session.username, session.domain, session.target_dir, session.filename, session.size, session.checksum) == \
+                        (username, domain, target_dir, filename, size, checksum) and os.path.exists(session.temp_path):
+                    session.updated = time.time()
+                    return session, True
+            session = UploadSession(os.urandom(12).hex(), username, domain, target_dir, filename, size,
+                                    FM_UPLOAD_CHUNK_SIZE, checksum)
+            # Arquivo temporário já no tamanho final (esparso): as partes podem chegar em qualquer ordem
+            fd = os.open(session.temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            try:
+                os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+            with session.lock:
+                self._save(session)
+            self._sessions[session.upload_id] = session
+            return session, False
+
+    def get(self, upload_id):
+        with self._lock:
+            self._load_locked()
+            return self._sessions.get(upload_id)
+
+    def write_chunk(self, session, offset, stream, length, chunk_checksum=None):
+        """
+        Grava 'length' bytes de 'stream' em 'offset'. A faixa só é registrada depois de
+        chegar inteira ao disco (e conferir com chunk_checksum, se enviado). ValueError se não.
+        """
+        hasher = hashlib.new(chunk_checksum[0]) if chunk_checksum else None
+        fd = os.open(session.temp_path, os.O_WRONLY)
+        try:
+            position = offset
+            remaining = length
+            while remaining > 0:
+                data = stream.read(min(remaining, 1024 * 1024))
+                if not data:
+                    raise ValueError(f"Parte incompleta: recebidos {position - offset} de {length} bytes.")
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(fd, view, position)
+                    view = view[written:]
+                    position += written
+                remaining -= len(data)
+                if hasher:
+                    hasher.update(data)
+            if hasher and hasher.hexdigest() != chunk_checksum[1]:
+                raise ValueError("Checksum da parte não confere. Reenvie a parte.")
+            getattr(os, 'fdatasync', os.fsync)(fd) # A faixa registrada precisa sobreviver a uma queda
+        finally:
+            os.close(fd)
+        with session.lock:
+            session.add_range(offset, offset + length)
+            session.updated = time.time()
+            self._save(session)
+
+    def finalize(self, session):
+        """Confere e move o arquivo para o destino. ValueError se faltar algo ou o checksum falhar."""
+        with session.lock:
+            if self.get(session.upload_id) is not session:
+                raise ValueError("Sessão de upload já finalizada ou cancelada.")
+            if not session.complete():
+                missing = session.size - session.received_bytes()
+                raise ValueError(f"Upload incompleto: faltam {missing} bytes.")
+            fd = os.open(session.temp_path, os.O_RDONLY)
+            try:
+                if session.checksum:
+                    hasher = hashlib.new(session.checksum[0])
+                    while True:
+                        data = os.read(fd, 1024 * 1024)
+                        if not data:
+                            break
+                        hasher.update(data)
+                    if hasher.hexdigest() != session.checksum[1]:
+                        # Não dá para saber qual parte veio errada: o arquivo precisa ser reenviado
+                        session.received = []
+                        self._save(session)
+                        raise ValueError("Checksum do arquivo não confere. O arquivo será reenviado por completo.")
+            finally:
+                os.close(fd)
+            os.replace(session.temp_path, session.destination)
+            with self._lock:
+                self._discard_locked(session, remove_temp=False)
+        return session.destination
+
+    def discard(self, session):
+        with session.lock, self._lock:
+            self._discard_locked(session)
+
+
+upload_manager = UploadManager(UPLOAD_STATE_DIR)
+
+# --- Download Compactado (File Manager) ---
+# O zip/tar.gz é montado por uma thread produtora com zipfile/tarfile escrevendo num
+# objeto que só repassa os bytes, em blocos, por uma fila limitada; o gerador da resposta
+# consome a fila. Nada vai para o disco e a memória fica em ~FM_ARCHIVE_QUEUE_CHUNKS
+# blocos, qualquer que seja o tamanho da seleção. Se o cliente desconectar, a produtora
+# é cancelada na próxima gravação. Links simbólicos nunca são seguidos (o conteúdo
+# apontado pode estar fora da raiz do site): entram no arquivo como links.
+
+ARCHIVE_FORMATS = {'zip': ('.zip', 'application/zip'), 'tar.gz': ('.tar.gz', 'application/gzip')}
+
+class ArchiveCancelled(Exception):
+    pass
+
+
+class ArchiveStreamWriter:
+    """Arquivo só de escrita que entrega o que recebe em blocos por uma fila limitada."""
+
+    def __init__(self, chunk_size=FM_ARCHIVE_CHUNK_SIZE, max_chunks=FM_ARCHIVE_QUEUE_CHUNKS):
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.cancelled = threading.Event()
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def put(self, item):
+        # Espera o consumidor, mas desiste se a resposta foi abandonada
+        while True:
+            if self.cancelled.is_set():
+                raise ArchiveCancelled()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+
+
+def iter_archive_entries(roots):
+    """
+    (caminho, nome_no_arquivo, lstat) de cada raiz (caminho já sanitizado, nome no arquivo)
+    e, nas pastas, de tudo abaixo delas. os.walk não entra em links simbólicos.
+    """
+    for path, arcroot in roots:
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            print(f"Aviso: '{path}' ignorado no arquivo compactado: {e}")
+            continue
+        yield path, arcroot, st
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        for dirpath, dirnames, filenames in os.walk(path, onerror=lambda e: print(f"Aviso: {e}")):
+            dirnames.sort()
+            relative_dir = os.path.relpath(dirpath, path)
+            for entry_name in dirnames + sorted(filenames):
+                entry_path = os.path.join(dirpath, entry_name)
+                try:
+                    entry_st = os.lstat(entry_path)
+                except OSError:
+                    continue # Removido durante a leitura
+                yield entry_path, os.path.normpath(os.path.join(arcroot, relative_dir, entry_name)), entry_st
+
+
+def write_archive(writer, archive_format, entries, level):
+    """Grava as entradas no formato pedido (executa na thread produtora)."""
+    if archive_format == 'zip':
+        compression = zipfile.ZIP_DEFLATED if level > 0 else zipfile.ZIP_STORED
+        with zipfile.ZipFile(writer, 'w', compression=compression, compresslevel=level or None, allowZip64=True) as zf:
+            for path, arcname, st in entries:
+                try:
+                    if stat.S_ISLNK(st.st_mode):
+                        info = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+                        info.create_system = 3 # Unix: permite gravar o tipo link nos atributos
+                        info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                        zf.writestr(info, os.readlink(path))
+                    elif stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode):
+                        zf.write(path, arcname)
+                except OSError as e:
+                    print(f"Aviso: '{path}' ignorado no arquivo compactado: {e}")
+    else:
+        with gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=level, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for path, arcname, st in entries:
+                    if not (stat.S_ISLNK(st.st_mode) or stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+                        continue # Sockets, FIFOs, dispositivos
+                    try:
+                        if stat.S_ISREG(st.st_mode):
+                            with open(path, 'rb') as f:
+                                tarinfo = tar.gettarinfo(arcname=arcname, fileobj=f)
+                                tar.addfile(tarinfo, f)
+                        else:
+                            tar.add(path, arcname, recursive=False) # lstat: links entram como links
+                    except OSError as e:
+                        print(f"Aviso: '{path}' ignorado no arquivo compactado: {e}")
+    writer.finish()
+
+
+def stream_archive(archive_format, entries, level):
+    """Gerador da resposta: inicia a thread produtora e repassa os blocos da fila."""
+    writer = ArchiveStreamWriter()
+
+    def produce():
+        try:
+            write_archive(writer, archive_format, entries, level)
+            writer.put(None)
+        except ArchiveCancelled:
+            print("Download compactado cancelado pelo cliente.")
+        except Exception as e:
+            print(f"Erro ao gerar o arquivo compactado: {e}")
+            try:
+                writer.put(e)
+            except ArchiveCancelled:
+                pass
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = writer.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                return # A resposta já começou: o arquivo chega truncado (erro no log)
+            yield item
+    finally:
+        writer.cancelled.set()
+
+# --- Tarefas em Background (File Manager) ---
+# Extrair, copiar, mover e excluir rodam num pool limitado de threads: a rota valida o
+# pedido, enfileira a tarefa e responde na hora com o id. O progresso (bytes e itens)
+# fica na própria tarefa, consultada por /api/file_manager/jobs/<id>; os registros vão
+# para o backend de armazenamento nas mudanças de estado. Tarefas na fila só começam
+# se o dono e o site estão abaixo de FILE_JOBS_PER_USER/FILE_JOBS_PER_SITE, então um
+# usuário com várias operações grandes não ocupa todo o disco (nem todos os workers).
+
+FILE_JOB_ACTIVE_STATES = ('queued', 'running')
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobLimitError(Exception):
+    pass
+
+
+class FileJob:
+    """Uma operação do file manager em background. work(job) faz o trabalho e retorna a mensagem final."""
+
+    def __init__(self, kind, username, domain, description, work):
+        self.id = os.urandom(8).hex()
+        self.kind = kind
+        self.username = username
+        self.domain = domain
+        self.description = description
+        self.work = work
+        self.status = 'queued'
+        self.bytes_done = self.bytes_total = 0
+        self.files_done = self.files_total = 0
+        self.message = None
+        self.errors = []
+        self.changed_paths = [] # Diretórios avisados ao file_manager_changed no fim (mesmo se falhar)
+        self.created = time.time()
+        self.started = self.finished = None
+        self.cancel_event = threading.Event()
+        self._progress_lock = threading.Lock() # advance() é chamado por várias threads (ex: extração de zip)
+
+    def set_total(self, bytes_total, files_total):
+        self.bytes_total, self.files_total = bytes_total, files_total
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def advance(self, bytes_done=0, files_done=0):
+        """Soma progresso; também é o ponto onde o cancelamento interrompe o trabalho."""
+        self.check_cancelled()
+        with self._progress_lock:
+            self.bytes_done += bytes_done
+            self.files_done += files_done
+
+    def add_error(self, message):
+        if len(self.errors) < FILE_JOBS_MAX_ERRORS:
+            self.errors.append(message)
+
+    def to_dict(self):
+        return {
+            "id": self.id, "kind": self.kind, "username": self.username, "domain": self.domain,
+            "description": self.description, "status": self.status,
+            "bytes_done": self.bytes_done, "bytes_total": self.bytes_total,
+            "files_done": self.files_done, "files_total": self.files_total,
+            "message": self.message, "errors": self.errors,
+            "created": self.created, "started": self.started, "finished": self.finished,
+        }
+
+
+class FileJobManager:
+    """Fila e pool de workers das tarefas, com limites de concorrência por usuário e por site."""
+
+    def __init__(self, workers, per_user, per_site):
+        self.workers = workers
+        self.per_user = per_user
+        self.per_site = per_site
+        self._cond = threading.Condition()
+        self._pending = []
+        self._jobs = {} # id -> FileJob (ativas e as recentes desta execução)
+        self._running_users = {}
+        self._running_sites = {}
+        self._threads = []
+
+    def _persist(self, job):
+        try:
+            storage.save_job(job.to_dict())
+        except Exception as e:
+            print(f"Aviso: Falha ao gravar o registro da tarefa {job.id}: {e}")
+
+    def _start_locked(self):
+        if self._threads:
+            return
+        # Tarefas ativas registradas por uma execução anterior não vão continuar
+        for record in storage.list_jobs():
+            if record.get('status') in FILE_JOB_ACTIVE_STATES:
+                record.update(status='failed', finished=time.time(), message="Interrompida: o painel foi reiniciado.")
+                storage.save_job(record)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, kind, username, domain, description, work, errors=()):
+        """Enfileira uma tarefa. JobLimitError se o usuário já tem FILE_JOBS_MAX_QUEUED na fila."""
+        job = FileJob(kind, username, domain, description, work)
+        for error in errors: # Erros da validação feita na rota entram no relatório final
+            job.add_error(error)
+        with self._cond:
+            if sum(1 for queued in self._pending if queued.username == username) >= FILE_JOBS_MAX_QUEUED:
+                raise JobLimitError(f"Você já tem {FILE_JOBS_MAX_QUEUED} tarefas na fila. Aguarde algumas terminarem.")
+            self._start_locked()
+            self._pending.append(job)
+            self._jobs[job.id] = job
+            self._cond.notify()
+        self._persist(job)
+        return job
+
+    def _next_locked(self):
+        for job in self._pending:
+            if (self._running_users.get(job.username, 0) < self.per_user and
+                    self._running_sites.get(job.domain, 0) < self.per_site):
+                self._pending.remove(job)
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_locked()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_locked()
+                self._running_users[job.username] = self._running_users.get(job.username, 0) + 1
+                self._running_sites[job.domain] = self._running_sites.get(job.domain, 0) + 1
+                job.status = 'running'
+                job.started = time.time()
+            self._persist(job)
+            try:
+                job.message = job.work(job)
+                job.status = 'done'
+            except JobCancelled:
+                job.status = 'cancelled'
+                job.message = "Tarefa cancelada. O que já foi processado permanece."
+            except Exception as e:
+                job.status = 'failed'
+                job.message = str(e)
+                print(f"Erro na tarefa {job.id} ({job.kind}, site {job.domain}): {e}")
+            finally:
+                job.finished = time.time()
+                job.work = None
+                if job.changed_paths:
+                    file_manager_changed(*job.changed_paths)
+                with self._cond:
+                    self._running_users[job.username] -= 1
+                    self._running_sites[job.domain] -= 1
+                    self._forget_old_locked()
+                    self._cond.notify_all()
+                self._persist(job)
+
+    def _forget_old_locked(self):
+        finished = [job for job in self._jobs.values() if job.status not in FILE_JOB_ACTIVE_STATES]
+        for job in sorted(finished, key=lambda j: j.created)[:max(0, len(finished) - FILE_JOBS_HISTORY)]:
+            del self._jobs[job.id]
+
+    def cancel(self, job_id):
+        """Cancela uma tarefa na fila (na hora) ou em execução (no próximo ponto de progresso)."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.status not in FILE_JOB_ACTIVE_STATES:
+                return False
+            job.cancel_event.set()
+            if job.status != 'queued':
+                return True
+            self._pending.remove(job)
+            job.status = 'cancelled'
+            job.message = "Tarefa cancelada antes de começar."
+            job.finished = time.time()
+            job.work = None
+        self._persist(job)
+        return True
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return next((record for record in storage.list_jobs() if record.get('id') == job_id), None)
+
+    def list(self, username=None, domain=None):
+        """Registros (mais recentes primeiro), os desta execução com o progresso atual."""
+        records = {record['id']: record for record in storage.list_jobs()}
+        records.update((job.id, job.to_dict()) for job in list(self._jobs.values()))
+        return sorted((record for record in records.values()
+                       if (username is None or record.get('username') == username) and
+                          (domain is None or record.get('domain') == domain)),
+                      key=lambda record: record.get('created', 0), reverse=True)
+
+
+file_jobs = FileJobManager(FILE_JOBS_WORKERS, FILE_JOBS_PER_USER, FILE_JOBS_PER_SITE)
+
+def measure_tree(job, path):
+    """(bytes, itens) de um arquivo ou árvore, sem seguir links (total do progresso)."""
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size, 1
+    total_bytes, total_files = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        job.check_cancelled()
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            try:
+                total_bytes += os.lstat(os.path.join(dirpath, name)).st_size
+                total_files += 1
+            except OSError:
+                continue
+    return total_bytes, total_files
+
+def measure_items(job, paths):
+    """Mede cada caminho (itens que sumiram contam zero) e define o total da tarefa."""
+    sizes = []
+    for path in paths:
+        try:
+            sizes.append(measure_tree(job, path))
+        except OSError:
+            sizes.append((0, 0))
+    job.set_total(sum(size[0] for size in sizes), sum(size[1] for size in sizes))
+    return sizes
+
+def remove_tree(job, path):
+    """Remove um arquivo, link ou árvore inteira, contando o progresso por arquivo."""
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(path)
+        job.advance(st.st_size, 1)
+        return
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            size = os.lstat(file_path).st_size
+            os.unlink(file_path)
+            job.advance(size, 1)
+        for name in dirnames:
+            dir_path = os.path.join(dirpath, name)
+            if os.path.islink(dir_path): # os.walk não entra em links para pastas
+                os.unlink(dir_path)
+                job.advance(0, 1)
+            else:
+                os.rmdir(dir_path)
+    os.rmdir(path)
 
-    return full_path
+def job_response(job):
+    """Resposta das rotas que enfileiram tarefas (202: o trabalho continua em background)."""
+    return jsonify({"success": True, "job_id": job.id, "job": job.to_dict(),
+                    "message": f"{job.description}: tarefa iniciada."}), 202
 
 # --- Rota Principal do File Manager ---
 
@@ -1533,12 +6506,31 @@ def file_manager_page(site_domain):
 @app.route('/api/file_manager/list', methods=['GET'])
 @login_required
 def api_fm_list():
+    """
+    Lista um diretório em páginas: sort=name|size|mtime, order=asc|desc, filter=<trecho do nome>,
+    limit=N e cursor=<next_cursor da página anterior>. A resposta JSON é enviada em stream.
+    Listagens repetidas saem do cache em memória; com If-None-Match igual ao ETag a resposta é 304.
+    """
     domain = request.args.get('domain')
     relative_path = request.args.get('path', '')
     folders_only = request.args.get('folders_only', 'false').lower() == 'true'
+    sort = request.args.get('sort', 'name')
+    descending = request.args.get('order', 'asc').lower() == 'desc'
+    name_filter = request.args.get('filter', '')
 
     if not domain:
         return jsonify({"success": False, "error": "Parâmetro 'domain' ausente."}), 400
+    if sort not in LIST_SORT_KEYS:
+        return jsonify({"success": False, "error": f"Ordenação inválida. Use: {', '.join(LIST_SORT_KEYS)}."}), 400
+    try:
+        limit = min(max(1, int(request.args.get('limit', FM_LIST_PAGE_SIZE))), FM_LIST_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"success": False, "error": "Parâmetro 'limit' inválido."}), 400
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decode_list_cursor(request.args['cursor'], sort)
+        if cursor is None:
+            return jsonify({"success": False, "error": "Cursor de paginação inválido."}), 400
 
     if not check_file_manager_permission(domain):
         return jsonify({"success": False, "error": "Permissão negada."}), 403
@@ -1553,32 +6545,24 @@ def api_fm_list():
     if not os.path.isdir(target_path):
          return jsonify({"success": False, "error": f"Diretório não encontrado: {relative_path}"}), 404
 
+    start_disk_indexer()
 
     try:
-        # TODO: Adicionar tratamento de erro de permissão aqui
-        items = []
-        for item_name in os.listdir(target_path):
-            item_path = os.path.join(target_path, item_name)
-            try: # Tenta obter informações, pula se não tiver permissão
-                stat_info = os.stat(item_path)
-                is_dir = os.path.isdir(item_path)
-
-                if folders_only and not is_dir:
-                    continue # Pula arquivos se pedimos apenas pastas
-
-                items.append({
-                    "name": item_name,
-                    "is_dir": is_dir,
-                    "size": stat_info.st_size if not is_dir else None,
-                    "modified": stat_info.st_mtime
-                })
-            except OSError as e:
-                print(f"Erro ao acessar item '{item_path}': {e}. Pulando.")
-                # Opcional: Adicionar um item indicando erro de permissão
-                # items.append({"name": item_name, "is_dir": False, "error": "Permission Denied"})
-                continue # Pula este item
-
-        return jsonify({"success": True, "files": items, "path": relative_path})
+        listing = listing_cache.get(target_path)
+        # ETag: leitura do diretório + versão do índice de disco (tamanho das pastas) + parâmetros
+        params = '\0'.join((relative_path, sort, str(descending), name_filter, str(folders_only),
+                             request.args.get('cursor', ''), str(limit)))
+        etag = f'{listing.version:x}-{disk_index.version:x}-{zlib.crc32(params.encode()):x}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            page, total, next_cursor = list_directory_page(listing, sort, descending, name_filter,
+                                                           folders_only, cursor, limit)
+            response = Response(stream_directory_listing(listing, relative_path, page, total, next_cursor),
+                                mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache' # Sempre revalida (If-None-Match)
+        return response
 
     except FileNotFoundError:
          return jsonify({"success": False, "error": f"Diretório não encontrado: {relative_path}"}), 404
@@ -1591,6 +6575,64 @@ def api_fm_list():
         return jsonify({"success": False, "error": f"Erro inesperado ao listar arquivos: {e}"}), 500
 
 
+@app.route('/api/file_manager/search', methods=['GET'])
+@login_required
+def api_fm_search():
+    """
+    Busca recursiva a partir de 'path': name=<padrão> (name_mode=glob|regex), content=<texto>
+    (content_mode=text|regex), type=all|file|dir, case=true (diferencia maiúsculas),
+    limit=N e timeout=<segundos>. Resposta em NDJSON: um resultado por linha e o resumo no fim.
+    """
+    domain = request.args.get('domain')
+    relative_path = request.args.get('path', '')
+    name_pattern = request.args.get('name', '')
+    content = request.args.get('content', '')
+    name_mode = request.args.get('name_mode', 'glob')
+    content_mode = request.args.get('content_mode', 'text')
+    item_type = request.args.get('type', 'all')
+    ignore_case = request.args.get('case', 'false').lower() != 'true'
+
+    if not domain:
+        return jsonify({"success": False, "error": "Parâmetro 'domain' ausente."}), 400
+    if not name_pattern and not content:
+        return jsonify({"success": False, "error": "Informe 'name' e/ou 'content'."}), 400
+    if name_mode not in SEARCH_NAME_MODES or content_mode not in SEARCH_CONTENT_MODES or item_type not in SEARCH_TYPES:
+        return jsonify({"success": False, "error": "Parâmetros 'name_mode', 'content_mode' ou 'type' inválidos."}), 400
+    try:
+        limit = min(max(1, int(request.args.get('limit', FM_SEARCH_MAX_RESULTS))), FM_SEARCH_MAX_RESULTS)
+        time_limit = min(max(0.1, float(request.args.get('timeout', FM_SEARCH_TIME_LIMIT))), FM_SEARCH_TIME_LIMIT)
+    except ValueError:
+        return jsonify({"success": False, "error": "Parâmetros 'limit' ou 'timeout' inválidos."}), 400
+    try:
+        name_match = compile_name_matcher(name_pattern, name_mode, ignore_case) if name_pattern else None
+        content_pattern = compile_content_pattern(content, content_mode, ignore_case) if content else None
+    except re.error as e:
+        return jsonify({"success": False, "error": f"Expressão regular inválida: {e}"}), 400
+
+    if not check_file_manager_permission(domain):
+        return jsonify({"success": False, "error": "Permissão negada."}), 403
+
+    base_path = get_site_base_path(domain)
+    if not base_path:
+        return jsonify({"success": False, "error": f"Caminho base não encontrado ou inválido para o site '{domain}'."}), 404
+
+    start_path = sanitize_path(base_path, relative_path)
+    if not start_path or not os.path.isdir(start_path):
+        return jsonify({"success": False, "error": f"Diretório não encontrado: {relative_path}"}), 404
+
+    start_disk_indexer()
+    search = search_files_isolated if search_needs_isolation(name_mode, content_mode, name_pattern, content) else search_files
+
+    def generate():
+        for item in search(base_path, start_path, name_match, content_pattern, item_type, limit, time_limit):
+            yield json.dumps(item, separators=(',', ':')) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx: envia cada resultado assim que sai
+    return response
+
+
 @app.route('/api/file_manager/upload', methods=['POST'])
 @login_required
 def api_fm_upload():
@@ -1660,6 +6702,9 @@ def api_fm_upload():
              print(error_msg)
              errors.append(error_msg)
 
+    if uploaded_files:
+        file_manager_changed(target_path) # Arquivos sobrescritos não mudam o mtime da pasta
+
     if not errors:
          return jsonify({"success": True, "message": f"{len(uploaded_files)} arquivo(s) enviados com sucesso."})
     else:
@@ -1671,6 +6716,400 @@ def api_fm_upload():
          }), 207 # Multi-Status (indica sucesso parcial)
 
 
+def get_upload_session(upload_id):
+    """Sessão de upload do usuário logado (admin vê todas). Retorna (sessão, resposta_de_erro)."""
+    upload = upload_manager.get(upload_id)
+    current_user = session.get('username')
+    if upload is None or (upload.username != current_user and current_user != 'cico'):
+        return None, (jsonify({"success": False, "error": "Sessão de upload não encontrada ou expirada."}), 404)
+    if not check_file_manager_permission(upload.domain):
+        return None, (jsonify({"success": False, "error": "Permissão negada."}), 403)
+    return upload, None
+
+@app.route('/api/file_manager/upload/init', methods=['POST'])
+@login_required
+def api_fm_upload_init():
+    """
+    Inicia (ou retoma) um upload em partes. JSON: domain, path, filename, size e checksum
+    opcional ('sha256:<hex>'). A resposta traz upload_id, chunk_size e as faixas já recebidas.
+    """
+    data = request.json or {}
+    domain = data.get('domain')
+    relative_path = data.get('path', '')
+    filename = os.path.basename(str(data.get('filename') or '')) # Remove barras
+    size = data.get('size')
+
+    if not domain or not filename or filename in ('.', '..') or '\0' in filename:
+        return jsonify({"success": False, "error": "Parâmetros 'domain' e 'filename' são obrigatórios e válidos."}), 400
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return jsonify({"success": False, "error": "Parâmetro 'size' inválido."}), 400
+    if size > FM_UPLOAD_MAX_SIZE:
+        return jsonify({"success": False, "error": f"Arquivo maior que o limite de {FM_UPLOAD_MAX_SIZE} bytes."}), 413
+    try:
+        checksum = parse_upload_checksum(data.get('checksum'))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    if not check_file_manager_permission(domain):
+        return jsonify({"success": False, "error": "Permissão negada."}), 403
+
+    base_path = get_site_base_path(domain)
+    if not base_path:
+        return jsonify({"success": False, "error": f"Caminho base não encontrado ou inválido para o site '{domain}'."}), 404
+
+    target_path = sanitize_path(base_path, relative_path)
+    if not target_path or not os.path.isdir(target_path):
+        return jsonify({"success": False, "error": "Caminho de destino inválido ou não é um diretório."}), 400
+    if not os.access(target_path, os.W_OK):
+        return jsonify({"success": False, "error": f"Sem permissão de escrita no diretório de destino: '{relative_path}'. Verifique as permissões no servidor."}), 403
+    if os.path.isdir(os.path.join(target_path, filename)):
+        return jsonify({"success": False, "error": f"Já existe uma pasta chamada '{filename}' no destino."}), 409
+
+    try:
+        upload, resumed = upload_manager.create(session.get('username'), domain, target_path, filename, size, checksum)
+        if not resumed and shutil.disk_usage(target_path).free < size: # Arquivo esparso: ainda não ocupa espaço
+            upload_manager.discard(upload)
+            return jsonify({"success": False, "error": "Espaço em disco insuficiente para o arquivo."}), 507
+    except OSError as e:
+        print(f"Erro ao iniciar upload de '{filename}' em '{target_path}': {e}")
+        return jsonify({"success": False, "error": f"Erro ao iniciar o upload: {e}"}), 500
+
+    return jsonify({"success": True, "resumed": resumed, **upload.status()})
+
+@app.route('/api/file_manager/upload/<upload_id>', methods=['PUT'])
+@login_required
+def api_fm_upload_chunk(upload_id):
+    """
+    Recebe uma parte no corpo bruto da requisição: ?offset=N, Content-Length obrigatório e
+    cabeçalho X-Chunk-Checksum opcional ('sha256:<hex>' da parte).
+    """
+    upload, error = get_upload_session(upload_id)
+    if error:
+        return error
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return jsonify({"success": False, "error": "Parâmetro 'offset' inválido."}), 400
+    try:
+        chunk_checksum = parse_upload_checksum(request.headers.get('X-Chunk-Checksum'))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    length = request.content_length
+    if length is None:
+        return jsonify({"success": False, "error": "Content-Length obrigatório."}), 411
+    if length > FM_UPLOAD_MAX_CHUNK_SIZE:
+        return jsonify({"success": False, "error": f"Parte maior que o limite de {FM_UPLOAD_MAX_CHUNK_SIZE} bytes."}), 413
+    if offset < 0 or offset + length > upload.size:
+        return jsonify({"success": False, "error": "Parte fora dos limites do arquivo."}), 416
+
+    try:
+        upload_manager.write_chunk(upload, offset, request.stream, length, chunk_checksum)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 422
+    except FileNotFoundError:
+        return jsonify({"success": False, "error": "Arquivo temporário do upload não existe mais. Inicie o envio novamente."}), 410
+    except OSError as e:
+        print(f"Erro ao gravar parte do upload {upload_id} (offset {offset}): {e}")
+        return jsonify({"success": False, "error": f"Erro ao gravar a parte: {e}"}), 500
+    return jsonify({"success": True, "received_bytes": upload.received_bytes()})
+
+@app.route('/api/file_manager/upload/<upload_id>', methods=['GET'])
+@login_required
+def api_fm_upload_status(upload_id):
+    upload, error = get_upload_session(upload_id)
+    if error:
+        return error
+    return jsonify({"success": True, **upload.status()})
+
+@app.route('/api/file_manager/upload/<upload_id>/finalize', methods=['POST'])
+@login_required
+def api_fm_upload_finalize(upload_id):
+    upload, error = get_upload_session(upload_id)
+    if error:
+        return error
+    try:
+        upload_manager.finalize(upload)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e), **upload.status()}), 409
+    except OSError as e:
+        print(f"Erro ao finalizar o upload {upload_id} ('{upload.filename}'): {e}")
+        return jsonify({"success": False, "error": f"Erro ao finalizar o upload: {e}"}), 500
+    print(f"Arquivo '{upload.filename}' ({upload.size} bytes) salvo com sucesso em '{upload.destination}'.")
+    file_manager_changed(upload.target_dir)
+    return jsonify({"success": True, "message": f"Arquivo '{upload.filename}' enviado com sucesso."})
+
+@app.route('/api/file_manager/upload/<upload_id>', methods=['DELETE'])
+@login_required
+def api_fm_upload_cancel(upload_id):
+    upload, error = get_upload_session(upload_id)
+    if error:
+        return error
+    upload_manager.discard(upload)
+    file_manager_changed(upload.target_dir)
+    return jsonify({"success": True, "message": "Upload cancelado."})
+
+
+@app.route('/api/file_manager/download', methods=['GET'])
+@login_required
+def api_fm_download():
+    """
+    Baixa um arquivo (?domain=...&path=...). Suporta Range e ETag/Last-Modified (retomada
+    e 304). O envio usa o wsgi.file_wrapper do servidor (sendfile no gunicorn/uWSGI); com
+    FM_DOWNLOAD_ACCEL_PREFIX definido, o nginx envia o arquivo (X-Accel-Redirect) e o
+    worker do Flask fica livre na hora.
+    """
+    domain = request.args.get('domain')
+    relative_path = request.args.get('path', '')
+
+    if not domain or not relative_path:
+        return jsonify({"success": False, "error": "Parâmetros 'domain' e 'path' são obrigatórios."}), 400
+
+    if not check_file_manager_permission(domain):
+        return jsonify({"success": False, "error": "Permissão negada."}), 403
+
+    base_path = get_site_base_path(domain)
+    if not base_path:
+        return jsonify({"success": False, "error": f"Caminho base não encontrado ou inválido para o site '{domain}'."}), 404
+
+    target_path = sanitize_path(base_path, relative_path)
+    if not target_path:
+        return jsonify({"success": False, "error": "Caminho inválido ou acesso negado."}), 400
+    if not os.path.isfile(target_path):
+        return jsonify({"success": False, "error": f"Arquivo não encontrado: {relative_path}"}), 404
+    if not os.access(target_path, os.R_OK):
+        return jsonify({"success": False, "error": f"Sem permissão de leitura no arquivo: {relative_path}"}), 403
+
+    filename = os.path.basename(target_path)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    if FM_DOWNLOAD_ACCEL_PREFIX:
+        # O nginx trata Range, ETag e o envio; aqui só autorizamos e indicamos o arquivo
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = FM_DOWNLOAD_ACCEL_PREFIX.rstrip('/') + requests.utils.quote(target_path)
+        response.headers['Content-Disposition'] = "attachment; filename*=UTF-8''" + requests.utils.quote(filename, safe='')
+    else:
+        try:
+            response = send_file(target_path, mimetype=mimetype, as_attachment=True, download_name=filename,
+                                 conditional=True, etag=True, max_age=None)
+        except OSError as e:
+            print(f"Erro ao abrir '{target_path}' para download: {e}")
+            return jsonify({"success": False, "error": f"Erro ao abrir o arquivo: {e}"}), 500
+    response.headers['Cache-Control'] = 'private, no-cache' # Revalida com If-None-Match/If-Modified-Since
+    return response
+
+
+def resolve_site_file(domain, relative_path):
+    """(caminho absoluto, None) ou (None, resposta de erro) para um arquivo do site."""
+    if not domain or not relative_path:
+        return None, (jsonify({"success": False, "error": "Parâmetros 'domain' e 'path' são obrigatórios."}), 400)
+    if not check_file_manager_permission(domain):
+        return None, (jsonify({"success": False, "error": "Permissão negada."}), 403)
+    base_path = get_site_base_path(domain)
+    if not base_path:
+        return None, (jsonify({"success": False, "error": f"Caminho base não encontrado ou inválido para o site '{domain}'."}), 404)
+    target_path = sanitize_path(base_path, relative_path)
+    if not target_path:
+        return None, (jsonify({"success": False, "error": "Caminho inválido ou acesso negado."}), 400)
+    # Links são seguidos (lê/grava o destino), desde que continuem dentro do site
+    real_base = os.path.realpath(base_path)
+    real_path = os.path.realpath(target_path)
+    if os.path.commonpath([real_base, real_path]) != real_base:
+        return None, (jsonify({"success": False, "error": "O arquivo aponta para fora do site."}), 403)
+    return real_path, None
+
+@app.route('/api/file_manager/file', methods=['GET'])
+@login_required
+def api_fm_file_read():
+    """
+    Lê um arquivo (?domain=...&path=...) em faixas: offset/length em bytes, line/count (linhas a
+    partir de 1) ou tail=N (últimas N linhas). Sem faixa: o início do arquivo, até
+    FM_VIEW_MAX_BYTES. O ETag identifica a versão e é usado como precondição ao salvar.
+    """
+    target_path, error = resolve_site_file(request.args.get('domain'), request.args.get('path', ''))
+    if error:
+        return error
+    relative_path = request.args.get('path', '')
+    if not os.path.isfile(target_path):
+        return jsonify({"success": False, "error": f"Arquivo não encontrado: {relative_path}"}), 404
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        length = max(1, int(request.args['length'])) if request.args.get('length') else None
+        start_line = max(1, int(request.args['line'])) if request.args.get('line') else None
+        line_count = min(max(1, int(request.args.get('count', FM_VIEW_MAX_LINES))), FM_VIEW_MAX_LINES)
+        tail_lines = min(max(1, int(request.args['tail'])), FM_VIEW_MAX_LINES) if request.args.get('tail') else None
+    except ValueError:
+        return jsonify({"success": False, "error": "Parâmetros de faixa inválidos."}), 400
+
+    try:
+        st = os.stat(target_path)
+        etag = file_etag(st)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            st, start, end, data = read_file_range(target_path, offset, length, start_line, line_count, tail_lines)
+            etag = file_etag(st)
+            binary = b'\0' in data[:8192]
+            complete = start == 0 and end == st.st_size
+            content, utf8 = None, False
+            if not binary:
+                try:
+                    content, utf8 = data.decode('utf-8'), True
+                except UnicodeDecodeError:
+                    content = data.decode('utf-8', 'replace') # Só para exibir: salvar isso corromperia o arquivo
+            response = jsonify({
+                "success": True, "path": relative_path, "size": st.st_size, "modified": st.st_mtime,
+                "etag": etag, "start": start, "end": end, "binary": binary, "complete": complete,
+                "editable": complete and utf8, # Arquivo inteiro e em UTF-8 válido
+                "content": content,
+            })
+    except PermissionError:
+        return jsonify({"success": False, "error": f"Sem permissão de leitura no arquivo: {relative_path}"}), 403
+    except OSError as e:
+        print(f"Erro ao ler '{target_path}': {e}")
+        return jsonify({"success": False, "error": f"Erro ao ler o arquivo: {e}"}), 500
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/file_manager/file', methods=['PUT'])
+@login_required
+def api_fm_file_write():
+    """
+    Salva um arquivo: JSON {domain, path, content, etag | mtime} (ou o cabeçalho If-Match).
+    Sem precondição a resposta é 428; se o arquivo mudou, 412 com o ETag atual.
+    {create: true} cria um arquivo novo (409 se já existe).
+    """
+    data = request.json or {}
+    relative_path = data.get('path', '')
+    target_path, error = resolve_site_file(data.get('domain'), relative_path)
+    if error:
+        return error
+    content = data.get('content')
+    if not isinstance(content, str):
+        return jsonify({"success": False, "error": "Parâmetro 'content' (texto) é obrigatório."}), 400
+    encoded = content.encode('utf-8')
+    if len(encoded) > FM_EDITOR_MAX_SIZE:
+        return jsonify({"success": False, "error": f"Conteúdo maior que o limite do editor ({FM_EDITOR_MAX_SIZE} bytes)."}), 413
+    create = bool(data.get('create'))
+    expected_etag = data.get('etag') or (request.if_match.as_set().pop() if len(request.if_match.as_set()) == 1 else None)
+    expected_mtime = data.get('mtime')
+    if not create and expected_etag is None and expected_mtime is None:
+        return jsonify({"success": False, "error": "Informe o 'etag' (ou 'mtime') da versão aberta para salvar."}), 428
+
+    real_path = target_path # resolve_site_file já resolveu os links
+    if os.path.isdir(real_path):
+        return jsonify({"success": False, "error": "O caminho é um diretório."}), 400
+
+    try:
+        st = write_file_atomic(real_path, encoded, expected_etag, expected_mtime, create)
+    except EditConflict as e:
+        response = jsonify({"success": False, "error": str(e), "etag": file_etag(e.st), "modified": e.st.st_mtime})
+        response.status_code = 412
+        return response
+    except FileExistsError:
+        return jsonify({"success": False, "error": f"Já existe um item chamado '{os.path.basename(target_path)}'."}), 409
+    except FileNotFoundError:
+        return jsonify({"success": False, "error": f"Arquivo ou pasta não encontrado: {relative_path}"}), 404
+    except PermissionError:
+        return jsonify({"success": False, "error": f"Sem permissão de escrita em: {relative_path}"}), 403
+    except OSError as e:
+        print(f"Erro ao salvar '{real_path}': {e}")
+        return jsonify({"success": False, "error": f"Erro ao salvar o arquivo: {e}"}), 500
+    file_manager_changed(os.path.dirname(real_path))
+    print(f"Arquivo '{real_path}' salvo pelo editor ({len(encoded)} bytes).")
+    response = jsonify({"success": True, "message": "Arquivo salvo.", "etag": file_etag(st),
+                        "size": st.st_size, "modified": st.st_mtime})
+    response.set_etag(file_etag(st))
+    return response
+
+@app.route('/api/file_manager/file/follow', methods=['GET'])
+@login_required
+def api_fm_file_follow():
+    """Segue um arquivo (tail -f) a partir de ?offset= (padrão: o fim atual). Resposta em NDJSON."""
+    target_path, error = resolve_site_file(request.args.get('domain'), request.args.get('path', ''))
+    if error:
+        return error
+    if not os.path.isfile(target_path):
+        return jsonify({"success": False, "error": f"Arquivo não encontrado: {request.args.get('path', '')}"}), 404
+    try:
+        size = os.path.getsize(target_path)
+        offset = min(max(0, int(request.args.get('offset', size))), size)
+    except ValueError:
+        return jsonify({"success": False, "error": "Parâmetro 'offset' inválido."}), 400
+    except OSError as e:
+        return jsonify({"success": False, "error": f"Erro ao abrir o arquivo: {e}"}), 500
+    if not os.access(target_path, os.R_OK):
+        return jsonify({"success": False, "error": "Sem permissão de leitura no arquivo."}), 403
+
+    def generate():
+        for event in follow_file(target_path, offset, FM_TAIL_MAX_DURATION):
+            yield json.dumps(event, separators=(',', ':')) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx: envia cada bloco assim que sai
+    return response
+
+
+@app.route('/api/file_manager/archive', methods=['GET', 'POST'])
+@login_required
+def api_fm_archive():
+    """
+    Baixa itens compactados, gerados durante o envio: domain, path (pasta atual), items
+    (repetível; vazio = a pasta atual inteira), format=zip|tar.gz e level=0-9.
+    """
+    domain = request.values.get('domain')
+    relative_path = request.values.get('path', '')
+    items = [item for item in request.values.getlist('items') if item]
+    archive_format = request.values.get('format', 'zip')
+
+    if not domain:
+        return jsonify({"success": False, "error": "Parâmetro 'domain' ausente."}), 400
+    if archive_format not in ARCHIVE_FORMATS:
+        return jsonify({"success": False, "error": f"Formato inválido. Use: {', '.join(ARCHIVE_FORMATS)}."}), 400
+    try:
+        level = int(request.values.get('level', FM_ARCHIVE_COMPRESSION_LEVEL))
+        if not 0 <= level <= 9:
+            raise ValueError
+    except ValueError:
+        return jsonify({"success": False, "error": "Parâmetro 'level' inválido (0 a 9)."}), 400
+
+    if not check_file_manager_permission(domain):
+        return jsonify({"success": False, "error": "Permissão negada."}), 403
+
+    base_path = get_site_base_path(domain)
+    if not base_path:
+        return jsonify({"success": False, "error": f"Caminho base não encontrado ou inválido para o site '{domain}'."}), 404
+
+    target_path = sanitize_path(base_path, relative_path)
+    if not target_path or not os.path.isdir(target_path):
+        return jsonify({"success": False, "error": "Caminho inválido ou não é um diretório."}), 400
+
+    roots = []
+    for item in items:
+        name = os.path.basename(item.rstrip('/'))
+        if name in ('', '.', '..'):
+            return jsonify({"success": False, "error": f"Item inválido: '{item}'."}), 400
+        # Como em excluir/renomear: sem resolver links (um link para fora do site entra como link)
+        item_path = os.path.join(target_path, name)
+        if not os.path.lexists(item_path):
+            return jsonify({"success": False, "error": f"Item não encontrado: '{name}'."}), 404
+        roots.append((item_path, os.path.basename(item_path)))
+    # Sem itens: a pasta atual inteira (na raiz, com o nome do domínio)
+    folder_name = os.path.basename(target_path) if relative_path.strip('/') else domain
+    roots = roots or [(target_path, folder_name)]
+
+    extension, mimetype = ARCHIVE_FORMATS[archive_format]
+    archive_name = (roots[0][1] if len(roots) == 1 else folder_name) + extension
+
+    entries = iter_archive_entries(roots)
+    response = Response(stream_archive(archive_format, entries, level), mimetype=mimetype)
+    response.headers['Content-Disposition'] = "attachment; filename*=UTF-8''" + requests.utils.quote(archive_name, safe='')
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx: repassa os blocos sem acumular a resposta
+    return response
+
+
 @app.route('/api/file_manager/create_folder', methods=['POST'])
 @login_required
 def api_fm_create_folder():
@@ -1710,6 +7149,7 @@ def api_fm_create_folder():
 
     try:
         os.makedirs(new_folder_path) # Cria a pasta
+        file_manager_changed(parent_dir_path)
         print(f"Pasta '{safe_folder_name}' criada com sucesso em '{parent_dir_path}'.")
         # Opcional: Ajustar permissões da pasta recém-criada
         # os.chmod(new_folder_path, 0o755) # Exemplo: drwxr-xr-x
@@ -1783,6 +7223,7 @@ def api_fm_rename():
 
     try:
         os.rename(old_item_path, new_item_path)
+        file_manager_changed(parent_dir_path)
         print(f"Item '{safe_old_name}' renomeado para '{safe_new_name}' em '{parent_dir_path}'.")
         return jsonify({"success": True, "message": "Item renomeado com sucesso."})
     except OSError as e:
@@ -1820,8 +7261,8 @@ def api_fm_delete():
          print(f"Erro de permissão: Sem permissão de escrita no diretório pai '{parent_dir_path}' para excluir itens.")
          return jsonify({"success": False, "error": f"Sem permissão para excluir itens em: '{relative_path}'. Verifique as permissões no servidor."}), 403
 
-    deleted_items = []
     errors = []
+    targets = []
 
     for item_name in items_to_delete:
         safe_item_name = os.path.basename(item_name)
@@ -1831,58 +7272,227 @@ def api_fm_delete():
 
         item_path = os.path.join(parent_dir_path, safe_item_name)
 
-        if not os.path.exists(item_path):
+        if not os.path.lexists(item_path):
             # Pode já ter sido deletado ou nome inválido
             print(f"Item a ser deletado não encontrado: '{item_path}'. Pulando.")
-            # errors.append(f"Item '{safe_item_name}' não encontrado.") # Opcional: reportar como erro
             continue
+        targets.append((safe_item_name, item_path))
+
+    if not targets:
+        return jsonify({"success": False, "error": "Nenhum item válido para excluir.", "errors": errors}), 400
 
+    def work(job):
+        job.changed_paths.append(parent_dir_path)
+        measure_items(job, [item_path for _, item_path in targets])
+        deleted_items = []
+        for safe_item_name, item_path in targets:
+            try:
+                remove_tree(job, item_path) # Arquivo, link ou diretório com todo o conteúdo
+                print(f"Item '{safe_item_name}' removido com sucesso de '{parent_dir_path}'.")
+                deleted_items.append(safe_item_name)
+            except OSError as e:
+                error_msg = f"Erro ao excluir '{safe_item_name}': {e}"
+                print(error_msg)
+                job.add_error(error_msg)
+        if not job.errors:
+            return f"{len(deleted_items)} item(ns) excluído(s) com sucesso."
+        return f"{len(deleted_items)} item(ns) excluído(s). {len(job.errors)} erro(s) ocorreram."
+
+    try:
+        job = file_jobs.submit('delete', session.get('username'), domain, f"Excluindo {len(targets)} item(ns)", work, errors)
+    except JobLimitError as e:
+        return jsonify({"success": False, "error": str(e)}), 429
+    return job_response(job)
+
+# --- Motor de Cópia (File Manager) ---
+# Copia os dados sem passar por buffers em Python sempre que o kernel deixa:
+# 1. reflink (ioctl FICLONE): em Btrfs/XFS o arquivo novo compartilha os blocos do original,
+#    então a cópia é instantânea seja qual for o tamanho;
+# 2. os.copy_file_range: a cópia é feita dentro do kernel (e no NFS/CIFS, pelo servidor);
+# 3. read/write em blocos, para os demais casos.
+# Os pares (origem, destino) de sistemas de arquivos que recusam (1) ou (2) ficam memorizados
+# por st_dev, para não repetir a tentativa em cada arquivo; EXDEV (cópia entre sistemas de
+# arquivos) não é memorizado, pois só diz respeito àquela cópia. Numa árvore, as pastas e os links são criados na
+# ordem do percurso, e os arquivos vão para um pool de FM_COPY_WORKERS threads (que é o
+# que acelera as pastas com milhares de arquivos pequenos). Os metadados (modo, datas,
+# xattrs e, se o painel roda como root, o dono) são preservados. Os metadados das pastas
+# são aplicados no fim.
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int) em linux/fs.h
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.ETXTBSY}
+_reflink_unsupported = set() # (st_dev da origem, st_dev do destino) onde o FICLONE falhou
+_copy_range_unsupported = set() # (st_dev da origem, st_dev do destino) onde o copy_file_range falhou
+
+def copy_file_data(src_fd, dst_fd, size, devices, progress):
+    """Copia 'size' bytes de src_fd para dst_fd (reflink, copy_file_range ou read/write)."""
+    if fcntl is not None and devices not in _reflink_unsupported and size:
         try:
-            if os.path.isdir(item_path):
-                shutil.rmtree(item_path) # Remove diretório e conteúdo recursivamente
-                print(f"Diretório '{safe_item_name}' removido com sucesso de '{parent_dir_path}'.")
-            else:
-                os.remove(item_path) # Remove arquivo
-                print(f"Arquivo '{safe_item_name}' removido com sucesso de '{parent_dir_path}'.")
-            deleted_items.append(safe_item_name)
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            progress(size)
+            return
         except OSError as e:
-             error_msg = f"Erro ao excluir '{safe_item_name}': {e}"
-             print(error_msg)
-             errors.append(error_msg)
-        except Exception as e:
-            error_msg = f"Erro inesperado ao excluir '{safe_item_name}': {e}"
-            print(error_msg)
-            errors.append(error_msg)
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+            if e.errno != errno.EXDEV:
+                _reflink_unsupported.add(devices)
+    copied = 0
+    if hasattr(os, 'copy_file_range') and devices not in _copy_range_unsupported:
+        try:
+            while True:
+                count = os.copy_file_range(src_fd, dst_fd, FM_COPY_CHUNK_SIZE)
+                if not count:
+                    return
+                copied += count
+                progress(count)
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS or copied:
+                raise
+            if e.errno != errno.EXDEV:
+                _copy_range_unsupported.add(devices)
+    while True:
+        data = os.read(src_fd, FM_COPY_BUFFER_SIZE)
+        if not data:
+            return
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        progress(len(data))
+
+def copy_metadata(src, dst, st):
+    """Modo, datas e xattrs (shutil.copystat); o dono só quando o painel roda como root."""
+    shutil.copystat(src, dst, follow_symlinks=False)
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+
+def copy_file(src, dst, st, job=None):
+    """Copia um arquivo regular (dados e metadados)."""
+    progress = (lambda count: job.advance(count)) if job else (lambda count: None)
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            copy_file_data(src_fd, dst_fd, st.st_size, (st.st_dev, os.fstat(dst_fd).st_dev), progress)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    copy_metadata(src, dst, st)
+    if job:
+        job.advance(0, 1)
+
+def copy_symlink(src, dst, st, job=None):
+    if os.path.lexists(dst) and not os.path.isdir(dst):
+        os.unlink(dst)
+    os.symlink(os.readlink(src), dst)
+    copy_metadata(src, dst, st)
+    if job:
+        job.advance(st.st_size, 1)
+
+def copy_tree(src, dst, job=None):
+    """
+    Copia um arquivo, link ou árvore (links são copiados como links: o conteúdo apontado
+    pode estar fora do site). O destino pode já existir. Erros em arquivos individuais
+    não interrompem a cópia e são levantados juntos no fim, como no shutil.copytree.
+    """
+    st = os.lstat(src)
+    if stat.S_ISLNK(st.st_mode):
+        copy_symlink(src, dst, st, job)
+        return
+    if not stat.S_ISDIR(st.st_mode):
+        copy_file(src, dst, st, job)
+        return
 
+    errors = []
+    directories = []
+    pending = threading.BoundedSemaphore(FM_COPY_WORKERS * 64) # Limita os arquivos na fila do pool
+    failure = [] # JobCancelled (ou outra exceção fatal) vinda de um worker
 
-    if not errors:
-         return jsonify({"success": True, "message": f"{len(deleted_items)} item(ns) excluído(s) com sucesso."})
-    else:
-         return jsonify({
-            "success": len(deleted_items) > 0, # Sucesso parcial se algum foi deletado
-            "message": f"{len(deleted_items)} item(ns) excluído(s). {len(errors)} erro(s) ocorreram.",
-            "deleted": deleted_items,
-            "errors": errors
-         }), 207 # Multi-Status
+    def copy_one(file_src, file_dst, file_st):
+        try:
+            if not failure:
+                copy_file(file_src, file_dst, file_st, job)
+        except JobCancelled as e:
+            failure.append(e)
+        except OSError as e:
+            errors.append((file_src, file_dst, str(e)))
+        finally:
+            pending.release()
+
+    with ThreadPoolExecutor(max_workers=FM_COPY_WORKERS) as pool:
+        stack = [(src, dst, st)]
+        while stack and not failure:
+            dir_src, dir_dst, dir_st = stack.pop()
+            if job:
+                job.check_cancelled()
+            try:
+                # Lista a origem antes de criar o destino: copiando uma pasta para dentro dela
+                # mesma, a cópia nova não aparece na listagem (senão seria copiada de novo, sem fim)
+                entries = list(os.scandir(dir_src))
+                os.makedirs(dir_dst, exist_ok=True)
+            except OSError as e:
+                errors.append((dir_src, dir_dst, str(e)))
+                continue
+            directories.append((dir_src, dir_dst, dir_st))
+            for entry in entries:
+                entry_dst = os.path.join(dir_dst, entry.name)
+                try:
+                    entry_st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(entry_st.st_mode):
+                        stack.append((entry.path, entry_dst, entry_st))
+                    elif stat.S_ISLNK(entry_st.st_mode):
+                        copy_symlink(entry.path, entry_dst, entry_st, job)
+                    elif stat.S_ISREG(entry_st.st_mode):
+                        pending.acquire()
+                        pool.submit(copy_one, entry.path, entry_dst, entry_st)
+                    else:
+                        errors.append((entry.path, entry_dst, "arquivo especial (FIFO, socket ou dispositivo) ignorado"))
+                except OSError as e:
+                    errors.append((entry.path, entry_dst, str(e)))
+    if failure:
+        raise failure[0]
+    if job:
+        job.check_cancelled()
+
+    # Pastas por último, das mais profundas para a raiz: criar arquivos mudaria o mtime
+    for dir_src, dir_dst, dir_st in reversed(directories):
+        try:
+            copy_metadata(dir_src, dir_dst, dir_st)
+        except OSError as e:
+            errors.append((dir_src, dir_dst, str(e)))
+    if errors:
+        raise shutil.Error(errors)
 
-# --- Funções Auxiliares para Copiar/Mover ---
+def move_tree(src, dst, job=None):
+    """rename no mesmo sistema de arquivos; entre dispositivos, copy_tree e remoção da origem."""
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    copy_tree(src, dst, job)
+    if os.path.isdir(src) and not os.path.islink(src):
+        shutil.rmtree(src)
+    else:
+        os.unlink(src)
 
-def copy_item(src, dst):
+def copy_item(src, dst, job=None):
     """Copia um arquivo ou diretório."""
     try:
-        if os.path.isdir(src):
-            shutil.copytree(src, dst, dirs_exist_ok=True) # Permite que o diretório de destino já exista
-        else:
-            shutil.copy2(src, dst) # copy2 preserva metadados
+        copy_tree(src, dst, job)
         return None # Sem erro
+    except JobCancelled:
+        raise
     except Exception as e:
         return f"Erro ao copiar '{os.path.basename(src)}': {e}"
 
-def move_item(src, dst):
+def move_item(src, dst, job=None):
     """Move um arquivo ou diretório."""
     try:
-        shutil.move(src, dst)
+        move_tree(src, dst, job)
         return None # Sem erro
+    except JobCancelled:
+        raise
     except Exception as e:
         return f"Erro ao mover '{os.path.basename(src)}': {e}"
 
@@ -1938,8 +7548,8 @@ def handle_copy_move(action_type):
          return jsonify({"success": False, "error": f"Sem permissão de escrita na origem para mover: '{source_relative_path}'."}), 403
 
 
-    processed_items = []
     errors = []
+    targets = []
 
     operation_func = copy_item if action_type == 'copy' else move_item
     action_verb_gerund = "copiando" if action_type == 'copy' else "movendo"
@@ -1959,54 +7569,318 @@ def handle_copy_move(action_type):
             errors.append(f"Item de origem '{safe_item_name}' não encontrado.")
             continue
 
-        # Verifica se o destino já existe (shutil.move falha, copytree/copy2 sobrescrevem/falham dependendo)
+        # Verifica se o destino já existe (o rename sobrescreveria arquivos, a cópia mesclaria pastas)
         if os.path.exists(dest_item_path):
             # Para simplificar, vamos impedir a sobrescrita por enquanto
             errors.append(f"Item '{safe_item_name}' já existe no destino.")
             continue
 
-        # Prevenção simples contra mover/copiar para dentro de si mesmo
-        if os.path.isdir(source_item_path) and dest_dir_path.startswith(source_item_path + os.path.sep):
+        # Prevenção contra mover/copiar para dentro de si mesmo (inclusive para a própria pasta)
+        if os.path.isdir(source_item_path) and os.path.commonpath([source_item_path, dest_dir_path]) == source_item_path:
              errors.append(f"Não é possível {action_verb_gerund} a pasta '{safe_item_name}' para dentro dela mesma.")
              continue
 
+        targets.append((safe_item_name, source_item_path, dest_item_path))
 
-        print(f"Tentando {action_verb_gerund} '{source_item_path}' para '{dest_dir_path}'")
-        error = operation_func(source_item_path, dest_item_path) # Passa o caminho completo do destino
+    if not targets:
+        return jsonify({"success": False, "error": f"Nenhum item pode ser {action_verb_past.replace('(s)', '')}.", "errors": errors}), 400
 
-        if error:
-            print(f"Erro ao {action_verb_gerund} '{safe_item_name}': {error}")
-            errors.append(error)
-            # Tentar reverter? Complexo. Por enquanto, apenas reporta.
-        else:
-            print(f"Item '{safe_item_name}' {action_verb_past} com sucesso.")
-            processed_items.append(safe_item_name)
+    def work(job):
+        job.changed_paths.extend([dest_dir_path] + ([source_parent_dir_path] if action_type == 'move' else []))
+        sizes = measure_items(job, [source_item_path for _, source_item_path, _ in targets])
+        processed_items = []
+        for (safe_item_name, source_item_path, dest_item_path), (item_bytes, item_files) in zip(targets, sizes):
+            print(f"Tentando {action_verb_gerund} '{source_item_path}' para '{dest_dir_path}'")
+            bytes_before, files_before = job.bytes_done, job.files_done
+            error = operation_func(source_item_path, dest_item_path, job) # Passa o caminho completo do destino
 
-    if not errors:
-         return jsonify({"success": True, "message": f"{len(processed_items)} item(ns) {action_verb_past} com sucesso."})
-    else:
-         return jsonify({
-            "success": len(processed_items) > 0, # Sucesso parcial
-            "message": f"{len(processed_items)} item(ns) {action_verb_past}. {len(errors)} erro(s) ocorreram.",
-            "processed": processed_items,
-            "errors": errors
-         }), 207 # Multi-Status
+            if error:
+                print(f"Erro ao {action_verb_gerund} '{safe_item_name}': {error}")
+                job.add_error(error)
+                # Tentar reverter? Complexo. Por enquanto, apenas reporta.
+            else:
+                # Completa o progresso do item: rename no mesmo sistema de arquivos, links, pastas vazias
+                job.advance(max(0, bytes_before + item_bytes - job.bytes_done), max(0, files_before + item_files - job.files_done))
+                print(f"Item '{safe_item_name}' {action_verb_past} com sucesso.")
+                processed_items.append(safe_item_name)
 
+        if not job.errors:
+            return f"{len(processed_items)} item(ns) {action_verb_past} com sucesso."
+        return f"{len(processed_items)} item(ns) {action_verb_past}. {len(job.errors)} erro(s) ocorreram."
 
-import zipfile
-import tarfile
-import gzip
-import bz2 # Para .tar.bz2
-import zipfile
-import tarfile
-import gzip
-import bz2 # Para .tar.bz2
+    description = f"{'Copiando' if action_type == 'copy' else 'Movendo'} {len(targets)} item(ns)"
+    try:
+        job = file_jobs.submit(action_type, session.get('username'), domain, description, work, errors)
+    except JobLimitError as e:
+        return jsonify({"success": False, "error": str(e)}), 429
+    return job_response(job)
+
+
+# --- Extração de Arquivos Compactados ---
+# Um único motor para o file manager. O formato vem dos primeiros bytes, não da extensão.
+# O tar (puro ou com gzip, bzip2, xz ou zstd) é validado e extraído membro a membro numa
+# única passada pelo arquivo. O zip tem índice central: é validado por ele antes de gravar
+# qualquer coisa, e os membros são descompactados em paralelo por FM_EXTRACT_WORKERS
+# threads (o zlib libera o GIL). Um arquivo comprimido que não contém um tar (ex: dump.sql.gz)
+# vira um único arquivo descompactado.
+
+try:
+    import lzma # .xz (ausente em alguns builds do Python)
+except ImportError:
+    lzma = None
+try:
+    import zstandard # .zst (opcional: pip install zstandard)
+except ImportError:
+    zstandard = None
+
+ARCHIVE_MAGIC = (
+    (b'PK\x03\x04', 'zip'), (b'PK\x05\x06', 'zip'), # Zip (ou zip vazio)
+    (b'\x1f\x8b', 'gz'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zst'),
+)
+COMPRESSED_SUFFIXES = {'gz': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zst': '.zst'}
+ARCHIVE_DECODE_ERRORS = tuple(error for error in (
+    zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, gzip.BadGzipFile,
+    lzma.LZMAError if lzma else None, zstandard.ZstdError if zstandard else None) if error)
+
+class ArchiveError(ValueError):
+    """Arquivo compactado não suportado, corrompido ou inseguro (mensagem para o usuário)."""
+
+
+def is_tar_header(block):
+    try:
+        tarfile.TarInfo.frombuf(block, tarfile.ENCODING, 'surrogateescape')
+        return True
+    except tarfile.EOFHeaderError:
+        return True # Bloco de zeros: tar vazio
+    except tarfile.HeaderError:
+        return False
+
+def sniff_archive_format(path):
+    """'zip', 'tar', 'gz', 'bz2', 'xz' ou 'zst' pelos bytes iniciais; None se não reconhecido."""
+    with open(path, 'rb') as f:
+        head = f.read(tarfile.BLOCKSIZE)
+    for magic, archive_format in ARCHIVE_MAGIC:
+        if head.startswith(magic):
+            return archive_format
+    if len(head) == tarfile.BLOCKSIZE and is_tar_header(head):
+        return 'tar'
+    return None
+
+def archive_format_error(archive_format):
+    """Mensagem de erro se o formato não pode ser extraído aqui, senão None."""
+    if archive_format is None:
+        return "Formato não reconhecido. Suportados: zip, tar, tar.gz, tar.bz2, tar.xz, tar.zst (e .gz/.bz2/.xz/.zst simples)."
+    if archive_format == 'xz' and lzma is None:
+        return "Este Python não tem suporte a xz (módulo lzma)."
+    if archive_format == 'zst' and zstandard is None:
+        return "Suporte a zstd requer o pacote 'zstandard' (pip install zstandard)."
+    return None
+
+
+class ProgressReader:
+    """Lê o arquivo compactado contando os bytes no progresso (e no cancelamento) da tarefa."""
+
+    def __init__(self, fileobj, job):
+        self.fileobj = fileobj
+        self.job = job
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.job.advance(len(data))
+        return data
+
+
+class PrefixedReader:
+    """Devolve primeiro os bytes já lidos para detectar o conteúdo, depois o resto do stream."""
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b''
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+def open_decompressor(archive_format, raw):
+    if archive_format == 'gz':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if archive_format == 'bz2':
+        return bz2.BZ2File(raw)
+    if archive_format == 'xz':
+        return lzma.LZMAFile(raw)
+    if archive_format == 'zst':
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    return raw
+
+def read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def tar_member_filter(member, target_dir):
+    """
+    Valida um membro antes de gravá-lo: filtro 'data' do tarfile quando disponível (nome,
+    destino de links, permissões, sem dono do arquivo); senão uma checagem equivalente.
+    Retorna o membro a extrair ou None para pular (dispositivos, FIFOs).
+    """
+    if hasattr(tarfile, 'data_filter'):
+        try:
+            return tarfile.data_filter(member, target_dir)
+        except tarfile.SpecialFileError:
+            return None
+        except tarfile.FilterError as e:
+            raise ArchiveError(f"Tentativa de extração insegura detectada no TAR: {e}")
+    if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+        return None
+    target_real = os.path.realpath(target_dir)
+    destination = os.path.realpath(os.path.join(target_real, member.name))
+    if member.issym():
+        link_target = os.path.realpath(os.path.join(os.path.dirname(destination), member.linkname))
+    elif member.islnk():
+        link_target = os.path.realpath(os.path.join(target_real, member.linkname))
+    else:
+        link_target = destination
+    for path in (destination, link_target):
+        if os.path.commonpath([target_real, path]) != target_real:
+            raise ArchiveError(f"Tentativa de extração insegura detectada no TAR: {member.name}")
+    member = copy.copy(member)
+    member.mode &= 0o755 # Sem setuid/setgid e sem escrita para grupo/outros
+    member.uid, member.gid, member.uname, member.gname = os.getuid(), os.getgid(), '', ''
+    return member
+
+def extract_tar_stream(job, stream, target_dir):
+    """Extrai um tar lido sequencialmente ('r|'): cada membro é validado e gravado na mesma passada."""
+    extract_options = {'filter': 'fully_trusted'} if hasattr(tarfile, 'data_filter') else {} # Já filtrado acima
+    directories = []
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            member = tar_member_filter(member, target_dir)
+            if member is None:
+                continue
+            # Atributos das pastas só no fim: uma pasta somente leitura bloquearia o conteúdo
+            tar.extract(member, target_dir, set_attrs=not member.isdir(), **extract_options)
+            if member.isdir():
+                directories.append(member)
+            job.advance(0, 1)
+        for member in reversed(directories):
+            path = os.path.join(target_dir, member.name)
+            try:
+                tar.utime(member, path)
+                tar.chmod(member, path)
+            except tarfile.ExtractError as e:
+                print(f"Aviso: Atributos da pasta '{member.name}' não aplicados: {e}")
+
+def extract_zip_member(job, archive, info, destination, stop):
+    if stop.is_set():
+        return
+    with archive.open(info) as source, open(destination, 'wb') as target:
+        while True:
+            chunk = source.read(FM_EXTRACT_BUFFER_SIZE)
+            if not chunk:
+                break
+            target.write(chunk)
+            job.advance(len(chunk))
+    mode = (info.external_attr >> 16) & 0o755 # Permissões Unix (ex: bits de execução em node_modules/.bin)
+    if mode:
+        os.chmod(destination, mode)
+    timestamp = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(destination, (timestamp, timestamp))
+    job.advance(0, 1)
+
+def extract_zip(job, archive_path, target_dir):
+    """Valida o zip pelo índice central e grava os membros em paralelo."""
+    target_real = os.path.realpath(target_dir)
+    files = []
+    directories = set()
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            destination = os.path.realpath(os.path.join(target_real, info.filename))
+            if os.path.commonpath([target_real, destination]) != target_real or (destination == target_real and not info.is_dir()):
+                raise ArchiveError(f"Tentativa de extração insegura detectada: '{info.filename}' sairia do diretório alvo.")
+            if info.is_dir():
+                directories.add(destination)
+            else:
+                files.append((info, destination))
+                directories.add(os.path.dirname(destination))
+    job.set_total(sum(info.file_size for info, _ in files), len(files))
+    for directory in sorted(directories):
+        os.makedirs(directory, exist_ok=True)
+
+    # Um ZipFile por thread: o objeto compartilha o descritor e não é seguro entre threads
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+    stop = threading.Event()
+
+    def extract(info, destination):
+        archive = getattr(local, 'archive', None)
+        if archive is None:
+            archive = local.archive = zipfile.ZipFile(archive_path)
+            with opened_lock:
+                opened.append(archive)
+        try:
+            extract_zip_member(job, archive, info, destination, stop)
+        except BaseException:
+            stop.set() # As outras threads param no próximo membro
+            raise
 
-# --- Funções Auxiliares de Extração ---
+    try:
+        with ThreadPoolExecutor(max_workers=FM_EXTRACT_WORKERS) as pool:
+            for future in [pool.submit(extract, info, destination) for info, destination in files]:
+                future.result()
+    finally:
+        for archive in opened:
+            archive.close()
+
+def extract_archive(job, archive_path, target_dir):
+    """
+    Extrai 'archive_path' em 'target_dir' e retorna o nome do formato detectado.
+    ArchiveError se o formato não é suportado, se o arquivo está corrompido ou se é inseguro.
+    """
+    archive_format = sniff_archive_format(archive_path)
+    error = archive_format_error(archive_format)
+    if error:
+        raise ArchiveError(error)
+    try:
+        if archive_format == 'zip':
+            extract_zip(job, archive_path, target_dir)
+            return 'ZIP'
+        job.set_total(os.path.getsize(archive_path), 0) # Progresso pelos bytes lidos do arquivo
+        with open(archive_path, 'rb') as raw:
+            stream = open_decompressor(archive_format, ProgressReader(raw, job))
+            head = read_exactly(stream, tarfile.BLOCKSIZE)
+            stream = PrefixedReader(head, stream)
+            if archive_format == 'tar' or (len(head) == tarfile.BLOCKSIZE and is_tar_header(head)):
+                extract_tar_stream(job, stream, target_dir)
+                return 'TAR' if archive_format == 'tar' else f'TAR.{archive_format.upper()}'
+            # Um único arquivo comprimido: grava ao lado, sem a extensão
+            name = os.path.basename(archive_path)
+            suffix = COMPRESSED_SUFFIXES[archive_format]
+            name = name[:-len(suffix)] if name.lower().endswith(suffix) and len(name) > len(suffix) else name + '.out'
+            # Nunca sobrescreve: um link simbólico com esse nome apontaria a escrita para fora do site
+            try:
+                fd = os.open(os.path.join(target_dir, name), os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0o666)
+            except FileExistsError:
+                raise ArchiveError(f"'{name}' já existe na pasta. Remova-o ou renomeie-o antes de extrair.")
+            with os.fdopen(fd, 'wb') as target:
+                shutil.copyfileobj(stream, target, FM_EXTRACT_BUFFER_SIZE)
+            job.advance(0, 1)
+            return archive_format.upper()
+    except (ArchiveError, PermissionError, JobCancelled):
+        raise
+    except ARCHIVE_DECODE_ERRORS as e:
+        raise ArchiveError(f"Arquivo compactado inválido ou corrompido ({archive_format}): {e}")
 
-def is_safe_path(basedir, path_to_check):
-    """Verifica se um caminho está dentro do diretório base (prevenindo ../)."""
-    return os.path.abspath(path_to_check).startswith(os.path.abspath(basedir))
 
 # --- Rota para Extrair Arquivos ---
 
@@ -2046,104 +7920,66 @@ def api_fm_extract():
         print(f"Erro de permissão: Sem permissão de escrita em '{target_dir_path}' para extração.")
         return jsonify({"success": False, "error": f"Sem permissão de escrita no diretório '{relative_path}' para extrair. Verifique as permissões."}), 403
 
-    print(f"Tentando extrair '{archive_path}' para '{target_dir_path}'")
-
-    try:
-        if safe_filename.lower().endswith('.zip'):
-            with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-                # Verificação de segurança: checa membros antes de extrair
-                for member in zip_ref.infolist():
-                    member_path = os.path.join(target_dir_path, member.filename)
-                    if not is_safe_path(target_dir_path, member_path):
-                         raise ValueError(f"Tentativa de extração insegura detectada: '{member.filename}' sairia do diretório alvo.")
-                # Se todos os membros são seguros, extrai
-                zip_ref.extractall(target_dir_path)
-            print(f"Arquivo ZIP '{safe_filename}' extraído com sucesso.")
-
-        elif safe_filename.lower().endswith(('.tar.gz', '.tgz')):
-             with tarfile.open(archive_path, 'r:gz') as tar_ref:
-                 # Verificação de segurança (Python >= 3.12 tem filtro 'data', versões anteriores precisam de checagem manual)
-                 # Adaptado de documentação: https://docs.python.org/3/library/tarfile.html#tarfile-extraction-filter
-                 def is_within_directory(directory, target):
-                      abs_directory = os.path.abspath(directory)
-                      abs_target = os.path.abspath(target)
-                      prefix = os.path.commonprefix([abs_directory, abs_target])
-                      return prefix == abs_directory
-
-                 def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                     for member in tar.getmembers():
-                         member_path = os.path.join(path, member.name)
-                         if not is_within_directory(path, member_path):
-                             raise Exception(f"Tentativa de extração insegura detectada no TAR: {member.name}")
-                     tar.extractall(path, members, numeric_owner=numeric_owner)
-
-                 safe_extract(tar_ref, target_dir_path)
-                 # tar_ref.extractall(target_dir_path) # Versão insegura
-                 print(f"Arquivo TAR.GZ '{safe_filename}' extraído com sucesso.")
-
-        elif safe_filename.lower().endswith(('.tar.bz2', '.tbz2')):
-            with tarfile.open(archive_path, 'r:bz2') as tar_ref:
-                # Reutiliza a mesma função de extração segura
-                def is_within_directory(directory, target):
-                      abs_directory = os.path.abspath(directory)
-                      abs_target = os.path.abspath(target)
-                      prefix = os.path.commonprefix([abs_directory, abs_target])
-                      return prefix == abs_directory
-
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception(f"Tentativa de extração insegura detectada no TAR: {member.name}")
-                    tar.extractall(path, members, numeric_owner=numeric_owner)
-
-                safe_extract(tar_ref, target_dir_path)
-                # tar_ref.extractall(target_dir_path) # Versão insegura
-                print(f"Arquivo TAR.BZ2 '{safe_filename}' extraído com sucesso.")
-
-        elif safe_filename.lower().endswith('.tar'):
-            with tarfile.open(archive_path, 'r:') as tar_ref:
-                # Reutiliza a mesma função de extração segura
-                def is_within_directory(directory, target):
-                      abs_directory = os.path.abspath(directory)
-                      abs_target = os.path.abspath(target)
-                      prefix = os.path.commonprefix([abs_directory, abs_target])
-                      return prefix == abs_directory
-
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception(f"Tentativa de extração insegura detectada no TAR: {member.name}")
-                    tar.extractall(path, members, numeric_owner=numeric_owner)
-
-                safe_extract(tar_ref, target_dir_path)
-                # tar_ref.extractall(target_dir_path) # Versão insegura
-                print(f"Arquivo TAR '{safe_filename}' extraído com sucesso.")
+    # Formato pelos primeiros bytes, não pela extensão (ex: um .zip renomeado continua funcionando)
+    error = archive_format_error(sniff_archive_format(archive_path))
+    if error:
+        return jsonify({"success": False, "error": error}), 400
 
-        else:
-            return jsonify({"success": False, "error": "Tipo de arquivo compactado não suportado. Use .zip, .tar, .tar.gz, .tgz, .tar.bz2, .tbz2."}), 400
-
-        return jsonify({"success": True, "message": f"Arquivo '{safe_filename}' extraído com sucesso em '{relative_path or '/'}'."})
-
-    except zipfile.BadZipFile:
-        return jsonify({"success": False, "error": f"Erro: Arquivo ZIP ('{safe_filename}') inválido ou corrompido."}), 400
-    except tarfile.TarError as e:
-         return jsonify({"success": False, "error": f"Erro ao processar arquivo TAR ('{safe_filename}'): {e}"}), 400
-    except PermissionError as e:
-        # Este erro pode ocorrer se um arquivo DENTRO do zip/tar não puder ser escrito
-        error_msg = f"Erro de permissão durante a extração de '{safe_filename}'. Verifique as permissões no diretório de destino e nos arquivos existentes."
-        print(f"{error_msg} Detalhes: {e}")
-        return jsonify({"success": False, "error": error_msg}), 403
-    except ValueError as e: # Captura o erro de caminho inseguro
-         print(f"Erro de segurança ao extrair '{safe_filename}': {e}")
-         return jsonify({"success": False, "error": f"Erro de segurança ao extrair: {e}"}), 400
-    except Exception as e:
-        error_msg = f"Erro inesperado ao extrair '{safe_filename}': {e}"
-        print(error_msg)
-        # Em produção, evite expor detalhes internos do erro ao cliente
-        # return jsonify({"success": False, "error": "Ocorreu um erro inesperado durante a extração."}), 500
-        return jsonify({"success": False, "error": error_msg}), 500 # Por enquanto, mostra o erro para debug
+    def work(job):
+        job.changed_paths.append(target_dir_path)
+        print(f"Tentando extrair '{archive_path}' para '{target_dir_path}'")
+        try:
+            archive_kind = extract_archive(job, archive_path, target_dir_path)
+        except PermissionError as e:
+            # Este erro pode ocorrer se um arquivo DENTRO do zip/tar não puder ser escrito
+            error_msg = f"Erro de permissão durante a extração de '{safe_filename}'. Verifique as permissões no diretório de destino e nos arquivos existentes."
+            print(f"{error_msg} Detalhes: {e}")
+            raise ValueError(error_msg)
+        except ArchiveError as e:
+            print(f"Erro ao extrair '{safe_filename}': {e}")
+            raise
+        print(f"Arquivo {archive_kind} '{safe_filename}' extraído com sucesso.")
+        return f"Arquivo '{safe_filename}' extraído com sucesso em '{relative_path or '/'}'."
+
+    try:
+        job = file_jobs.submit('extract', session.get('username'), domain, "Extraindo arquivo compactado", work)
+    except JobLimitError as e:
+        return jsonify({"success": False, "error": str(e)}), 429
+    return job_response(job)
+
+
+# --- Rotas das Tarefas em Background ---
+
+def job_visible(record):
+    """Tarefas são visíveis ao usuário que as criou e ao admin."""
+    current_user = session.get('username')
+    return record is not None and (current_user == 'cico' or record.get('username') == current_user)
+
+@app.route('/api/file_manager/jobs', methods=['GET'])
+@login_required
+def api_fm_jobs():
+    """Tarefas do usuário logado (admin: de todos), mais recentes primeiro; ?domain= filtra por site."""
+    current_user = session.get('username')
+    username = None if current_user == 'cico' else current_user
+    return jsonify({"success": True, "jobs": file_jobs.list(username, request.args.get('domain') or None)})
+
+@app.route('/api/file_manager/jobs/<job_id>', methods=['GET'])
+@login_required
+def api_fm_job_status(job_id):
+    record = file_jobs.get(job_id)
+    if not job_visible(record):
+        return jsonify({"success": False, "error": "Tarefa não encontrada."}), 404
+    return jsonify({"success": True, "job": record})
+
+@app.route('/api/file_manager/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def api_fm_job_cancel(job_id):
+    record = file_jobs.get(job_id)
+    if not job_visible(record):
+        return jsonify({"success": False, "error": "Tarefa não encontrada."}), 404
+    if not file_jobs.cancel(job_id):
+        return jsonify({"success": False, "error": "A tarefa já terminou."}), 409
+    return jsonify({"success": True, "message": "Cancelamento solicitado."})
 
 
 # --- Rota para Reiniciar Serviço ---
@@ -2159,8 +7995,7 @@ def restart_service_route(service_name):
         return jsonify({"success": False, "error": "Nome de serviço inválido."}), 400
 
     # 2. Verificar se o serviço pertence a um site gerenciado
-    sites = load_sites()
-    site_found = next((s for s in sites if s.get('service_name') == service_name), None)
+    site_found = storage.site_by_service(service_name)
 
     if not site_found:
         return jsonify({"success": False, "error": f"Serviço '{service_name}' não encontrado ou não associado a um site gerenciado."}), 404
@@ -2178,16 +8013,17 @@ def restart_service_route(service_name):
          print(f"Tentativa de reiniciar serviço '{service_name}' em sistema não-Linux ({platform.system()}).")
          return jsonify({"success": False, "error": "Reiniciar serviços só é suportado em sistemas Linux com systemd."}), 400
 
-    command = ['sudo', 'systemctl', 'restart', service_name]
     print(f"Usuário '{current_user}' solicitou restart do serviço: {service_name}")
-    result = run_command(command, check=False) # check=False para capturar erros
+    try:
+        error_details = systemd.restart([service_name])[service_name]
+    except SystemdError as e:
+        error_details = str(e) or "Erro desconhecido ao reiniciar o serviço."
 
-    if result and result.returncode == 0:
-         print(f"Serviço '{service_name}' reiniciado com sucesso via systemctl.")
+    if error_details is None:
+         print(f"Serviço '{service_name}' reiniciado com sucesso via {systemd.backend}.")
          # Retorna sucesso para o Javascript
          return jsonify({"success": True, "message": f"Serviço '{service_name}' reiniciado com sucesso."})
     else:
-         error_details = result.stderr.strip() if result and result.stderr else "Erro desconhecido ao executar systemctl restart."
          print(f"Falha ao reiniciar o serviço '{service_name}'. Detalhes: {error_details}")
          # Retorna falha com detalhes para o Javascript
          return jsonify({"success": False, "error": f"Falha ao reiniciar o serviço: {error_details}"}), 500
@@ -2199,15 +8035,78 @@ def restart_service_route(service_name):
 
 
 
+# --- Estado dos Serviços (systemd) ---
+
+@app.route('/api/services/status', methods=['GET'])
+@login_required
+def api_services_status():
+    """Estado no systemd dos serviços dos sites do usuário (admin: de todos), numa única consulta."""
+    current_user = session.get('username')
+    sites = storage.list_sites() if current_user == 'cico' else storage.sites_by_owner(current_user)
+    services = sorted({site['service_name'] for site in sites if site.get('service_name')})
+    if platform.system() != 'Linux' or not services:
+        return jsonify({"success": True, "backend": systemd.backend, "services": {}})
+    try:
+        states = systemd.status(services)
+    except SystemdError as e:
+        return jsonify({"success": False, "error": f"Falha ao consultar o systemd: {e}"}), 502
+    return jsonify({"success": True, "backend": systemd.backend, "services": states})
+
+
+# --- Linha de Comando (flask --app app <comando>) ---
+
+@app.cli.command('import-sites')
+@click.argument('manifest', type=click.File('r', encoding='utf-8'))
+@click.option('--owner', default='cico', show_default=True, help="Dono dos sites sem a coluna 'owner'.")
+@click.option('--dry-run', is_flag=True, help="Só valida o manifesto.")
+@click.option('--report', 'report_file', type=click.File('w', encoding='utf-8'), help="Grava o relatório (JSON) neste arquivo.")
+def import_sites_command(manifest, owner, dry_run, report_file):
+    """Provisiona os sites de um manifesto JSON ou CSV (mesmo formato de /api/provisioning/bulk)."""
+    extension = os.path.splitext(manifest.name)[1].lower()
+    try:
+        rows = parse_site_manifest(manifest.read(), {'.json': 'json', '.csv': 'csv'}.get(extension))
+    except ValueError as e:
+        raise click.ClickException(f"Manifesto inválido: {e}")
+    # Sem retomar provisionamentos antigos: eles pertencem ao painel em execução
+    provisioning.start(resume=False)
+    specs, errors = validate_site_manifest(rows, owner)
+    if errors:
+        for error in errors:
+            click.echo(f"Linha {error['row']} ({error['domain'] or '-'}): {error['error']}", err=True)
+        raise click.ClickException(f"{len(errors)} erro(s) no manifesto. Nenhum site foi provisionado.")
+    if dry_run:
+        click.echo(f"Manifesto válido: {len(specs)} site(s).")
+        return
+
+    click.echo(f"Provisionando {len(specs)} site(s)...")
+    report = provisioning.wait_batch(provisioning.submit_batch(owner, specs))
+    for site in report['sites']:
+        duration = f"{site['duration']:.1f}s" if site['duration'] is not None else '-'
+        click.echo(f"{site['status']:<7} {duration:>8}  {site['domain']}: {site['message']}")
+    click.echo(f"Concluídos: {report['done']} (com avisos: {report['with_warnings']}), falhas: {report['failed']}, "
+               f"tempo total: {report['elapsed'] or 0:.1f}s.")
+    if report_file is not None:
+        json.dump(report, report_file, indent=2, ensure_ascii=False)
+    if report['failed']:
+        raise SystemExit(1)
+
+
 # --- Ponto de Entrada da Aplicação ---
 
 if __name__ == '__main__':
-    # --- Inicia a thread de logging em background ---
-    # Roda a primeira vez imediatamente para ter dados iniciais
-    log_system_stats()
-    # Cria e inicia a thread como daemon (encerra junto com o app principal)
-    scheduler_thread = threading.Thread(target=run_logging_scheduler, daemon=True)
-    scheduler_thread.start()
+    # --- Resolve o IP público em background (a primeira resolução começa agora) ---
+    start_public_ip_resolver()
+
+    # --- Inicia o sampler de métricas em background ---
+    # Ele também persiste o nível de 5 minutos (a primeira vez logo na primeira amostra)
+    # e roda como daemon (encerra junto com o app principal)
+    start_metrics_sampler()
+
+    # --- Indexador de uso de disco dos sites (inotify quando disponível) ---
+    start_disk_indexer()
+
+    # --- Retoma provisionamentos de sites interrompidos por um reinício ---
+    provisioning.start()
 
     # ATENÇÃO: Rodar com 0.0.0.0 expõe na rede. Use 127.0.0.1 para acesso local apenas.
     #          O ideal é usar um servidor WSGI como Gunicorn ou Waitress por trás de um Nginx.